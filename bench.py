@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the demon. Runs it in-process with the simulated mount backend,
+so it needs no root and touches no real mounts. The "disk" is slowed down
+to look like a slow one (see --disk-latency and --disk-bandwidth).
+Results are stored as JSON per commit, so runs can be compared.
+"""
+
+
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from demon import RamPipeDaemon
+
+MB = 1024 * 1024
+
+
+def write_file(path, size, rng):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(rng.randbytes(size))
+
+
+def small_files_tree(root, scale, rng):
+    """Lots of small files, like a source tree or a cache"""
+    for i in range(int(5000 * scale)):
+        write_file(root / f"dir{i % 100}" / f"file{i}", rng.randint(1024, 16 * 1024), rng)
+
+
+def small_files_dirty(root, scale, rng):
+    """Rewrite 5% of the files"""
+    files = sorted(root.rglob('file*'))
+    for path in rng.sample(files, max(1, len(files) // 20)):
+        write_file(path, rng.randint(1024, 16 * 1024), rng)
+
+
+def huge_files_tree(root, scale, rng):
+    """A few big files, like VM images or game assets"""
+    for i in range(3):
+        write_file(root / f"huge{i}", int(64 * MB * scale), rng)
+
+
+def huge_files_dirty(root, scale, rng):
+    """Overwrite some chunks of one file, append to another"""
+    with open(root / 'huge0', 'r+b') as f:
+        for _ in range(4):
+            f.seek(rng.randrange(0, int(60 * MB * scale)))
+            f.write(rng.randbytes(int(4 * MB * scale)))
+    with open(root / 'huge1', 'ab') as f:
+        f.write(rng.randbytes(int(8 * MB * scale)))
+
+
+def sqlite_tree(root, scale, rng):
+    """One database file"""
+    write_file(root / 'app.db', int(64 * MB * scale), rng)
+
+
+def sqlite_dirty(root, scale, rng):
+    """Transactions the way SQLite does them: a rollback journal, a few 4K pages rewritten in place"""
+    db_size = int(64 * MB * scale)
+    with open(root / 'app.db', 'r+b') as db:
+        for _ in range(int(500 * scale) or 1):
+            journal = root / 'app.db-journal'
+            pages = [rng.randrange(0, db_size // 4096) for _ in range(5)]
+            with open(journal, 'wb') as f:
+                for page in pages:
+                    db.seek(page * 4096)
+                    f.write(db.read(4096))
+            for page in pages:
+                db.seek(page * 4096)
+                db.write(rng.randbytes(4096))
+            db.flush()
+            journal.unlink()
+
+
+SCENARIOS = {
+    'small_files': (small_files_tree, small_files_dirty),
+    'huge_files': (huge_files_tree, huge_files_dirty),
+    'sqlite': (sqlite_tree, sqlite_dirty),
+}
+
+
+def memory_mb():
+    """Current and peak RSS of this process"""
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                values[key] = int(value.split()[0]) / 1024
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+
+def flushed_bytes(daemon):
+    return daemon.metrics.get('rampipe_flushed_bytes_total', type='move')
+
+
+def run_scenario(daemon, name, disk_dir, scale, seed):
+    make_tree, make_dirty = SCENARIOS[name]
+    rng = random.Random(seed)
+    root = disk_dir / name
+    make_tree(root, scale, rng)
+    size = sum(p.stat().st_size for p in root.rglob('*') if p.is_file())
+
+    started = time.monotonic()
+    daemon.pin_move(root)
+    pin_seconds = time.monotonic() - started
+    rss_pinned, _ = memory_mb()
+
+    # Applications write to the pinned path, which the simulated backend resolves to the RAM copy
+    make_dirty(Path(daemon.mounts.resolve(root)), scale, rng)
+    time.sleep(0.5)  # Let inotify catch up
+    before = flushed_bytes(daemon)
+    started = time.monotonic()
+    daemon.run_sync()
+    sync_seconds = time.monotonic() - started
+    dirty_mb = (flushed_bytes(daemon) - before) / MB
+
+    latencies = []
+    for _ in range(200):
+        started = time.monotonic()
+        daemon.execute({'action': 'status'})
+        latencies.append(time.monotonic() - started)
+    latencies.sort()
+
+    started = time.monotonic()
+    daemon.unpin(str(root))
+    unpin_seconds = time.monotonic() - started
+
+    return {
+        'size_mb': size / MB,
+        'pin_seconds': pin_seconds,
+        'pin_mb_per_second': size / MB / pin_seconds if pin_seconds else None,
+        'dirty_mb': dirty_mb,
+        'sync_seconds': sync_seconds,
+        'sync_seconds_per_dirty_mb': sync_seconds / dirty_mb if dirty_mb else None,
+        'status_median_ms': statistics.median(latencies) * 1000,
+        'status_p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'unpin_seconds': unpin_seconds,
+        'rss_mb_while_pinned': rss_pinned,
+    }
+
+
+def git_commit():
+    """The commit being benchmarked, with -dirty if the tree has changes"""
+    repo = Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return 'unknown'
+    return commit + ('-dirty' if changes else '')
+
+
+def compare(results, old):
+    """Print how each number changed against an earlier run"""
+    print(f"\nCompared to {old['commit']} (lower is better, except MB/s):")
+    for name, metrics in results['results'].items():
+        for key, value in metrics.items():
+            before = old['results'].get(name, {}).get(key)
+            if not isinstance(value, (int, float)) or not before:
+                continue
+            print(f"  {name}.{key}: {before:.4g} -> {value:.4g} ({(value / before - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RamPipe benchmarks, run without root')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Only run this scenario (can be given more than once)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply file counts and sizes by this')
+    parser.add_argument('--disk-latency', type=float, default=0.0005, help='Seconds per file on the "disk"')
+    parser.add_argument('--disk-bandwidth', default='200M', help='Bytes per second of the "disk", 0 for unlimited')
+    parser.add_argument('--work-dir', help='Where to create the trees (default: a temporary directory)')
+    parser.add_argument('--output', default='bench-results', help='Directory to store the results in')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Read it now, the new results may well go to the same file
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='rampipe-bench-'))
+    disk_dir = work_dir / 'disk'
+    disk_dir.mkdir(parents=True, exist_ok=True)
+    config_path = work_dir / 'rampipe.conf'
+    config_path.write_text('\n'.join([
+        'mount_backend = simulated',
+        f'sim_disk_latency = {args.disk_latency}',
+        f'sim_disk_bandwidth = {args.disk_bandwidth}',
+        f'ramdisk_path = {work_dir / "ram"}',
+        f'overlay_base = {work_dir / "overlays"}',
+        f'disk_view_base = {work_dir / "views"}',
+        f'state_file = {work_dir / "state.json"}',
+        f'socket_path = {work_dir / "rampipe.sock"}',
+        f'manifest_file = {work_dir / "rampipe.manifest"}',
+    ]) + '\n')
+
+    try:
+        daemon = RamPipeDaemon(str(config_path))
+        results = {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'params': {'scale': args.scale, 'disk_latency': args.disk_latency,
+                       'disk_bandwidth': args.disk_bandwidth, 'seed': args.seed},
+            'results': {},
+        }
+        for name in args.scenario or sorted(SCENARIOS):
+            print(f"Running {name}...", flush=True)
+            results['results'][name] = run_scenario(daemon, name, disk_dir, args.scale, args.seed)
+        results['peak_rss_mb'] = memory_mb()[1]
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for name, metrics in results['results'].items():
+        print(f"{name}:")
+        for key, value in metrics.items():
+            print(f"  {key}: {value:.4g}" if isinstance(value, float) else f"  {key}: {value}")
+    print(f"peak RSS: {results['peak_rss_mb']:.1f} MB")
+
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    result_file = output / f"{results['commit']}.json"
+    with open(result_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {result_file}")
+
+    if old is not None:
+        compare(results, old)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,18 +16,2230 @@ import subprocess
 import threading
 import socket
 import shutil
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import stat
+import hashlib
+import tempfile
+import fnmatch
+import mmap
+import resource
+import fcntl
+import re
+import socketserver
+import http.server
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+_libc.inotify_init1.argtypes = [ctypes.c_int]
+_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+_libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+# capabilities(7), the one that lets mlock ignore RLIMIT_MEMLOCK
+CAP_IPC_LOCK = 14
+
+# FIEMAP ioctl, see <linux/fiemap.h>: struct fiemap, then fm_extent_count struct fiemap_extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')        # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count
+FIEMAP_EXTENT = struct.Struct('=QQQ16xI12x')    # fe_logical, fe_physical, fe_length, fe_flags
+FIEMAP_EXTENT_LAST = 0x1
+
+# inotify(7) event bits, see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# No IN_OPEN: reads would flood the queue, note_open_files covers use without writes
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Socket protocol: every message is a 4-byte big-endian length followed by that much JSON
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+SOCKET_BACKLOG = 128
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def set_idle_io_priority():
+    """Put the calling thread into the idle I/O class, so it only gets the disk when nobody else wants it"""
+    try:
+        subprocess.run(['ionice', '-c', '3', '-p', str(threading.get_native_id())],
+                       check=True, capture_output=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        print(f"Warning: Could not set idle I/O priority: {e}", file=sys.stderr)
+
+
+def parse_size(value):
+    """Turn sizes like 512M or 1G (the format mount uses) into bytes"""
+    value = str(value).strip().strip('"').upper()
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+TIMESPAN_UNITS = {'us': 1e-6, 'ms': 1e-3, 's': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+def parse_timespan(value):
+    """Turn time spans like 90, 90s or 1min 30s (the format systemd uses) into seconds, None for infinity"""
+    value = str(value).strip().strip('"')
+    if value == 'infinity':
+        return None
+    if not re.fullmatch(r'(\s*[\d.]+\s*(min|ms|us|h|d|s)?)+', value):
+        raise ValueError(f"Invalid time span: {value}")
+    return sum(float(number) * TIMESPAN_UNITS[unit or 's']
+               for number, unit in re.findall(r'([\d.]+)\s*(min|ms|us|h|d|s)?', value))
+
+
+MANIFEST_MODES = ('move', 'overlay', 'lazy', 'dedup', 'lock')
+TIERS = ('tmpfs', 'zram')
+
+def make_filters(include=None, exclude=None, max_file_size=0):
+    """The filters of a selective pin, None if there aren't any"""
+    filters = {'include': list(include or []), 'exclude': list(exclude or []),
+               'max_file_size': parse_size(max_file_size or 0)}
+    return filters if any(filters.values()) else None
+
+
+def glob_matches(rel, patterns):
+    """Whether the name or the path (relative to the pin) matches one of the globs"""
+    return any(fnmatch.fnmatch(os.path.basename(rel), pattern) or fnmatch.fnmatch(rel, pattern)
+               for pattern in patterns)
+
+
+def filtered_files(root, filters=None, left_out=None):
+    """
+    The regular files below root that pass the filters, as {relative path: stat}.
+    Excluded directories aren't even walked into. If left_out is a list, the
+    excluded directories and the excluded or too big regular files go into it
+    """
+    filters = filters or {}
+    include, exclude = filters.get('include') or [], filters.get('exclude') or []
+    max_file_size = filters.get('max_file_size') or 0
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        rel_dir = '' if rel_dir == '.' else rel_dir
+        kept = []
+        for name in dirnames:
+            rel = os.path.join(rel_dir, name)
+            if not glob_matches(rel, exclude):
+                kept.append(name)
+            elif left_out is not None and not os.path.islink(os.path.join(dirpath, name)):
+                left_out.append(rel)
+        dirnames[:] = kept
+        for name in filenames:
+            rel = os.path.join(rel_dir, name)
+            excluded = glob_matches(rel, exclude)
+            if (excluded and left_out is None) or (include and not excluded and not glob_matches(rel, include)):
+                continue
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if excluded or (max_file_size and st.st_size > max_file_size):
+                if left_out is not None:
+                    left_out.append(rel)
+                continue
+            files[rel] = st
+    return files
+
+
+def parse_manifest(manifest_path):
+    """
+    Read the pin manifest. One pin per line: the path, then optionally
+    mode=move|overlay|lazy|dedup|lock, tier=tmpfs|zram, include=GLOB and exclude=GLOB (can
+    be given more than once) and max_file_size=N (not for lazy and dedup), priority=N (higher
+    goes first) and critical (the daemon only reports ready once those are in RAM)
+    """
+    entries = []
+    with open(manifest_path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            words = line.split()
+            entry = {'path': words[0], 'mode': 'move', 'tier': 'tmpfs', 'include': [], 'exclude': [],
+                     'max_file_size': 0, 'priority': 0, 'critical': False}
+            try:
+                for word in words[1:]:
+                    if word == 'critical':
+                        entry['critical'] = True
+                    elif word.startswith('mode=') and word[5:] in MANIFEST_MODES:
+                        entry['mode'] = word[5:]
+                    elif word.startswith('tier=') and word[5:] in TIERS:
+                        entry['tier'] = word[5:]
+                    elif word.startswith('include=') and word[8:]:
+                        entry['include'].append(word[8:])
+                    elif word.startswith('exclude=') and word[8:]:
+                        entry['exclude'].append(word[8:])
+                    elif word.startswith('max_file_size='):
+                        entry['max_file_size'] = parse_size(word[14:])
+                    elif word.startswith('priority='):
+                        entry['priority'] = int(word[9:])
+                    else:
+                        raise ValueError(f"unknown option {word}")
+            except ValueError as e:
+                print(f"Warning: Skipping line {number} of {manifest_path}: {e}", file=sys.stderr)
+                continue
+            entries.append(entry)
+    return entries
+
+
+def proc_field(path, key):
+    """A 'Key: value' line of a /proc file like /proc/meminfo, '' if it isn't there"""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == key:
+                    return value.strip()
+    except OSError:
+        pass
+    return ''
+
+
+def proc_bytes(path, key):
+    """A '123 kB' field of a /proc file in bytes"""
+    value = proc_field(path, key).split()
+    return int(value[0]) * 1024 if value else 0
+
+
+def unescape_mountinfo(field):
+    """mountinfo writes spaces, tabs, newlines and backslashes in paths as octal escapes"""
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+
+def notify_systemd(message):
+    """Send a message to systemd if it started us with Type=notify, else do nothing"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode('utf-8'), address)
+    except OSError as e:
+        print(f"Warning: Could not notify systemd: {e}", file=sys.stderr)
+
+
+class DirtyTracker:
+    """
+    Keeps inotify watches on the tmpfs copies of move pins and on the upper
+    dirs of overlay pins, and journals which paths changed since the last
+    sync, so write-back only touches those.
+    A pin whose watches could not be set up, or whose events were lost because
+    the kernel queue overflowed, is flagged for a full sync instead.
+    """
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self.lock = threading.Lock()
+        self.watches = {}       # wd -> (pin path, path relative to the pin root)
+        self.roots = {}         # pin path -> tmpfs copy being watched
+        self.journals = {}      # pin path -> {relative path: 'write' | 'delete'}
+        self.needs_full = set() # pins whose journal can't be trusted
+        self.untracked = set()  # pins that ran out of watches, always fully synced
+        self.last_event = {}    # pin path -> time anything changed below it
+        self.dirty_times = {}   # pin path -> {relative path: (first change, last change)}
+        self.on_change = None   # called with (pin, relative path) for every journaled change
+        self.running = True
+
+    def start(self):
+        thread = threading.Thread(target=self.event_loop, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def watch(self, pin, root, full=False):
+        """Start journaling changes below root for pin"""
+        with self.lock:
+            self.roots[pin] = str(root)
+            self.journals[pin] = {}
+            self.dirty_times[pin] = {}
+            if full:
+                self.needs_full.add(pin)
+            self.add_tree(pin, '', mark=False)
+
+    def unwatch(self, pin):
+        """Drop all watches and the journal of pin"""
+        with self.lock:
+            for wd, (owner, _) in list(self.watches.items()):
+                if owner == pin:
+                    _libc.inotify_rm_watch(self.fd, wd)
+                    del self.watches[wd]
+            self.roots.pop(pin, None)
+            self.journals.pop(pin, None)
+            self.needs_full.discard(pin)
+            self.untracked.discard(pin)
+            self.last_event.pop(pin, None)
+            self.dirty_times.pop(pin, None)
+
+    def take(self, pin, settle=0, max_age=None):
+        """
+        Hand out the journal of pin and start a new one. Returns (entries, full).
+        With settle, paths changed within the last settle seconds stay in the
+        journal, so a file that is being rewritten again and again is written
+        back once it calms down, or once it has been dirty for max_age seconds
+        """
+        with self.lock:
+            entries = self.journals.get(pin, {})
+            times = self.dirty_times.get(pin, {})
+            full = self.is_full(pin)
+            self.needs_full.discard(pin)
+
+            held = {}
+            if settle and not full:
+                now = time.time()
+                for rel, op in entries.items():
+                    first, last = times.get(rel, (0, 0))
+                    if now - last < settle and (max_age is None or now - first < max_age):
+                        held[rel] = op
+                for rel in held:
+                    del entries[rel]
+            for rel in entries:
+                times.pop(rel, None)
+            self.journals[pin] = held
+            return entries, full
+
+    def peek(self, pin):
+        """The journal of pin without taking it. Returns (entries, full)"""
+        with self.lock:
+            return dict(self.journals.get(pin, {})), self.is_full(pin)
+
+    def wants_full(self, pin):
+        """Whether the next sync of pin has to be a full one"""
+        with self.lock:
+            return self.is_full(pin)
+
+    def is_full(self, pin):
+        """Caller holds self.lock"""
+        return pin in self.needs_full or pin in self.untracked or pin not in self.roots
+
+    def restore(self, pin, entries, full):
+        """Put back a journal that could not be written out"""
+        with self.lock:
+            if pin not in self.roots:
+                return
+            journal = self.journals[pin]
+            for rel, op in entries.items():
+                journal.setdefault(rel, op)
+            if full:
+                self.needs_full.add(pin)
+
+    def add_watch(self, pin, rel):
+        """Watch one directory (or the pinned file itself). Caller holds self.lock"""
+        path = os.path.join(self.roots[pin], rel) if rel else self.roots[pin]
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT:
+                return
+            if pin not in self.untracked:
+                print(f"Warning: Could not watch {path} ({os.strerror(err)}), "
+                      f"falling back to full syncs for {pin}", file=sys.stderr)
+            self.untracked.add(pin)
+            return
+        self.watches[wd] = (pin, rel)
+
+    def add_tree(self, pin, rel, mark):
+        """Watch a directory tree, optionally marking everything in it dirty. Caller holds self.lock"""
+        top = os.path.join(self.roots[pin], rel) if rel else self.roots[pin]
+        self.add_watch(pin, rel)
+        if not os.path.isdir(top) or os.path.islink(top):
+            return
+        for dirpath, dirnames, filenames in os.walk(top):
+            base = os.path.relpath(dirpath, self.roots[pin])
+            base = '' if base == '.' else base
+            for name in dirnames:
+                self.add_watch(pin, os.path.join(base, name))
+            if mark:
+                for name in dirnames + filenames:
+                    self.journal(pin, os.path.join(base, name), 'write')
+
+    def journal(self, pin, rel, op):
+        """Record a change. Caller holds self.lock"""
+        now = time.time()
+        times = self.dirty_times[pin]
+        times[rel] = (times.get(rel, (now, now))[0], now)
+        self.journals[pin][rel] = op
+        if self.on_change is not None:
+            self.on_change(pin, rel)
+
+    def event_loop(self):
+        while self.running:
+            try:
+                ready, _, _ = select.select([self.fd], [], [], 1)
+                if not ready:
+                    continue
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            except Exception as e:
+                print(f"Warning: inotify read failed: {e}", file=sys.stderr)
+                time.sleep(1)
+                continue
+            with self.lock:
+                self.handle_events(data)
+
+    def handle_events(self, data):
+        """Turn raw inotify events into journal entries. Caller holds self.lock"""
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                print("Warning: inotify queue overflowed, next sync will be a full one", file=sys.stderr)
+                self.needs_full.update(self.roots)
+                continue
+            if wd not in self.watches:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            pin, rel = self.watches[wd]
+            self.last_event[pin] = time.time()
+            if name:
+                rel = os.path.join(rel, name)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.journal(pin, rel, 'delete')
+            else:
+                self.journal(pin, rel, 'write')
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    # Anything created before the watch got added would be missed otherwise
+                    self.add_tree(pin, rel, mark=True)
+
+
+class SizeIndex:
+    """
+    RAM used by each pin, as allocated bytes (st_blocks) per file. Built once
+    when a pin is made, afterwards only the paths reported as changed get
+    looked at again, so asking for a total never walks a tree
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = {}   # pin -> directory or file the sizes are relative to
+        self.sizes = {}   # pin -> {relative path: allocated bytes}
+        self.totals = {}  # pin -> sum of sizes
+        self.stale = {}   # pin -> relative paths to look at again
+
+    @staticmethod
+    def allocated(st):
+        return st.st_blocks * 512
+
+    @staticmethod
+    def scan(root):
+        """Allocated bytes of everything below root"""
+        sizes = {}
+        try:
+            sizes[''] = SizeIndex.allocated(os.lstat(root))
+        except OSError:
+            return sizes
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                full = os.path.join(dirpath, name)
+                try:
+                    sizes[os.path.relpath(full, root)] = SizeIndex.allocated(os.lstat(full))
+                except OSError:
+                    pass
+        return sizes
+
+    def build(self, pin, root):
+        self.replace(pin, root, self.scan(root))
+
+    def replace(self, pin, root, sizes):
+        """Take sizes from a walk somebody did anyway"""
+        with self.lock:
+            self.roots[pin] = str(root)
+            self.sizes[pin] = sizes
+            self.totals[pin] = sum(sizes.values())
+            # Paths marked while the walk ran may have changed after it looked at them
+            self.stale[pin] = self.stale.get(pin, set())
+
+    def drop(self, pin):
+        with self.lock:
+            for table in (self.roots, self.sizes, self.totals, self.stale):
+                table.pop(pin, None)
+
+    def mark(self, pin, rel):
+        """Note that rel below pin changed"""
+        with self.lock:
+            if pin in self.stale:
+                self.stale[pin].add(rel)
+
+    def refresh(self, pin):
+        """Look at the paths that changed since the last refresh"""
+        with self.lock:
+            if pin not in self.stale:
+                return
+            stale, self.stale[pin] = self.stale[pin], set()
+            root, sizes = self.roots[pin], self.sizes[pin]
+            for rel in stale:
+                full = os.path.join(root, rel) if rel else root
+                try:
+                    sizes[rel] = self.allocated(os.lstat(full))
+                except OSError:
+                    sizes.pop(rel, None)
+                    # A deleted or renamed directory takes everything below it along
+                    prefix = rel + os.sep
+                    for child in [child for child in sizes if child.startswith(prefix)]:
+                        del sizes[child]
+            self.totals[pin] = sum(sizes.values())
+
+    def bytes_of(self, pin, rels):
+        """Allocated bytes of some paths below pin"""
+        self.refresh(pin)
+        with self.lock:
+            sizes = self.sizes.get(pin, {})
+            return sum(sizes.get(rel, 0) for rel in rels)
+
+    def total(self, pin):
+        """Allocated bytes of pin, None if it isn't indexed (yet)"""
+        self.refresh(pin)
+        with self.lock:
+            return self.totals.get(pin)
+
+
+# name -> (type, help). Everything the daemon records has to be listed here
+METRICS = {
+    'rampipe_sync_duration_seconds': ('histogram', 'Duration of a sync of all pins'),
+    'rampipe_sync_bytes_total': ('counter', 'Bytes written to disk by syncs of all pins'),
+    'rampipe_pin_sync_duration_seconds': ('histogram', 'Duration of the write-back of one pin'),
+    'rampipe_pin_sync_bytes_total': ('counter', 'Bytes written to disk by the write-back of one pin'),
+    'rampipe_flushed_files_total': ('counter', 'Files written to disk, by pin type'),
+    'rampipe_flushed_bytes_total': ('counter', 'Bytes written to disk, by pin type'),
+    'rampipe_pin_duration_seconds': ('histogram', 'Time it took to pin a path'),
+    'rampipe_pin_bytes_total': ('counter', 'Bytes copied into RAM when pinning'),
+    'rampipe_unpin_duration_seconds': ('histogram', 'Time it took to unpin a path, write-back included'),
+    'rampipe_request_duration_seconds': ('histogram', 'Time it took to answer a socket request'),
+    'rampipe_ram_writes_total': ('counter', 'Changes to files of move pins seen by inotify'),
+    'rampipe_pins': ('gauge', 'Pinned paths, by type'),
+    'rampipe_pinned_bytes': ('gauge', 'RAM used by pins, by type'),
+    'rampipe_ram_used_bytes': ('gauge', 'Used bytes of the RAM filesystems'),
+    'rampipe_ram_size_bytes': ('gauge', 'Size of the RAM filesystems'),
+    'rampipe_dirty_bytes': ('gauge', 'Bytes waiting to be written back'),
+    'rampipe_disk_writes_avoided': ('gauge', 'Estimated writes that never reached the disk'),
+    'rampipe_time_to_warm_seconds': ('gauge', 'Time from daemon start until the manifest pins were in RAM'),
+}
+
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Metrics:
+    """Counters, gauges and histograms, keyed by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}        # (name, labels) -> number
+        self.histograms = {}    # (name, labels) -> [bucket counts, sum, count]
+
+    @staticmethod
+    def key(name, labels):
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.values.get(self.key(name, labels), 0)
+
+    def snapshot(self):
+        """Everything as plain data, for the socket"""
+        snapshot = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), (buckets, total, count) in self.histograms.items():
+                snapshot.setdefault(name, []).append({'labels': dict(labels), 'count': count, 'sum': total,
+                                                      'buckets': dict(zip(HISTOGRAM_BUCKETS, buckets))})
+        return snapshot
+
+    def prometheus(self):
+        """Everything in the Prometheus text format"""
+        def series(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return name
+            escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                       for k, v in pairs]
+            return name + '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in METRICS.items():
+                values = [(labels, value) for (n, labels), value in self.values.items() if n == name]
+                histograms = [(labels, h) for (n, labels), h in self.histograms.items() if n == name]
+                if not values and not histograms:
+                    continue
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in values:
+                    lines.append(f'{series(name, labels)} {value}')
+                for labels, (buckets, total, count) in histograms:
+                    for bound, bucket in zip(HISTOGRAM_BUCKETS, buckets):
+                        lines.append(f'{series(name + "_bucket", labels, [("le", bound)])} {bucket}')
+                    lines.append(f'{series(name + "_bucket", labels, [("le", "+Inf")])} {count}')
+                    lines.append(f'{series(name + "_sum", labels)} {total}')
+                    lines.append(f'{series(name + "_count", labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /metrics for Prometheus"""
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.rampipe.metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown everything else
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # http.server expects an address it can print
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+class RateLimiter:
+    """
+    Token bucket for bytes per second and operations per second toward one
+    device. Callers that go over the budget sleep off the debt, so concurrent
+    writers share the budget. A limit of 0 means unlimited
+    """
+
+    def __init__(self, bandwidth=0, iops=0):
+        self.bandwidth = bandwidth
+        self.iops = iops
+        self.lock = threading.Lock()
+        self.byte_tokens = bandwidth
+        self.op_tokens = iops
+        self.updated = time.monotonic()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Make everyone using this limiter give up at their next write, sleeping or not"""
+        self.cancelled.set()
+
+    def consume(self, nbytes=0, ops=0):
+        if self.cancelled.is_set():
+            raise Exception("Write-back was cancelled")
+        if not self.bandwidth and not self.iops:
+            return
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            delay = 0
+            if self.bandwidth:
+                self.byte_tokens = min(self.bandwidth, self.byte_tokens + elapsed * self.bandwidth) - nbytes
+                delay = max(delay, -self.byte_tokens / self.bandwidth)
+            if self.iops:
+                self.op_tokens = min(self.iops, self.op_tokens + elapsed * self.iops) - ops
+                delay = max(delay, -self.op_tokens / self.iops)
+        if delay > 0 and self.cancelled.wait(delay):
+            raise Exception("Write-back was cancelled")
+
+
+class SimulatedDisk:
+    """
+    Slows copies down like a slow disk would: a fixed latency per file plus
+    a bandwidth limit. Unlike RateLimiter there is no burst, transfers queue
+    up behind each other like on a single disk
+    """
+
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.busy_until = 0
+
+    def consume(self, nbytes=0, ops=0):
+        delay = ops * self.latency
+        if self.bandwidth and nbytes:
+            with self.lock:
+                now = time.monotonic()
+                self.busy_until = max(now, self.busy_until) + nbytes / self.bandwidth
+                delay += self.busy_until - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MountBackend:
+    """
+    Everything the daemon does to the mount table. SystemMountBackend does
+    the real thing and needs root, SimulatedMountBackend only pretends, so
+    the daemon can be run and benchmarked without root
+    """
+
+    def is_mountpoint(self, path):
+        raise NotImplementedError
+
+    def mount_tmpfs(self, path, size):
+        raise NotImplementedError
+
+    def bind(self, src, dst, private=False):
+        """Bind src over dst. A private bind doesn't see mounts made later under src"""
+        raise NotImplementedError
+
+    def mount_overlay(self, lower, upper, work, merged):
+        raise NotImplementedError
+
+    def umount(self, path, force=False, check=True):
+        raise NotImplementedError
+
+    def submounts(self, path):
+        raise NotImplementedError
+
+    def mount_table(self):
+        """
+        What is mounted, in mount order, as dicts with the id, parent (id), dev
+        (major:minor), root (inside its filesystem), target, fstype and options
+        """
+        raise NotImplementedError
+
+    def shows(self, target, source):
+        """Whether target shows the data of source, like after binding source over it"""
+        try:
+            a, b = os.stat(target), os.stat(source)
+        except OSError:
+            return False
+        return (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+
+    def create_zram(self, size, algorithm, mem_limit=0):
+        """Set up a zram device with a filesystem on it, returns the device"""
+        raise NotImplementedError
+
+    def mount_zram(self, device, path):
+        raise NotImplementedError
+
+    def destroy_zram(self, device):
+        raise NotImplementedError
+
+    def zram_stats(self, device):
+        """Bytes stored, bytes after compression and RAM used, None if unknown"""
+        raise NotImplementedError
+
+    def resolve(self, path):
+        """Where the data of path really is"""
+        return str(path)
+
+
+class SystemMountBackend(MountBackend):
+    """Real mounts, with mount(8) and friends"""
+
+    def is_mountpoint(self, path):
+        return subprocess.run(['mountpoint', '-q', str(path)]).returncode == 0
+
+    def mount_tmpfs(self, path, size):
+        subprocess.run(['mount', '-t', 'tmpfs', '-o', f'size={size}', 'tmpfs', str(path)],
+                       check=True, capture_output=True)
+
+    def bind(self, src, dst, private=False):
+        subprocess.run(['mount', '--bind', str(src), str(dst)], check=True, capture_output=True)
+        if private:
+            subprocess.run(['mount', '--make-private', str(dst)], check=True, capture_output=True)
+
+    def mount_overlay(self, lower, upper, work, merged):
+        # No redirects or metacopy, so every upper entry holds its full
+        # content under its real name and checkpoints can copy it as is
+        subprocess.run([
+            'mount', '-t', 'overlay', 'overlay',
+            '-o', f'lowerdir={lower},upperdir={upper},workdir={work},redirect_dir=off,metacopy=off',
+            str(merged)
+        ], check=True, capture_output=True)
+
+    def umount(self, path, force=False, check=True):
+        subprocess.run(['umount'] + (['-f'] if force else []) + [str(path)], check=check, capture_output=True)
+
+    def submounts(self, path):
+        result = subprocess.run(['findmnt', '-rn', '-o', 'TARGET', '--submounts', str(path)],
+                                capture_output=True, text=True)
+        return result.stdout.split()
+
+    def mount_table(self):
+        mounts = []
+        with open('/proc/self/mountinfo', 'r') as f:
+            for line in f:
+                # Optional fields come before the -, the filesystem's own after it
+                fields = line.split()
+                separator = fields.index('-')
+                mounts.append({'id': int(fields[0]), 'parent': int(fields[1]), 'dev': fields[2],
+                               'root': unescape_mountinfo(fields[3]), 'target': unescape_mountinfo(fields[4]),
+                               'fstype': fields[separator + 1],
+                               'options': unescape_mountinfo(fields[separator + 3])})
+        return mounts
+
+    @staticmethod
+    def zram_sysfs(device):
+        return Path('/sys/block') / Path(device).name
+
+    def zram_algorithm(self, device):
+        # comp_algorithm lists them all, the one in use is in brackets
+        algorithms = (self.zram_sysfs(device) / 'comp_algorithm').read_text()
+        return algorithms[algorithms.find('[') + 1:algorithms.find(']')]
+
+    def create_zram(self, size, algorithm, mem_limit=0):
+        with open('/sys/class/zram-control/hot_add', 'r') as f:
+            device = f"/dev/zram{int(f.read())}"
+        sysfs = self.zram_sysfs(device)
+        try:
+            # The algorithm can only be changed before the size is set
+            if algorithm:
+                try:
+                    (sysfs / 'comp_algorithm').write_text(algorithm)
+                except OSError:
+                    print(f"Warning: zram doesn't support {algorithm}, using {self.zram_algorithm(device)}",
+                          file=sys.stderr)
+            (sysfs / 'disksize').write_text(str(size))
+            if mem_limit:
+                (sysfs / 'mem_limit').write_text(str(mem_limit))
+            # No journal, it would only cost RAM. No reserved blocks either, nobody else writes here
+            subprocess.run(['mkfs.ext4', '-q', '-m', '0', '-O', '^has_journal', device],
+                           check=True, capture_output=True)
+        except Exception:
+            self.destroy_zram(device)
+            raise
+        return device
+
+    def mount_zram(self, device, path):
+        # discard hands freed blocks back to zram, else deleted files keep using RAM
+        subprocess.run(['mount', '-o', 'discard,noatime', device, str(path)], check=True, capture_output=True)
+
+    def destroy_zram(self, device):
+        sysfs = self.zram_sysfs(device)
+        try:
+            (sysfs / 'reset').write_text('1')
+            Path('/sys/class/zram-control/hot_remove').write_text(sysfs.name[len('zram'):])
+        except OSError as e:
+            print(f"Warning: Could not remove {device}: {e}", file=sys.stderr)
+
+    def zram_stats(self, device):
+        try:
+            fields = (self.zram_sysfs(device) / 'mm_stat').read_text().split()
+            algorithm = self.zram_algorithm(device)
+        except OSError:
+            return None
+        return {'data_size': int(fields[0]), 'compressed_size': int(fields[1]),
+                'mem_used': int(fields[2]), 'algorithm': algorithm}
+
+
+class SimulatedMountBackend(MountBackend):
+    """
+    Pretend mounts for running without root. The ramdisk is a plain directory
+    and binds are only remembered, resolve() says where a path's data really
+    is. Overlays can't be faked this way, so only move pins work
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mounts = {}    # target -> source
+        self.tmpfs = set()
+
+    def is_mountpoint(self, path):
+        with self.lock:
+            return str(path) in self.tmpfs or str(path) in self.mounts
+
+    def mount_tmpfs(self, path, size):
+        with self.lock:
+            self.tmpfs.add(str(path))
+
+    def bind(self, src, dst, private=False):
+        with self.lock:
+            if str(dst) in self.mounts:
+                raise Exception(f"{dst} is already mounted")
+            self.mounts[str(dst)] = str(src)
+
+    def mount_overlay(self, lower, upper, work, merged):
+        raise Exception("Overlay pins need real mounts, the simulated mount backend only does move pins")
+
+    def umount(self, path, force=False, check=True):
+        with self.lock:
+            if self.mounts.pop(str(path), None) is None and check:
+                raise Exception(f"{path} is not mounted")
+
+    def submounts(self, path):
+        prefix = str(path).rstrip('/') + '/'
+        with self.lock:
+            return [target for target in self.mounts if target.startswith(prefix)]
+
+    def mount_table(self):
+        # Nothing outlives the process, so this only ever lists our own mounts
+        with self.lock:
+            return ([{'id': 0, 'parent': 0, 'dev': 'simulated', 'root': '/', 'target': target,
+                      'fstype': 'tmpfs', 'options': ''} for target in self.tmpfs] +
+                    [{'id': 0, 'parent': 0, 'dev': 'simulated', 'root': source, 'target': target,
+                      'fstype': 'bind', 'options': ''} for target, source in self.mounts.items()])
+
+    def shows(self, target, source):
+        return self.resolve(target) == str(source)
+
+    def create_zram(self, size, algorithm, mem_limit=0):
+        # The "zram" is just the plain directory it gets mounted on, nothing gets compressed
+        return 'simulated-zram'
+
+    def mount_zram(self, device, path):
+        self.mount_tmpfs(path, 0)
+
+    def destroy_zram(self, device):
+        pass
+
+    def zram_stats(self, device):
+        return None
+
+    def resolve(self, path):
+        path = str(path)
+        with self.lock:
+            # The deepest mount wins, like in the real mount table
+            for target in sorted(self.mounts, key=len, reverse=True):
+                if path == target or path.startswith(target.rstrip('/') + '/'):
+                    return self.mounts[target] + path[len(target):]
+        return path
+
+
+class CopyEngine:
+    """
+    In-process, multi-threaded replacement for `cp -a` and `rsync -a --delete`.
+
+    Directories are walked by a thread pool. Small files of one directory are
+    copied together in a single task, large files get a task each and are
+    copied by the kernel with copy_file_range/sendfile. Files are written to a
+    temporary name and renamed into place, and mode, owner, xattrs and
+    timestamps are carried over. Files whose size and mtime already match are
+    skipped, like rsync's quick check.
+    """
+
+    SMALL_FILE_SIZE = 256 * 1024
+    CHUNK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, workers=4, idle=False, disk=None):
+        self.workers = max(1, int(workers))
+        self.disk = disk    # a SimulatedDisk to slow every copy down with, for benchmarks
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rampipe-copy',
+                                       initializer=set_idle_io_priority if idle else None)
+
+    def sync_tree(self, src, dst, delete=True, limiter=None):
+        """Make dst a copy of src. Returns {'files': copied, 'bytes': copied, 'skipped': unchanged}"""
+        src, dst = str(src), str(dst)
+        stats = {'files': 0, 'bytes': 0, 'skipped': 0}
+        st = os.lstat(src)
+        if not stat.S_ISDIR(st.st_mode):
+            self.copy_file(src, dst, st, stats, limiter=limiter)
+            return stats
+
+        dirs = []
+        errors = []
+        pending = {self.pool.submit(self.copy_dir, src, dst, delete, dirs, stats, limiter)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    subtasks = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                for task, args in subtasks:
+                    pending.add(self.pool.submit(task, *args))
+
+        # Directory timestamps only settle once everything inside them has been written
+        for dir_src, dir_dst, dir_st in sorted(dirs, key=lambda d: d[1].count(os.sep), reverse=True):
+            try:
+                self.copy_metadata(dir_src, dir_dst, dir_st)
+            except OSError as e:
+                errors.append(e)
+
+        if errors:
+            raise Exception(f"Copy of {src} to {dst} failed: {errors[0]}"
+                            + (f" (and {len(errors) - 1} more errors)" if len(errors) > 1 else ""))
+        return stats
+
+    def apply_entries(self, src_root, dst_root, rels, limiter=None):
+        """Bring just the given relative paths of dst_root in line with src_root"""
+        src_root, dst_root = str(src_root), str(dst_root)
+        stats = {'files': 0, 'bytes': 0, 'skipped': 0}
+        dirs = []
+        files = []
+
+        # Deletions and directories in tree order, so new directories exist before their files
+        for rel in sorted(rels, key=lambda r: r.count(os.sep)):
+            src = os.path.join(src_root, rel) if rel else src_root
+            dst = os.path.join(dst_root, rel) if rel else dst_root
+            try:
+                st = os.lstat(src)
+            except FileNotFoundError:
+                # The journal only says something happened, the source says what is there now
+                if rel:
+                    self.remove(dst)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                self.make_dir(dst)
+                dirs.append((src, dst, st))
+            else:
+                files.append((src, dst, st))
+
+        errors = []
+        futures = [self.pool.submit(self.copy_file, src, dst, st, stats, limiter=limiter)
+                   for src, dst, st in files]
+        for future in futures:
+            try:
+                future.result()
+            except FileNotFoundError:
+                # Deleted again since we looked, the next journal will say so
+                pass
+            except Exception as e:
+                errors.append(e)
+        for src, dst, st in reversed(dirs):
+            self.copy_metadata(src, dst, st)
+
+        if errors:
+            raise Exception(f"Write-back to {dst_root} failed: {errors[0]}")
+        return stats
+
+    def copy_dir(self, src, dst, delete, dirs, stats, limiter=None):
+        """Copy one directory level, returning the follow-up tasks for the pool"""
+        self.make_dir(dst)
+        dirs.append((src, dst, os.lstat(src)))
+
+        entries = {}
+        with os.scandir(src) as it:
+            for entry in it:
+                entries[entry.name] = entry
+
+        if delete:
+            with os.scandir(dst) as it:
+                for entry in it:
+                    if entry.name not in entries:
+                        self.remove(entry.path)
+
+        subtasks = []
+        small = []
+        for name, entry in entries.items():
+            st = entry.stat(follow_symlinks=False)
+            src_path = os.path.join(src, name)
+            dst_path = os.path.join(dst, name)
+            if stat.S_ISDIR(st.st_mode):
+                subtasks.append((self.copy_dir, (src_path, dst_path, delete, dirs, stats, limiter)))
+            elif stat.S_ISREG(st.st_mode) and st.st_size >= self.SMALL_FILE_SIZE:
+                subtasks.append((self.copy_file, (src_path, dst_path, st, stats, (), limiter)))
+            else:
+                small.append((src_path, dst_path, st))
+        if small:
+            subtasks.append((self.copy_batch, (small, stats, limiter)))
+        return subtasks
+
+    def copy_batch(self, batch, stats, limiter=None):
+        for src, dst, st in batch:
+            self.copy_file(src, dst, st, stats, limiter=limiter)
+        return []
+
+    def copy_file(self, src, dst, st=None, stats=None, skip_xattrs=(), limiter=None):
+        """Copy a single non-directory entry (file, symlink, device, fifo)"""
+        if st is None:
+            st = os.lstat(src)
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+
+        if dst_st is not None:
+            if stat.S_ISDIR(dst_st.st_mode):
+                shutil.rmtree(dst)
+                dst_st = None
+            elif (stat.S_ISREG(st.st_mode) and stat.S_ISREG(dst_st.st_mode)
+                  and dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns):
+                if (dst_st.st_mode, dst_st.st_uid, dst_st.st_gid) != (st.st_mode, st.st_uid, st.st_gid):
+                    self.copy_metadata(src, dst, st, skip_xattrs)
+                if stats is not None:
+                    stats['skipped'] += 1
+                return []
+            elif (stat.S_ISLNK(st.st_mode) and stat.S_ISLNK(dst_st.st_mode)
+                  and os.readlink(src) == os.readlink(dst)):
+                if stats is not None:
+                    stats['skipped'] += 1
+                return []
+
+        tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.rampipe~")
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        self.throttle(limiter, 0, ops=1)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), tmp)
+        elif stat.S_ISREG(st.st_mode):
+            self.copy_data(src, tmp, st, limiter)
+        else:
+            os.mknod(tmp, st.st_mode, st.st_rdev)
+        try:
+            self.copy_metadata(src, tmp, st, skip_xattrs)
+            try:
+                os.replace(tmp, dst)
+            except OSError as e:
+                # A bind-mounted file (a pinned single file) can't be replaced, only rewritten
+                if e.errno != errno.EBUSY or not stat.S_ISREG(st.st_mode):
+                    raise
+                shutil.copyfile(tmp, dst)
+                self.copy_metadata(src, dst, st, skip_xattrs)
+                os.remove(tmp)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+        if stats is not None:
+            stats['files'] += 1
+            stats['bytes'] += st.st_size if stat.S_ISREG(st.st_mode) else 0
+        return []
+
+    def copy_data(self, src, dst, st, limiter=None):
+        """Copy file content, letting the kernel move the bytes for anything but small files"""
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            if st.st_size < self.SMALL_FILE_SIZE:
+                self.throttle(limiter, st.st_size)
+                fdst.write(fsrc.read())
+                return
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            copied = 0
+            try:
+                while True:
+                    self.throttle(limiter, max(0, min(self.CHUNK_SIZE, st.st_size - copied)))
+                    chunk = os.copy_file_range(infd, outfd, self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    copied += chunk
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+            # Older kernels can't copy_file_range across filesystems, sendfile can
+            offset = os.lseek(infd, 0, os.SEEK_CUR)
+            while True:
+                self.throttle(limiter, max(0, min(self.CHUNK_SIZE, st.st_size - offset)))
+                sent = os.sendfile(outfd, infd, offset, self.CHUNK_SIZE)
+                if not sent:
+                    break
+                offset += sent
+
+    def copy_blocks(self, src, dst, st, blocks, block_size, limiter=None, skip_xattrs=()):
+        """
+        Copy a big regular file in blocks of block_size. Given the checksums of
+        the blocks dst holds now, only the blocks that differ are written, in
+        place. Without them the whole file goes to a temporary name first, like
+        in copy_file. Returns the checksums of the new blocks and the bytes written
+        """
+        self.throttle(limiter, 0, ops=1)
+        if blocks is None:
+            tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.rampipe~")
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            try:
+                checksums, written = self.write_blocks(src, tmp, [], block_size, limiter, create=True)
+                self.copy_metadata(src, tmp, st, skip_xattrs)
+                try:
+                    os.replace(tmp, dst)
+                    return checksums, written
+                except OSError as e:
+                    # A bind-mounted file (a pinned single file) can't be replaced, only rewritten
+                    if e.errno != errno.EBUSY:
+                        raise
+            finally:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+            blocks = []
+        checksums, written = self.write_blocks(src, dst, blocks, block_size, limiter)
+        self.copy_metadata(src, dst, st, skip_xattrs)
+        return checksums, written
+
+    def write_blocks(self, src, dst, blocks, block_size, limiter=None, create=False):
+        """Write the blocks of src whose checksum isn't the one in blocks into dst, then truncate and fsync it"""
+        checksums = []
+        written = 0
+        run, run_offset = [], 0
+
+        def write_run():
+            # Neighbouring changed blocks go out in one write
+            nonlocal written
+            data = b''.join(run)
+            self.throttle(limiter, len(data))
+            view = memoryview(data)
+            while view:
+                done = os.pwrite(fd, view, run_offset + len(data) - len(view))
+                view = view[done:]
+            written += len(data)
+            run.clear()
+
+        with open(src, 'rb') as fsrc:
+            fd = os.open(dst, os.O_WRONLY | os.O_CLOEXEC | (os.O_CREAT | os.O_TRUNC if create else 0), 0o600)
+            try:
+                offset = 0
+                while True:
+                    data = fsrc.read(block_size)
+                    if not data:
+                        break
+                    checksum = hashlib.blake2b(data, digest_size=16).hexdigest()
+                    if len(checksums) < len(blocks) and blocks[len(checksums)] == checksum:
+                        if run:
+                            write_run()
+                    else:
+                        if not run:
+                            run_offset = offset
+                        run.append(data)
+                        if len(run) * block_size >= self.CHUNK_SIZE:
+                            write_run()
+                    checksums.append(checksum)
+                    offset += len(data)
+                if run:
+                    write_run()
+                os.ftruncate(fd, offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return checksums, written
+
+    def throttle(self, limiter, nbytes, ops=0):
+        if limiter is not None:
+            limiter.consume(nbytes, ops)
+        if self.disk is not None:
+            self.disk.consume(nbytes, ops)
+
+    def copy_metadata(self, src, dst, st, skip_xattrs=()):
+        """Carry owner, mode, xattrs and timestamps over, like rsync -a"""
+        is_link = stat.S_ISLNK(st.st_mode)
+        try:
+            os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+        except PermissionError:
+            pass
+        if not is_link:
+            # After chown, which drops setuid/setgid bits
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        try:
+            for name in os.listxattr(src, follow_symlinks=False):
+                if name.startswith(skip_xattrs):
+                    continue
+                try:
+                    os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False),
+                                follow_symlinks=False)
+                except OSError as e:
+                    if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EACCES):
+                        raise
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM):
+                raise
+        if not is_link or os.utime in os.supports_follow_symlinks:
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    def make_dir(self, dst):
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            os.makedirs(dst)
+            return
+        if not stat.S_ISDIR(dst_st.st_mode):
+            os.remove(dst)
+            os.makedirs(dst)
+
+    def remove(self, path):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+class OverlayCheckpointer:
+    """
+    Applies the delta collected in an overlay's upper dir onto its lower dir
+    while the overlay stays mounted, so a crash only loses what changed since
+    the last checkpoint.
+
+    Whiteouts delete from the lower dir, opaque directories drop whatever the
+    lower dir has that the upper dir doesn't. Every flushed upper entry is
+    remembered with its (mtime, ctime, size, inode), so the next checkpoint
+    only copies entries that changed since. The lower dir must be reached
+    through a private mount, not through the overlay.
+    """
+
+    # Overlay bookkeeping that must never end up on the lower dir
+    OVERLAY_XATTRS = ('trusted.overlay.', 'user.overlay.')
+
+    def __init__(self, copier):
+        self.copier = copier
+
+    @staticmethod
+    def signature(st):
+        return [st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino]
+
+    @staticmethod
+    def is_whiteout(st):
+        return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+    def is_opaque(self, path):
+        for name in ('trusted.overlay.opaque', 'user.overlay.opaque'):
+            try:
+                if os.getxattr(path, name, follow_symlinks=False) in (b'y', b'x'):
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def checkpoint(self, upper_dir, lower_dir, flushed, limiter=None, hold=None, sizes=None, write_file=None):
+        """
+        Flush upper_dir onto lower_dir. flushed maps relative paths to the
+        signature they had when last flushed and is updated in place.
+        hold(rel, st) may postpone a changed file to a later checkpoint.
+        sizes, if given, gets the allocated bytes of everything in upper_dir.
+        write_file(rel, src, dst, st) may write a regular file itself and return
+        the bytes written, or None to leave it to the usual copy.
+        Returns {'files': copied, 'bytes': copied, 'deleted': removed}
+        """
+        upper_dir, lower_dir = str(upper_dir), str(lower_dir)
+        stats = {'files': 0, 'bytes': 0, 'deleted': 0}
+        seen = set()
+        dirs = []
+        if sizes is not None:
+            sizes[''] = SizeIndex.allocated(os.lstat(upper_dir))
+
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            upper = os.path.join(upper_dir, rel_dir) if rel_dir else upper_dir
+            with os.scandir(upper) as it:
+                entries = list(it)
+
+            if rel_dir and flushed.get(rel_dir) != self.signature(os.lstat(upper)) and self.is_opaque(upper):
+                self.drop_hidden({entry.name for entry in entries}, os.path.join(lower_dir, rel_dir), stats)
+
+            for entry in entries:
+                rel = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                st = entry.stat(follow_symlinks=False)
+                seen.add(rel)
+                if sizes is not None:
+                    sizes[rel] = SizeIndex.allocated(st)
+                lower = os.path.join(lower_dir, rel)
+
+                if stat.S_ISDIR(st.st_mode):
+                    self.copier.make_dir(lower)
+                    stack.append(rel)
+                    dirs.append((rel, entry.path, lower, st))
+                    continue
+                self.flush_entry(rel, entry.path, lower, st, flushed, stats, limiter, hold, write_file)
+
+        self.flush_dirs(dirs, flushed)
+
+        # Entries that were only ever in the upper dir leave no whiteout when deleted,
+        # but an earlier checkpoint put them into the lower dir, so they have to go there too
+        for rel in sorted(set(flushed) - seen, key=lambda r: r.count(os.sep), reverse=True):
+            lower = os.path.join(lower_dir, rel)
+            if os.path.lexists(lower):
+                self.copier.remove(lower)
+                stats['deleted'] += 1
+            del flushed[rel]
+        return stats
+
+    def checkpoint_paths(self, upper_dir, lower_dir, flushed, rels, limiter=None, hold=None, write_file=None):
+        """
+        Like checkpoint, but only looks at rels and the directories above them,
+        the paths a journal says changed, instead of walking all of upper_dir
+        """
+        upper_dir, lower_dir = str(upper_dir), str(lower_dir)
+        stats = {'files': 0, 'bytes': 0, 'deleted': 0}
+        todo = set()
+        for rel in rels:
+            while rel and rel not in todo:
+                todo.add(rel)
+                rel = os.path.dirname(rel)
+        dirs = []
+
+        # Parents first, so a new file finds its directory on the lower dir
+        for rel in sorted(todo, key=lambda r: r.count(os.sep)):
+            upper = os.path.join(upper_dir, rel)
+            lower = os.path.join(lower_dir, rel)
+            try:
+                st = os.lstat(upper)
+            except (FileNotFoundError, NotADirectoryError):
+                # Deleted without a whiteout, so it was only ever in the upper dir. If an
+                # earlier checkpoint put it on the lower dir, it has to go there too
+                if rel in flushed:
+                    if os.path.lexists(lower):
+                        self.copier.remove(lower)
+                        stats['deleted'] += 1
+                    prefix = rel + os.sep
+                    for key in [key for key in flushed if key == rel or key.startswith(prefix)]:
+                        del flushed[key]
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                self.copier.make_dir(lower)
+                if flushed.get(rel) != self.signature(st) and self.is_opaque(upper):
+                    self.drop_hidden(set(os.listdir(upper)), lower, stats)
+                dirs.append((rel, upper, lower, st))
+                continue
+            self.flush_entry(rel, upper, lower, st, flushed, stats, limiter, hold, write_file)
+
+        self.flush_dirs(dirs, flushed)
+        return stats
+
+    def drop_hidden(self, names, lower, stats):
+        """An opaque directory hides everything the lower dir has at that spot"""
+        for name in os.listdir(lower):
+            if name not in names:
+                self.copier.remove(os.path.join(lower, name))
+                stats['deleted'] += 1
+
+    def flush_entry(self, rel, upper, lower, st, flushed, stats, limiter, hold, write_file):
+        """Bring one non-directory entry of the upper dir onto the lower dir, if it changed"""
+        sig = self.signature(st)
+        if flushed.get(rel) == sig:
+            return
+        if hold is not None and not self.is_whiteout(st) and hold(rel, st):
+            return
+        if self.is_whiteout(st):
+            if os.path.lexists(lower):
+                self.copier.remove(lower)
+                stats['deleted'] += 1
+        else:
+            written = None
+            if write_file is not None and stat.S_ISREG(st.st_mode):
+                written = write_file(rel, upper, lower, st)
+            if written is None:
+                self.copier.copy_file(upper, lower, st, skip_xattrs=self.OVERLAY_XATTRS, limiter=limiter)
+                written = st.st_size
+            if stat.S_ISREG(st.st_mode):
+                stats['files'] += 1
+                stats['bytes'] += written
+        flushed[rel] = sig
+
+    def flush_dirs(self, dirs, flushed):
+        # Deepest first, so directory timestamps aren't bumped again by their children
+        for rel, upper, lower, st in sorted(dirs, key=lambda d: d[0].count(os.sep), reverse=True):
+            sig = self.signature(st)
+            if flushed.get(rel) != sig:
+                self.copier.copy_metadata(upper, lower, st, self.OVERLAY_XATTRS)
+                flushed[rel] = sig
+
+
+class BlockMap:
+    """
+    Checksums of the fixed-size blocks of the big files of move and overlay
+    pins, as those files are on disk. A write-back hashes the RAM copy block by block
+    and writes only the blocks whose checksum changed, in place, so a
+    database or disk image with a few pages touched costs a few pages of disk
+    writes instead of the whole file.
+
+    Each file remembers the size, mtime and ctime its disk copy had when the
+    checksums were taken. If the disk copy changed since then, the checksums
+    are worthless and the file is written whole again. The maps are kept in
+    one JSON file per pin, so they survive a restart of the daemon
+    """
+
+    def __init__(self, directory, copier, block_size, min_size):
+        self.directory = Path(directory)
+        self.copier = copier
+        self.block_size = max(4096, block_size)
+        self.min_size = min_size        # smaller files are copied whole, 0 turns this off
+        self.lock = threading.Lock()
+        self.pins = {}                  # pin -> {relative path: {'disk': signature, 'blocks': [checksum]}}
+
+    @staticmethod
+    def signature(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+    def wants(self, st):
+        """Whether a file is big enough to be written back block by block"""
+        return bool(self.min_size) and stat.S_ISREG(st.st_mode) and st.st_size >= self.min_size
+
+    def map_file(self, pin):
+        return self.directory / f"{hashlib.sha1(pin.encode('utf-8')).hexdigest()}.json"
+
+    def files(self, pin):
+        """The map of one pin, read on first use"""
+        with self.lock:
+            if pin not in self.pins:
+                try:
+                    with open(self.map_file(pin), 'r') as f:
+                        self.pins[pin] = json.load(f)
+                except FileNotFoundError:
+                    self.pins[pin] = {}
+                except ValueError as e:
+                    print(f"Warning: Block map of {pin} is broken, its big files get written whole: {e}",
+                          file=sys.stderr)
+                    self.pins[pin] = {}
+            return self.pins[pin]
+
+    def save(self, pin):
+        files = self.files(pin)
+        path = self.map_file(pin)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(path.with_name(path.name + '.tmp'), 'w') as f:
+            json.dump(files, f)
+        os.replace(path.with_name(path.name + '.tmp'), path)
+
+    def drop(self, pin):
+        with self.lock:
+            self.pins.pop(pin, None)
+        self.map_file(pin).unlink(missing_ok=True)
+
+    def checksums(self, path):
+        checksums = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(self.block_size)
+                if not data:
+                    return checksums
+                checksums.append(hashlib.blake2b(data, digest_size=16).hexdigest())
+
+    def build(self, pin, ram_root, disk_root, rels=None):
+        """
+        Take the checksums of the big files of a pin that was just copied into
+        RAM, before anyone could write to the copy. Files whose disk copy doesn't
+        have the size and mtime of the RAM copy are left out
+        """
+        if not self.min_size:
+            return
+        ram_root, disk_root = str(ram_root), str(disk_root)
+        if rels is None:
+            rels = ['']
+            if os.path.isdir(ram_root):
+                rels = [os.path.relpath(os.path.join(dirpath, name), ram_root)
+                        for dirpath, dirnames, filenames in os.walk(ram_root) for name in filenames]
+
+        def take(rel):
+            ram = os.path.join(ram_root, rel) if rel else ram_root
+            try:
+                ram_st = os.lstat(ram)
+                if not self.wants(ram_st):
+                    return None
+                disk_st = os.lstat(os.path.join(disk_root, rel) if rel else disk_root)
+                if (disk_st.st_size, disk_st.st_mtime_ns) != (ram_st.st_size, ram_st.st_mtime_ns):
+                    return None
+                return rel, {'disk': self.signature(disk_st), 'blocks': self.checksums(ram)}
+            except OSError:
+                return None
+
+        files = self.files(pin)
+        for result in self.copier.pool.map(take, rels):
+            if result is not None:
+                files[result[0]] = result[1]
+        if files:
+            self.save(pin)
+
+    def lookup(self, pin, rel, disk_st):
+        """The checksums of what the disk copy holds, None if it changed behind our back"""
+        entry = self.files(pin).get(rel)
+        if entry is None or entry['disk'] != self.signature(disk_st):
+            return None
+        return entry['blocks']
+
+    def record(self, pin, rel, disk_st, checksums):
+        self.files(pin)[rel] = {'disk': self.signature(disk_st), 'blocks': checksums}
+
+
+class ContentStore:
+    """
+    Keeps every distinct file once in RAM, for dedup pins.
+
+    Files are hashed while they are copied in, and a file whose content,
+    mode, owner, mtime and xattrs all match an object already in the store
+    becomes a hard link to it instead of a second copy. A pin's linked tree
+    is only ever used as the lower dir of an overlay, so the first write to a
+    file copies it up into the pin's upper dir, which breaks the link, and
+    the store itself is never written through
+    """
+
+    def __init__(self, root, copier):
+        self.root = Path(root)
+        self.copier = copier
+        self.lock = threading.Lock()    # held while linking to or collecting objects
+        self.pins = {}                  # pin -> {inode: [links in the pin, allocated bytes]}
+        self.refs = {}                  # inode -> links from all pins
+        # Left over from copies that were interrupted
+        shutil.rmtree(self.root / 'tmp', ignore_errors=True)
+        (self.root / 'tmp').mkdir(parents=True, exist_ok=True)
+        (self.root / 'objects').mkdir(exist_ok=True)
+
+    def link_tree(self, src, dst):
+        """
+        Build dst as a copy of the directory src made of links into the store.
+        Returns {'files': files, 'bytes': bytes read, 'deduped': bytes that were in the store already}
+        """
+        src, dst = str(src), str(dst)
+        stats = {'files': 0, 'bytes': 0, 'deduped': 0}
+        dirs = []
+        futures = []
+        for dirpath, dirnames, filenames in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(dirpath, src))
+            self.copier.make_dir(target)
+            dirs.append((dirpath, target, os.lstat(dirpath)))
+            for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                st = os.lstat(os.path.join(dirpath, name))
+                if stat.S_ISREG(st.st_mode):
+                    futures.append(self.copier.pool.submit(self.add_file, os.path.join(dirpath, name),
+                                                           os.path.join(target, name), st, stats))
+                else:
+                    self.copier.copy_file(os.path.join(dirpath, name), os.path.join(target, name), st)
+
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        for dir_src, dir_dst, dir_st in reversed(dirs):
+            self.copier.copy_metadata(dir_src, dir_dst, dir_st)
+        if errors:
+            raise Exception(f"Dedup copy of {src} failed: {errors[0]}")
+        return stats
+
+    def add_file(self, src, dst, st, stats):
+        """Copy one file into the store (unless it is there already) and link dst to it"""
+        # Everything a hard link shares goes into the name, not just the content
+        digest = hashlib.sha256(f"{st.st_mode}:{st.st_uid}:{st.st_gid}:{st.st_mtime_ns}".encode())
+        try:
+            for name in sorted(os.listxattr(src, follow_symlinks=False)):
+                digest.update(name.encode() + b'=' + os.getxattr(src, name, follow_symlinks=False) + b';')
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM):
+                raise
+        digest.update(b'\0')
+
+        fd, tmp = tempfile.mkstemp(dir=self.root / 'tmp')
+        try:
+            self.copier.throttle(None, 0, ops=1)
+            with open(src, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+                while True:
+                    chunk = fsrc.read(self.copier.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.copier.throttle(None, len(chunk))
+                    digest.update(chunk)
+                    fdst.write(chunk)
+            name = digest.hexdigest()
+            obj = self.root / 'objects' / name[:2] / name
+            with self.lock:
+                if obj.exists():
+                    stats['deduped'] += st.st_size
+                else:
+                    self.copier.copy_metadata(src, tmp, st)
+                    obj.parent.mkdir(exist_ok=True)
+                    os.rename(tmp, obj)
+                os.link(obj, dst)
+                stats['files'] += 1
+                stats['bytes'] += st.st_size
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+    def index(self, pin, tree):
+        """Count which objects a pin's tree links to"""
+        links = {}
+        for dirpath, dirnames, filenames in os.walk(tree):
+            for name in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    links.setdefault(st.st_ino, [0, SizeIndex.allocated(st)])[0] += 1
+        with self.lock:
+            self.unindex(pin)
+            self.pins[pin] = links
+            for ino, (count, size) in links.items():
+                self.refs[ino] = self.refs.get(ino, 0) + count
+
+    def unindex(self, pin):
+        """Caller holds the lock"""
+        for ino, (count, size) in self.pins.pop(pin, {}).items():
+            self.refs[ino] -= count
+            if not self.refs[ino]:
+                del self.refs[ino]
+
+    def usage(self, pin):
+        """
+        (bytes the pin's files would take as copies, bytes it takes here).
+        An object shared by several pins is split between them evenly
+        """
+        logical = share = 0
+        with self.lock:
+            for ino, (count, size) in self.pins.get(pin, {}).items():
+                logical += count * size
+                share += count * size / self.refs[ino]
+        return logical, int(share)
+
+    def release(self, pin, tree):
+        """Remove a pin's tree and whatever objects nothing links to any more"""
+        with self.lock:
+            self.unindex(pin)
+        shutil.rmtree(tree, ignore_errors=True)
+        with self.lock:
+            for dirpath, dirnames, filenames in os.walk(self.root / 'objects'):
+                for name in filenames:
+                    obj = os.path.join(dirpath, name)
+                    try:
+                        if os.lstat(obj).st_nlink == 1:
+                            os.remove(obj)
+                    except OSError:
+                        pass
+
+
+class PageLocker:
+    """
+    Keeps files resident in the page cache for lock pins, by mapping them
+    and mlocking the mappings. Nothing is copied and nothing is mounted, so
+    there is nothing to write back either, the kernel just can't drop the
+    pages any more. The locks belong to this process and go away with it
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pins = {}      # pin -> {file: (signature, address, length)}
+
+    @staticmethod
+    def signature(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def pages(size):
+        """What locking size bytes really takes, whole pages"""
+        return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    def scan(self, root, filters=None):
+        """The files under root that would be locked, as {path: stat}"""
+        root = str(root)
+        st = os.stat(root)
+        if not stat.S_ISDIR(st.st_mode):
+            return {root: st} if stat.S_ISREG(st.st_mode) and st.st_size else {}
+        # Empty files have nothing to lock, and mmap won't take them
+        return {os.path.join(root, rel): st for rel, st in filtered_files(root, filters).items() if st.st_size}
+
+    def lock_files(self, pin, files):
+        """
+        Make the locks of a pin match files (from scan): lock new files, re-lock
+        the ones that changed, unlock the ones that are gone. Returns {'files', 'bytes'} newly locked
+        """
+        stats = {'files': 0, 'bytes': 0}
+        with self.lock:
+            locked = self.pins.setdefault(pin, {})
+            for path in list(locked):
+                if path not in files or locked[path][0] != self.signature(files[path]):
+                    self.unlock(*locked.pop(path)[1:])
+        for path, st in files.items():
+            if path in locked:
+                continue
+            try:
+                address, length = self.lock_file(path)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                locked[path] = (self.signature(st), address, length)
+            stats['files'] += 1
+            stats['bytes'] += length
+        return stats
+
+    def lock_file(self, path):
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        try:
+            length = os.fstat(fd).st_size
+            address = _libc.mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        finally:
+            # The mapping keeps the file open
+            os.close(fd)
+        if address in (None, MAP_FAILED):
+            err = ctypes.get_errno()
+            raise OSError(err, f"Could not map {path}: {os.strerror(err)}")
+        # Reads every page in and keeps it there
+        if _libc.mlock(address, length) != 0:
+            err = ctypes.get_errno()
+            _libc.munmap(address, length)
+            raise OSError(err, f"Could not lock {path}: {os.strerror(err)}")
+        return address, length
+
+    @staticmethod
+    def unlock(address, length):
+        _libc.munlock(address, length)
+        _libc.munmap(address, length)
+
+    def release(self, pin):
+        with self.lock:
+            for signature, address, length in self.pins.pop(pin, {}).values():
+                self.unlock(address, length)
+
+    def locked_bytes(self, pin=None):
+        """What a pin (or all of them) keeps locked"""
+        with self.lock:
+            pins = [self.pins.get(pin, {})] if pin is not None else list(self.pins.values())
+            return sum(self.pages(length) for locked in pins for signature, address, length in locked.values())
+
+
+class ReadaheadTrace:
+    """
+    Boot-time readahead. record() notes which parts of which files are in the
+    page cache (mincore) at the end of a window after boot. replay() reads
+    them in again on the next boot, ordered by where they are on the disk
+    (FIEMAP), so the disk gets mostly sequential reads instead of the random
+    ones the pins and programs would cause otherwise
+    """
+
+    # Pieces handed to one worker at a time, the workers go through them in disk order
+    BATCH_SIZE = 8 * 1024 * 1024
+    EXTENTS_PER_CALL = 256
+
+    def __init__(self, workers=4):
+        self.workers = max(1, int(workers))
+        self.resident_table = bytes(i & 1 for i in range(256))
+
+    def resident(self, path):
+        """The [offset, length] ranges of a file that are in the page cache"""
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            size = os.fstat(fd).st_size
+            if not size:
+                return []
+            address = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        finally:
+            os.close(fd)
+        if address in (None, MAP_FAILED):
+            return []
+        try:
+            pages = -(-size // mmap.PAGESIZE)
+            vec = (ctypes.c_ubyte * pages)()
+            if _libc.mincore(address, size, vec) != 0:
+                return []
+            # Only the lowest bit of each byte means something
+            resident = bytes(vec).translate(self.resident_table)
+        finally:
+            _libc.munmap(address, size)
+        return [[match.start() * mmap.PAGESIZE,
+                 min(match.end() * mmap.PAGESIZE, size) - match.start() * mmap.PAGESIZE]
+                for match in re.finditer(b'\x01+', resident)]
+
+    def record(self, files):
+        """Build a trace from what of files (path -> path to look at it through) is cached now"""
+        trace = {}
+        for path, source in files.items():
+            try:
+                ranges = self.resident(source)
+                st = os.stat(source)
+            except OSError:
+                continue
+            if ranges:
+                trace[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ranges': ranges}
+        return {'recorded_at': time.time(), 'files': trace}
+
+    def extents(self, fd):
+        """(logical, physical, length) of every extent of an open file, empty if FIEMAP isn't supported"""
+        extents = []
+        start = 0
+        while True:
+            buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size * self.EXTENTS_PER_CALL)
+            FIEMAP_HEADER.pack_into(buf, 0, start, 2 ** 64 - 1 - start, 0, 0, self.EXTENTS_PER_CALL, 0)
+            try:
+                fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+            except OSError:
+                return []
+            mapped = FIEMAP_HEADER.unpack_from(buf, 0)[3]
+            if not mapped:
+                return extents
+            for i in range(mapped):
+                logical, physical, length, flags = FIEMAP_EXTENT.unpack_from(
+                    buf, FIEMAP_HEADER.size + i * FIEMAP_EXTENT.size)
+                extents.append((logical, physical, length))
+                if flags & FIEMAP_EXTENT_LAST:
+                    return extents
+            start = logical + length
+
+    def plan(self, trace):
+        """The pieces to read as (device, physical offset, path, offset, length), in disk order"""
+        pieces = []
+        for path, entry in trace['files'].items():
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+            try:
+                st = os.fstat(fd)
+                extents = self.extents(fd)
+            finally:
+                os.close(fd)
+            for offset, length in entry['ranges']:
+                # The file may have shrunk since
+                length = min(length, st.st_size - offset)
+                if length <= 0:
+                    continue
+                if not extents:
+                    # No FIEMAP here, keep the files roughly in inode order at the end
+                    pieces.append((st.st_dev, 2 ** 64 + st.st_ino, path, offset, length))
+                    continue
+                # A range spanning several extents is read in one piece per extent
+                for logical, physical, extent_length in extents:
+                    lo = max(offset, logical)
+                    hi = min(offset + length, logical + extent_length)
+                    if lo < hi:
+                        pieces.append((st.st_dev, physical + lo - logical, path, lo, hi - lo))
+        pieces.sort()
+        return pieces
+
+    def replay(self, trace):
+        """Read the trace in with posix_fadvise(WILLNEED). Returns {'files', 'bytes', 'seconds'}"""
+        started = time.monotonic()
+        pieces = self.plan(trace)
+        batches = [[]]
+        batch_bytes = 0
+        for piece in pieces:
+            if batch_bytes >= self.BATCH_SIZE:
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append(piece)
+            batch_bytes += piece[4]
+        # Batches are taken in disk order, so the workers' requests stay close to each other
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rampipe-readahead') as pool:
+            list(pool.map(self.read_batch, batches))
+        return {'files': len({piece[2] for piece in pieces}), 'bytes': sum(piece[4] for piece in pieces),
+                'seconds': time.monotonic() - started}
+
+    @staticmethod
+    def read_batch(batch):
+        fds = {}
+        try:
+            for device, physical, path, offset, length in batch:
+                try:
+                    if path not in fds:
+                        fds[path] = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+                    os.posix_fadvise(fds[path], offset, length, os.POSIX_FADV_WILLNEED)
+                except OSError:
+                    continue
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+
+class AccessProfiler:
+    """
+    Samples which files processes do I/O on and ranks files and directories by it.
+
+    Every interval it reads /proc/<pid>/io for the read/write syscalls and the
+    bytes that actually hit a block device, and /proc/<pid>/fd plus fdinfo to
+    see which files each process has open and how far their offsets moved.
+    A process' I/O is attributed to its open files in proportion to those
+    offset moves (evenly if none moved). Only files on real block devices are
+    counted, plus files below `extra_roots`, which lets pinned paths (now on
+    tmpfs) keep showing up with the traffic they absorb.
+    """
+
+    # Weight of one read/write call against bytes when ranking, random I/O on slow disks is costly
+    OP_COST = 4096
+
+    def __init__(self, extra_roots=(), exclude_roots=()):
+        self.extra_roots = tuple(str(root).rstrip('/') + '/' for root in extra_roots)
+        self.exclude_roots = tuple(str(root).rstrip('/') + '/' for root in exclude_roots)
+        self.dev_cache = {}
+        # Our own copying would otherwise rank the pins we just made
+        self.own_pid = str(os.getpid())
+
+    def wanted(self, path):
+        if not path.startswith('/') or path.startswith(self.exclude_roots):
+            return False
+        if path.startswith(self.extra_roots) or (path + '/') in self.extra_roots:
+            return True
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        # Major 0 are virtual filesystems: tmpfs, proc, overlay and so on
+        return stat.S_ISREG(st.st_mode) and os.major(st.st_dev) != 0
+
+    @staticmethod
+    def read_io(pid):
+        counters = {}
+        with open(f'/proc/{pid}/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                counters[key] = int(value)
+        return counters
+
+    def sample(self):
+        """One snapshot: {pid: (io counters, {fd: (path, pos, write mode)})}"""
+        snapshot = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit() or pid == self.own_pid:
+                continue
+            try:
+                counters = self.read_io(pid)
+                fd_names = os.listdir(f'/proc/{pid}/fd')
+            except (OSError, ValueError):
+                # Processes come and go, and some we aren't allowed to look at
+                continue
+            fds = {}
+            for fd in fd_names:
+                try:
+                    target = os.readlink(f'/proc/{pid}/fd/{fd}')
+                    if target not in self.dev_cache:
+                        self.dev_cache[target] = self.wanted(target)
+                    if not self.dev_cache[target]:
+                        continue
+                    pos, flags = 0, 0
+                    with open(f'/proc/{pid}/fdinfo/{fd}', 'r') as f:
+                        for line in f:
+                            if line.startswith('pos:'):
+                                pos = int(line.split()[1])
+                            elif line.startswith('flags:'):
+                                flags = int(line.split()[1], 8)
+                    fds[fd] = (target, pos, flags & os.O_ACCMODE)
+                except (OSError, ValueError):
+                    # Closed while we were looking
+                    continue
+            snapshot[pid] = (counters, fds)
+        return snapshot
+
+    def run(self, duration, interval=1.0, job=None):
+        """Sample for duration seconds, returns {path: {'bytes', 'write_bytes', 'disk_bytes', 'ops'}}"""
+        files = {}
+        previous = self.sample()
+        end = time.time() + duration
+        while time.time() < end and not (job and job.cancelled):
+            time.sleep(min(interval, max(0, end - time.time())))
+            current = self.sample()
+            for pid, (counters, fds) in current.items():
+                if pid not in previous or not fds:
+                    continue
+                old_counters, old_fds = previous[pid]
+                delta = {key: max(0, counters.get(key, 0) - old_counters.get(key, 0)) for key in counters}
+                ops = delta.get('syscr', 0) + delta.get('syscw', 0)
+                disk_bytes = delta.get('read_bytes', 0) + delta.get('write_bytes', 0)
+                logical = delta.get('rchar', 0) + delta.get('wchar', 0)
+                write_share = delta.get('wchar', 0) / logical if logical else 0
+
+                moved = {}
+                for fd, (path, pos, mode) in fds.items():
+                    old = old_fds.get(fd)
+                    moved[fd] = abs(pos - old[1]) if old and old[0] == path else 0
+                total_moved = sum(moved.values())
+
+                for fd, (path, pos, mode) in fds.items():
+                    share = moved[fd] / total_moved if total_moved else 1 / len(fds)
+                    if not share:
+                        continue
+                    entry = files.setdefault(path, {'bytes': 0, 'write_bytes': 0, 'disk_bytes': 0, 'ops': 0})
+                    entry['bytes'] += moved[fd]
+                    if mode == os.O_WRONLY:
+                        entry['write_bytes'] += moved[fd]
+                    elif mode == os.O_RDWR:
+                        entry['write_bytes'] += int(moved[fd] * write_share)
+                    entry['disk_bytes'] += int(disk_bytes * share)
+                    entry['ops'] += ops * share
+            previous = current
+            if job is not None:
+                job.files_done += 1
+        return files
+
+    def score(self, entry):
+        return entry['bytes'] + entry['disk_bytes'] + entry['ops'] * self.OP_COST
+
+    def rank(self, files, min_depth=2):
+        """Rank files and the directories containing them, busiest first"""
+        ranked = {}
+        for path, entry in files.items():
+            parts = Path(path).parts
+            # The file itself, then every directory above it that is deep enough to pin.
+            # parts[0] is '/', so /home/user has depth 2 but three parts
+            for depth in range(len(parts), min_depth + 1, -1):
+                target = str(Path(*parts[:depth]))
+                total = ranked.setdefault(target, {'bytes': 0, 'write_bytes': 0, 'disk_bytes': 0, 'ops': 0,
+                                                   'is_dir': depth != len(parts)})
+                for key in ('bytes', 'write_bytes', 'disk_bytes', 'ops'):
+                    total[key] += entry[key]
+        for entry in ranked.values():
+            entry['ops'] = int(entry['ops'])
+            entry['score'] = self.score(entry)
+        return sorted(ranked.items(), key=lambda item: item[1]['score'], reverse=True)
+
+
+class Job:
+    """A background task the CLI can poll, e.g. filling RAM for a lazy pin"""
+
+    def __init__(self, job_id, kind, path):
+        self.job_id = job_id
+        self.kind = kind
+        self.path = path
+        self.state = 'running'
+        self.error = None
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = False
+        self.thread = None
+        self.deadline = None
+        self.result = None
+        self.summary = None
+
+    def finish(self, error=None):
+        self.finished = time.time()
+        if error is not None:
+            self.state = 'failed'
+            self.error = str(error)
+        elif self.cancelled:
+            self.state = 'cancelled'
+        else:
+            self.state = 'done'
+
+    def to_dict(self):
+        elapsed = (self.finished or time.time()) - self.started
+        rate = self.bytes_done / elapsed if elapsed > 0 else 0
+        eta = None
+        if self.state == 'running' and self.deadline is not None:
+            eta = max(0, self.deadline - time.time())
+        elif self.state == 'running' and rate > 0:
+            eta = (self.bytes_total - self.bytes_done) / rate
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'path': self.path,
+            'state': self.state,
+            'error': self.error,
+            'bytes_total': self.bytes_total,
+            'bytes_done': self.bytes_done,
+            'files_total': self.files_total,
+            'files_done': self.files_done,
+            'files_remaining': self.files_total - self.files_done,
+            'elapsed': elapsed,
+            'eta': eta,
+            'summary': self.summary
+        }
+
+
 class RamPipeDaemon:
     def __init__(self, config_path="/etc/rampipe.conf"):
+        self.started = time.monotonic()
         self.config = self.load_config(config_path)
         self.state_file = Path(self.config.get('state_file', '/mnt/rampipe/state.json'))
         self.pinned_items = {}
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()     # the registry: pinned_items and the lock tables, held briefly
+        self.pin_locks = {}              # pin path -> lock held while a pin is set up, synced or torn down
+        self.device_locks = {}           # st_dev -> lock, so one disk only ever gets one sync at a time
+        self.checkpoint_locks = {}       # pin path -> lock over the checkpoint bookkeeping of an overlay
         self.running = True
-        self.socket_path = "/run/rampipe.sock"
+        self.socket_path = self.config.get('socket_path', '/run/rampipe.sock')
+        disk = None
+        if self.config.get('mount_backend', 'system') == 'simulated':
+            self.mounts = SimulatedMountBackend()
+            disk = SimulatedDisk(float(self.config.get('sim_disk_latency', 0)),
+                                 parse_size(self.config.get('sim_disk_bandwidth', 0)))
+        else:
+            self.mounts = SystemMountBackend()
+            if os.geteuid() != 0:
+                raise Exception("RamPipe daemon must be run as root (or with mount_backend = simulated)")
+        self.tracker = DirtyTracker()
+        self.copier = CopyEngine(self.config.get('copy_workers', 4), disk=disk)
+        self.checkpointer = OverlayCheckpointer(self.copier)
+        # Background write-back gets its own threads, in the idle I/O class if configured
+        self.writeback_copier = CopyEngine(self.config.get('copy_workers', 4),
+                                           idle=self.config_flag('writeback_idle_priority', 'yes'), disk=disk)
+        self.writeback_checkpointer = OverlayCheckpointer(self.writeback_copier)
+        self.block_map = BlockMap(self.state_file.with_name('blockmaps'), self.copier,
+                                  parse_size(self.config.get('writeback_block_size', '64K')),
+                                  parse_size(self.config.get('writeback_delta_min_size', '16M')))
+        self.limiters = {}
+        self.writeback_cancelled = False
+        self.background_sync_lock = threading.Lock()
+        self.overlay_dirty_since = {}
+        self.sizes = SizeIndex()
+        self.metrics = Metrics()
+        self.request_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='rampipe-request')
+        self.connections = set()        # tasks serving a client, cancelled when we stop
+        self.tracker.on_change = self.note_change
+        self.overlay_flushed = {}
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.next_job_id = 1
+        self.last_access = {}
+        self.evicted = []
+        self.orphans = []                # data in RAM that belongs to no pin, found at start
+        self.critical_ready = threading.Event()
+        self.zram_device = None
+        self.zram_lock = threading.Lock()
+        self.stores = {}                 # tier -> ContentStore of its dedup pins
+        self.locker = PageLocker()
+        self.manifest_done = threading.Event()
+        self.readahead = ReadaheadTrace(self.config.get('readahead_workers', 4))
+        self.readahead_stats = None
+        self.warm_seconds = None
+        self.tracker.start()
         self.setup_tmpfs()
+        self.load_zram()
         self.load_state()
+        self.load_evicted()
+        replay = self.start_readahead_replay()
+        self.apply_manifest()
+        threading.Thread(target=self.wait_for_warm, args=(replay,), daemon=True).start()
         
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self.signal_handler)
@@ -40,6 +2252,49 @@ class RamPipeDaemon:
             'tmpfs_size': '1G',
             'sync_interval': 300,
             'overlay_base': '/dev/shm/overlays',
+            'disk_view_base': '/run/rampipe/disk',
+            'copy_workers': 4,
+            'lazy_hot_window': 86400,
+            'profile_duration': 60,
+            'profile_sample_interval': 1,
+            'autopin': 'no',
+            'autopin_budget': '256M',
+            'autopin_top_n': 5,
+            'autopin_interval': 3600,
+            'autopin_min_depth': 2,
+            'budget_high_watermark': 90,
+            'budget_low_watermark': 75,
+            'budget_psi_high': 10,
+            'budget_psi_low': 2,
+            'budget_check_interval': 10,
+            'budget_repin_delay': 300,
+            'never_evict': '',
+            'writeback_dirty_bytes': '64M',
+            'writeback_check_interval': 5,
+            'writeback_coalesce_window': 10,
+            'writeback_max_bandwidth': 0,
+            'writeback_max_iops': 0,
+            'writeback_idle_priority': 'yes',
+            'writeback_delta_min_size': '16M',
+            'writeback_block_size': '64K',
+            'manifest_file': '/etc/rampipe.manifest',
+            'manifest_concurrency': 4,
+            'metrics_listen': '',
+            'shutdown_timeout': 'auto',
+            'shutdown_margin': 5,
+            'shutdown_extend': 0,
+            'readahead': 'no',
+            'readahead_trace': '/var/lib/rampipe/readahead.json',
+            'readahead_window': 120,
+            'readahead_workers': 4,
+            'zram_path': '/mnt/rampipe-zram',
+            'zram_size': '2G',
+            'zram_mem_limit': '0',
+            'zram_algorithm': 'zstd',
+            'socket_path': '/run/rampipe.sock',
+            'mount_backend': 'system',
+            'sim_disk_latency': 0,
+            'sim_disk_bandwidth': 0,
             'state_file': '/mnt/rampipe/state.json'
         }
         
@@ -53,6 +2308,8 @@ class RamPipeDaemon:
                                 key, value = line.split('=', 1)
                                 key = key.strip()
                                 value = value.strip()
+                                if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+                                    value = value[1:-1]
                                 # Convert numeric values
                                 if value.isdigit():
                                     value = int(value)
@@ -64,6 +2321,10 @@ class RamPipeDaemon:
             
         return config
 
+    def config_flag(self, key, default='no'):
+        """Read a yes/no option"""
+        return str(self.config.get(key, default)).strip('"').lower() in ('1', 'yes', 'true', 'on')
+
     def setup_tmpfs(self):
         """Setup tmpfs mount for ramdisk"""
         ramdisk_path = self.config.get('ramdisk_path', '/mnt/rampipe')
@@ -71,18 +2332,16 @@ class RamPipeDaemon:
         Path(ramdisk_path).mkdir(parents=True, exist_ok=True)
         
         # Check if already mounted
-        result = subprocess.run(['mountpoint', '-q', ramdisk_path])
-        if result.returncode != 0:
+        if not self.mounts.is_mountpoint(ramdisk_path):
             try:
-                subprocess.run(['mount', '-t', 'tmpfs', '-o', f'size={tmpfs_size}', 'tmpfs', ramdisk_path], 
-                             check=True, capture_output=True)
+                self.mounts.mount_tmpfs(ramdisk_path, tmpfs_size)
                 print(f"Mounted tmpfs at {ramdisk_path}")
             except subprocess.CalledProcessError as e:
                 print(f"Error mounting tmpfs: {e}", file=sys.stderr)
                 raise
 
     def load_state(self):
-        """Load state from JSON file"""
+        """Load state from JSON file, and check it against what is really mounted"""
         with self.lock:
             if self.state_file.exists():
                 try:
@@ -92,6 +2351,595 @@ class RamPipeDaemon:
                     print(f"Warning: Could not load state: {e}", file=sys.stderr)
                     self.pinned_items = {}
 
+        try:
+            self.reconcile_pins()
+        except Exception as e:
+            print(f"Warning: Could not check the pins against the mount table: {e}", file=sys.stderr)
+
+        with self.lock:
+            # We don't know what changed while nobody was watching, so start with a full sync
+            for path, item in self.pinned_items.items():
+                if item['type'] == 'move' and Path(item['temp_path']).exists():
+                    self.tracker.watch(path, item['temp_path'], full=True)
+                elif item['type'] == 'overlay' and Path(item['upper_dir']).exists():
+                    self.tracker.watch(path, item['upper_dir'], full=True)
+
+        # Index what is in RAM already without holding up the start
+        threading.Thread(target=self.index_pins, daemon=True).start()
+
+        # Lazy pins that were still filling RAM pick up where they left off
+        for path, item in list(self.pinned_items.items()):
+            if item.get('lazy') and not item.get('populated'):
+                self.start_populate(path)
+
+    def reconcile_pins(self):
+        """
+        Check the pins of the state file against the mount table, so a restarted
+        daemon picks up where the last one left off without copying anything.
+        Pins whose mounts are all there are kept as they are. Pins whose mounts
+        are gone are dropped, and their data in RAM is reported as orphaned, not
+        deleted: it may hold changes that never made it to disk. Mounts of our
+        RAM copies that the state file doesn't know about become pins again
+        """
+        table = self.mounts.mount_table()
+        # Where several mounts are stacked on one target, the last one is what shows
+        targets = {mount['target']: mount for mount in table}
+        notes = {}
+        changed = False
+
+        for path, item in list(self.pinned_items.items()):
+            problem = self.pin_mount_problem(path, item, targets)
+            if problem is not None:
+                print(f"Warning: Dropping the pin of {path}, {problem}", file=sys.stderr)
+                self.drop_stale_pin(path, item, targets)
+                for ram_path in (item.get('temp_path'), item.get('upper_dir')):
+                    if ram_path:
+                        notes[ram_path] = f"was pinned at {path}, {problem}"
+                changed = True
+            elif 'disk_path' in item and item['disk_path'] not in targets:
+                # Still works, but periodic syncs have no way to the disk copy now. Unpin
+                # uncovers the original first, so it can write back there
+                print(f"Warning: The view of the disk copy of {path} is gone, it only gets written "
+                      f"back on unpin", file=sys.stderr)
+                disk_path = item.pop('disk_path')
+                if os.path.lexists(disk_path):
+                    self.release_disk_view(disk_path)
+                changed = True
+
+        adopted = self.adopt_lost_pins(table, targets)
+        self.remove_leftover_mounts()
+        if changed or adopted:
+            self.save_state()
+        self.orphans = self.find_orphans(notes)
+        for orphan in self.orphans:
+            print(f"Warning: {orphan['path']} is in RAM but belongs to no pin"
+                  + (f" ({orphan['note']})" if orphan['note'] else ""), file=sys.stderr)
+        if self.pinned_items:
+            print(f"Picked up {len(self.pinned_items)} pins that are still in place")
+
+    def pin_mount_problem(self, path, item, targets):
+        """Why a pin from the state file isn't mounted the way it should be, None if it is"""
+        if item['type'] == 'lock':
+            # Nothing mounted, index_pins takes the locks again
+            return None
+        if item['type'] == 'move':
+            if not os.path.lexists(item['temp_path']):
+                return "its copy in RAM is gone"
+            source = item['temp_path']
+        else:
+            if not os.path.isdir(item['upper_dir']):
+                return "its upper dir in RAM is gone"
+            if not self.is_our_overlay(targets.get(item['merged_dir']), item['upper_dir']):
+                return f"its overlay isn't mounted at {item['merged_dir']} any more"
+            source = item['merged_dir']
+        if path not in targets or not self.mounts.shows(path, source):
+            return f"{source} isn't mounted over {path} any more"
+        return None
+
+    @staticmethod
+    def is_our_overlay(mount, upper_dir):
+        return (mount is not None and mount['fstype'] == 'overlay'
+                and f"upperdir={upper_dir}," in mount['options'] + ',')
+
+    def drop_stale_pin(self, path, item, targets):
+        """Take down the mounts left of a pin that is dropped. Its data in RAM stays where it is"""
+        source = item.get('temp_path') or item.get('merged_dir')
+        # Whatever else is mounted there isn't ours
+        if path in targets and self.mounts.shows(path, source):
+            self.release_left_on_disk(path, [rel for rel in item.get('left_on_disk', [])
+                                             if os.path.join(path, rel) in targets])
+            self.mounts.umount(path, check=False)
+        if item['type'] == 'overlay' and self.is_our_overlay(targets.get(item['merged_dir']), item['upper_dir']):
+            self.mounts.umount(item['merged_dir'], check=False)
+        if 'disk_path' in item and os.path.lexists(item['disk_path']):
+            self.release_disk_view(item['disk_path'])
+        with self.lock:
+            del self.pinned_items[path]
+        self.block_map.drop(path)
+
+    def ram_roots(self, kind):
+        """Where the tiers that are up keep move copies ('move') or overlay dirs ('overlay')"""
+        roots = {'tmpfs': str(self.tier_root('tmpfs', kind))}
+        # Asking for the zram root would set the device up
+        if self.zram_device is not None:
+            roots['zram'] = str(self.tier_root('zram', kind))
+        return roots
+
+    def covered_view(self, table, mount):
+        """The disk view of the directory a mount covers, found by the filesystem and path it binds"""
+        parents = [parent for parent in table if parent['id'] == mount['parent']]
+        if not parents:
+            return None
+        parent = parents[-1]
+        root = os.path.normpath(os.path.join(parent['root'], os.path.relpath(mount['target'], parent['target'])))
+        view_base = str(self.config.get('disk_view_base', '/run/rampipe/disk')).rstrip('/') + '/'
+        for view in table:
+            if (view['target'].startswith(view_base) and view['dev'] == parent['dev']
+                    and view['root'] == root):
+                return view['target']
+        return None
+
+    def adopt_lost_pins(self, table, targets):
+        """
+        Turn mounts of our RAM copies and overlays that no pin knows (the state
+        file got lost, or is older) back into pins. Returns how many there were.
+        Filters only matter when pinning, a selective pin comes back without them
+        """
+        known = set()
+        for path, item in self.pinned_items.items():
+            known.update([path, item.get('merged_dir'), item.get('disk_path')])
+        move_roots = self.ram_roots('move')
+        overlay_roots = self.ram_roots('overlay')
+        tier_mounts = {tier: targets.get(str(self.tier_root('tmpfs', 'move')) if tier == 'tmpfs'
+                                         else self.config.get('zram_path', '/mnt/rampipe-zram'))
+                       for tier in move_roots}
+        overlays = {}
+        for mount in table:
+            upper = re.search(r'upperdir=([^,]+)', mount['options'])
+            if mount['fstype'] != 'overlay' or not upper:
+                continue
+            for tier, root in overlay_roots.items():
+                # The overlay itself is mounted at the merged dir named after it, a bind of
+                # it over the pinned path looks just the same otherwise
+                if (upper.group(1).startswith(root.rstrip('/') + '/') and
+                        os.path.basename(mount['target']) == os.path.basename(upper.group(1))[:-len('-upper')]):
+                    overlays[mount['dev']] = (tier, mount)
+
+        adopted = 0
+        for mount in table:
+            target = mount['target']
+            if target in known or targets.get(target) is not mount:
+                continue
+            item = None
+            for tier, tier_mount in tier_mounts.items():
+                if tier_mount is None or mount['dev'] != tier_mount['dev'] or mount is tier_mount:
+                    continue
+                temp_path = os.path.normpath(tier_mount['target'] + '/' +
+                                             os.path.relpath(mount['root'], tier_mount['root']))
+                # Only copies where pin_move puts them, anything else is somebody else's bind
+                if temp_path == os.path.join(move_roots[tier], os.path.relpath(target, '/')):
+                    item = {'type': 'move', 'temp_path': temp_path, 'original_path': target, 'tier': tier}
+            if mount['dev'] in overlays and overlays[mount['dev']][1] is not mount:
+                tier, overlay = overlays[mount['dev']]
+                options = dict(option.split('=', 1) for option in overlay['options'].split(',') if '=' in option)
+                upper_dir = options['upperdir']
+                overlay_id = os.path.basename(upper_dir)[:-len('-upper')]
+                item = {'type': 'overlay', 'upper_dir': upper_dir, 'work_dir': options.get('workdir'),
+                        'merged_dir': overlay['target'], 'overlay_id': overlay_id,
+                        'original_path': target, 'tier': tier}
+                if options.get('lowerdir', '').endswith(f"{overlay_id}-lower"):
+                    item.update({'dedup': True, 'lower_dir': options['lowerdir']})
+            if item is None:
+                continue
+            view = self.covered_view(table, mount)
+            if view is not None:
+                item['disk_path'] = view
+                known.add(view)
+                if item['type'] == 'overlay':
+                    # Disk copies a selective pin bound over what its filters left out
+                    left_on_disk = [os.path.relpath(child['target'], target) for child in table
+                                    if child['parent'] == mount['id'] and child['dev'] == targets[view]['dev']]
+                    if left_on_disk:
+                        item['left_on_disk'] = left_on_disk
+            known.update([target, item.get('merged_dir')])
+            with self.lock:
+                self.pinned_items[target] = item
+            print(f"Adopted {target} ({item['type']}), it was mounted but not in the state file")
+            adopted += 1
+        return adopted
+
+    def remove_leftover_mounts(self):
+        """Unmount disk views and overlays that belong to no pin. They hold no data of their own"""
+        targets = {mount['target']: mount for mount in self.mounts.mount_table()}
+        used = set()
+        for path, item in self.pinned_items.items():
+            # The bind of an overlay pin over its path looks just like the overlay
+            used.update([path, item.get('disk_path'), item.get('merged_dir')])
+        view_base = str(self.config.get('disk_view_base', '/run/rampipe/disk')).rstrip('/') + '/'
+        overlay_roots = [root.rstrip('/') + '/' for root in self.ram_roots('overlay').values()]
+        for target, mount in targets.items():
+            if target in used:
+                continue
+            if target.startswith(view_base):
+                print(f"Removing leftover disk view {target}")
+                self.release_disk_view(target)
+            elif mount['fstype'] == 'overlay' and any(f"upperdir={root}" in mount['options']
+                                                       for root in overlay_roots):
+                # Its upper dir stays, find_orphans reports it
+                print(f"Unmounting leftover overlay {target}")
+                self.mounts.umount(target, check=False)
+
+    def find_orphans(self, notes=None):
+        """
+        Move copies and overlay dirs in RAM that belong to no pin, with a note on
+        where they came from if we know. They are only reported, never deleted
+        """
+        notes = notes or {}
+        pinned = set()
+        overlay_ids = set()
+        for item in self.pinned_items.values():
+            pinned.update(path for path in (item.get('temp_path'), item.get('upper_dir')) if path)
+            overlay_ids.add(item.get('overlay_id'))
+        ancestors = set()
+        for path in pinned:
+            while path != os.path.dirname(path):
+                path = os.path.dirname(path)
+                ancestors.add(path)
+        # Our own files may be kept in RAM too
+        skip = {str(path) for path in (self.state_file, self.zram_file(), self.evicted_file(),
+                                       self.block_map.directory)}
+        skip.update([path + '.tmp' for path in skip])
+        move_roots = self.ram_roots('move')
+        overlay_roots = self.ram_roots('overlay')
+        skip.update(move_roots.values())
+        skip.update(overlay_roots.values())
+
+        orphans = []
+
+        def walk(directory):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                return
+            for entry in entries:
+                if entry.path in pinned or entry.path in skip:
+                    continue
+                if entry.path in ancestors:
+                    walk(entry.path)
+                else:
+                    orphans.append({'path': entry.path, 'note': notes.get(entry.path, ''), 'size': None})
+
+        for root in move_roots.values():
+            walk(root)
+        for root in overlay_roots.values():
+            groups = {}
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(root, name)
+                if name == 'store' or path in skip:
+                    continue
+                # An overlay leaves -upper, -work, -lower and -flushed.json, report them as one
+                overlay_id = re.sub(r'-(upper|work|lower|flushed\.json)$', '', name)
+                if overlay_id not in overlay_ids:
+                    groups.setdefault(overlay_id, []).append(path)
+            for overlay_id, paths in sorted(groups.items()):
+                upper = os.path.join(root, f"{overlay_id}-upper")
+                path = upper if upper in paths else sorted(paths)[0]
+                note = notes.get(path, '')
+                if len(paths) > 1:
+                    note = '; '.join(filter(None, [note, f"with {', '.join(sorted(set(paths) - {path}))}"]))
+                orphans.append({'path': path, 'note': note, 'size': None})
+        return orphans
+
+    def zram_file(self):
+        return self.state_file.with_name('zram.json')
+
+    def load_zram(self):
+        """Pick up the zram device of an earlier run, if it is still mounted"""
+        try:
+            with open(self.zram_file(), 'r') as f:
+                device = json.load(f)['device']
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Warning: Could not load zram state: {e}", file=sys.stderr)
+            return
+        if self.mounts.is_mountpoint(self.config.get('zram_path', '/mnt/rampipe-zram')):
+            self.zram_device = device
+
+    def setup_zram(self):
+        """Set up the zram tier the first time a pin needs it"""
+        with self.zram_lock:
+            if self.zram_device is not None:
+                return
+            zram_path = Path(self.config.get('zram_path', '/mnt/rampipe-zram'))
+            zram_path.mkdir(parents=True, exist_ok=True)
+            device = self.mounts.create_zram(parse_size(self.config.get('zram_size', '2G')),
+                                             str(self.config.get('zram_algorithm', 'zstd')),
+                                             parse_size(self.config.get('zram_mem_limit', 0)))
+            try:
+                self.mounts.mount_zram(device, zram_path)
+            except Exception:
+                self.mounts.destroy_zram(device)
+                raise
+            self.zram_device = device
+            with open(self.zram_file(), 'w') as f:
+                json.dump({'device': device}, f)
+            print(f"Set up {device} at {zram_path}")
+
+    def teardown_zram(self):
+        """Write back and unpin everything on the zram tier, then remove the device"""
+        if self.zram_device is None:
+            return
+        for path, item in list(self.pinned_items.items()):
+            if item.get('tier') == 'zram':
+                try:
+                    self.unpin(path)
+                except Exception as e:
+                    print(f"Warning: Could not unpin {path} from zram: {e}", file=sys.stderr)
+        try:
+            self.mounts.umount(self.config.get('zram_path', '/mnt/rampipe-zram'))
+        except Exception as e:
+            # Something still uses it, removing the device now would lose data
+            print(f"Warning: Could not unmount the zram tier, leaving it: {e}", file=sys.stderr)
+            return
+        self.mounts.destroy_zram(self.zram_device)
+        self.zram_device = None
+        self.zram_file().unlink(missing_ok=True)
+
+    def tier_root(self, tier, kind):
+        """Where pins of a tier keep their RAM copy ('move') or upper dirs ('overlay')"""
+        if tier == 'zram':
+            self.setup_zram()
+            zram_path = Path(self.config.get('zram_path', '/mnt/rampipe-zram'))
+            return zram_path / 'overlays' if kind == 'overlay' else zram_path / 'move'
+        if tier != 'tmpfs':
+            raise Exception(f"Unknown tier: {tier}")
+        if kind == 'overlay':
+            return Path(self.config.get('overlay_base', '/dev/shm/overlays'))
+        return Path(self.config['ramdisk_path'])
+
+    def content_store(self, tier):
+        """The dedup store of a tier, next to its overlays so pins can hard link to it"""
+        # The zram tier may have to be set up first, that takes a while and doesn't need the lock
+        root = self.tier_root(tier, 'overlay') / 'store'
+        with self.lock:
+            if tier not in self.stores:
+                self.stores[tier] = ContentStore(root, self.copier)
+            return self.stores[tier]
+
+    def evicted_file(self):
+        return self.state_file.with_name('evicted.json')
+
+    def load_evicted(self):
+        """Load the list of pins the budget manager demoted, to re-pin them later"""
+        try:
+            with open(self.evicted_file(), 'r') as f:
+                self.evicted = json.load(f)
+        except FileNotFoundError:
+            self.evicted = []
+        except Exception as e:
+            print(f"Warning: Could not load evicted pins: {e}", file=sys.stderr)
+            self.evicted = []
+
+    def save_evicted(self):
+        try:
+            with open(self.evicted_file(), 'w') as f:
+                json.dump(self.evicted, f, indent=2)
+        except Exception as e:
+            print(f"Error saving evicted pins: {e}", file=sys.stderr)
+
+    def index_pins(self):
+        """Build the size index of every pin that doesn't have one, and size up the orphans"""
+        for orphan in self.orphans:
+            orphan['size'] = sum(SizeIndex.scan(orphan['path']).values())
+        for path, item in list(self.pinned_items.items()):
+            if self.sizes.total(path) is not None:
+                continue
+            if item['type'] == 'move':
+                self.sizes.build(path, item['temp_path'])
+            elif item['type'] == 'overlay':
+                self.sizes.build(path, item['upper_dir'])
+            elif item['type'] == 'lock':
+                # Locks die with the process, so take them again
+                with self.pin_lock(path):
+                    try:
+                        self.locker.lock_files(path, self.locker.scan(path, self.pin_filters(item)))
+                    except Exception as e:
+                        print(f"Warning: Could not lock {path} again: {e}", file=sys.stderr)
+            if item.get('dedup'):
+                self.content_store(item.get('tier', 'tmpfs')).index(path, item['lower_dir'])
+
+    def apply_manifest(self):
+        """
+        Pin everything listed in the manifest that isn't pinned yet, several at
+        once, highest priority first. Pins whose paths overlap wait for each
+        other. Sets critical_ready once the critical entries are done
+        """
+        manifest_path = self.config.get('manifest_file', '/etc/rampipe.manifest')
+        try:
+            entries = parse_manifest(manifest_path)
+        except FileNotFoundError:
+            entries = []
+        except Exception as e:
+            print(f"Warning: Could not load manifest: {e}", file=sys.stderr)
+            entries = []
+
+        pending = []
+        for entry in entries:
+            path = str(Path(entry['path']).resolve())
+            if path in self.pinned_items:
+                # Survived a daemon restart, or came back from the state file
+                continue
+            pending.append(dict(entry, path=path))
+
+        # sorted() is stable, so equal priorities keep the manifest order
+        pending.sort(key=lambda entry: -entry['priority'])
+
+        # Overlapping paths go into the same chain, which is pinned one after the other
+        chains = []
+        for entry in pending:
+            for chain in chains:
+                if any(self.paths_overlap(entry['path'], other['path']) for other in chain):
+                    chain.append(entry)
+                    break
+            else:
+                chains.append([entry])
+
+        critical = [entry['path'] for entry in pending if entry['critical']]
+        if not pending:
+            self.critical_ready.set()
+            self.manifest_done.set()
+            return
+
+        print(f"Pinning {len(pending)} paths from {manifest_path}")
+        pool = ThreadPoolExecutor(max_workers=max(1, int(self.config.get('manifest_concurrency', 4))),
+                                  thread_name_prefix='rampipe-manifest')
+        futures = {pool.submit(self.pin_chain, chain): chain for chain in chains}
+        pool.shutdown(wait=False)
+
+        def wait_for_critical():
+            failed = []
+            for future, chain in futures.items():
+                if any(entry['critical'] for entry in chain):
+                    failed.extend(path for path in future.result() if path in critical)
+            if failed:
+                print(f"Warning: Critical pins failed: {', '.join(failed)}", file=sys.stderr)
+            self.critical_ready.set()
+            for future in futures:
+                future.result()
+            self.manifest_done.set()
+
+        threading.Thread(target=wait_for_critical, daemon=True).start()
+
+    def start_readahead_replay(self):
+        """Read in what the last boot's trace says, in disk order, in the background. Returns the thread"""
+        if not self.config_flag('readahead'):
+            return None
+        try:
+            with open(self.config.get('readahead_trace', '/var/lib/rampipe/readahead.json'), 'r') as f:
+                trace = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Warning: Could not load readahead trace: {e}", file=sys.stderr)
+            return None
+
+        def replay():
+            try:
+                self.readahead_stats = self.readahead.replay(trace)
+                print(f"Readahead: {self.readahead_stats['bytes'] / 1024 / 1024:.2f} MB of "
+                      f"{self.readahead_stats['files']} files in {self.readahead_stats['seconds']:.2f} s")
+            except Exception as e:
+                print(f"Warning: Readahead failed: {e}", file=sys.stderr)
+
+        thread = threading.Thread(target=replay, name='rampipe-readahead', daemon=True)
+        thread.start()
+        return thread
+
+    def wait_for_warm(self, replay):
+        """Note how long it took from start until the manifest pins (and the readahead) were done"""
+        self.manifest_done.wait()
+        if replay is not None:
+            replay.join()
+        self.warm_seconds = time.monotonic() - self.started
+        self.metrics.set('rampipe_time_to_warm_seconds', self.warm_seconds)
+        print(f"Warm after {self.warm_seconds:.2f} s")
+
+    def start_readahead_recorder(self):
+        """Record what is read during the first readahead_window seconds after boot, for the next boot"""
+        window = float(self.config.get('readahead_window', 120))
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        if uptime >= window:
+            # Started (or restarted) long after boot, what is read now says nothing about booting
+            return
+
+        def record():
+            profiler = AccessProfiler(
+                exclude_roots=[self.config['ramdisk_path'], self.config.get('overlay_base', '/dev/shm/overlays'),
+                               self.config.get('disk_view_base', '/run/rampipe/disk')])
+            files = {path: path for path in profiler.run(window - uptime, 1.0)}
+            # Pinned files are read from the disk through their private views, the trace needs the real paths
+            for path, item in list(self.pinned_items.items()):
+                source = item['original_path'] if item['type'] == 'lock' else item.get('disk_path')
+                if not source:
+                    continue
+                if os.path.isfile(source):
+                    files[path] = source
+                    continue
+                for dirpath, dirnames, filenames in os.walk(source):
+                    for name in filenames:
+                        full = os.path.join(dirpath, name)
+                        files[os.path.join(path, os.path.relpath(full, source))] = full
+            trace = self.readahead.record(files)
+            trace_path = Path(self.config.get('readahead_trace', '/var/lib/rampipe/readahead.json'))
+            try:
+                trace_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(trace_path.with_name(trace_path.name + '.tmp'), 'w') as f:
+                    json.dump(trace, f)
+                os.replace(trace_path.with_name(trace_path.name + '.tmp'), trace_path)
+            except OSError as e:
+                print(f"Warning: Could not save readahead trace: {e}", file=sys.stderr)
+                return
+            print(f"Recorded readahead trace of {len(trace['files'])} files to {trace_path}")
+
+        threading.Thread(target=record, name='rampipe-readahead-record', daemon=True).start()
+
+    def paths_overlap(self, a, b):
+        return a == b or a.startswith(b.rstrip('/') + '/') or b.startswith(a.rstrip('/') + '/')
+
+    def pin_chain(self, chain):
+        """Pin manifest entries one after the other, returns the paths that failed"""
+        failed = []
+        for entry in chain:
+            path = entry['path']
+            filters = make_filters(entry['include'], entry['exclude'], entry['max_file_size'])
+            try:
+                if filters and entry['mode'] not in ('move', 'overlay', 'lock'):
+                    raise Exception("include, exclude and max_file_size don't work with mode=lazy and mode=dedup")
+                if entry['mode'] == 'lock' and entry['tier'] != 'tmpfs':
+                    raise Exception("mode=lock stays in the page cache, it can't have a tier")
+                if entry['mode'] == 'lazy':
+                    job = self.pin_lazy(path, entry['tier'])
+                    # A critical lazy pin only counts once it's actually in RAM
+                    if entry['critical']:
+                        job.thread.join()
+                        if job.state != 'done':
+                            raise Exception(job.error or f"job {job.job_id} {job.state}")
+                elif entry['mode'] in ('overlay', 'dedup'):
+                    self.pin_overlay(path, entry['tier'], dedup=entry['mode'] == 'dedup', filters=filters)
+                elif entry['mode'] == 'lock':
+                    self.pin_mlock(path, filters)
+                else:
+                    self.pin_move(path, entry['tier'], filters)
+                self.set_pin_priority(path, entry['priority'])
+                print(f"Pinned {path} from manifest")
+            except Exception as e:
+                print(f"Error pinning {path} from manifest: {e}", file=sys.stderr)
+                failed.append(path)
+        return failed
+
+    def set_pin_priority(self, path, priority):
+        """Remember which pins to write back first when we are stopped in a hurry"""
+        if not priority:
+            return
+        with self.lock:
+            item = self.pinned_items.get(str(Path(path).resolve()))
+            if item is not None:
+                item['priority'] = priority
+        self.save_state()
+
+    def mark_auto(self, path):
+        """Flag a pin as one autopin made, so a later plan may drop it again. Caller holds its pin lock"""
+        with self.lock:
+            item = self.pinned_items.get(str(Path(path).resolve()))
+            if item is not None:
+                item['auto'] = True
+
     def save_state(self):
         """Save state to JSON file"""
         with self.lock:
@@ -101,254 +2949,1423 @@ class RamPipeDaemon:
             except Exception as e:
                 print(f"Error saving state: {e}", file=sys.stderr)
 
-    def pin_move(self, path):
-        """Pin file/directory using move method"""
+    def pin_move(self, path, tier='tmpfs', filters=None):
+        """
+        Pin file/directory using move method. With filters it becomes an overlay
+        pin that starts out with just the files that pass them, see pin_overlay
+        """
+        started = time.monotonic()
+        path = Path(path).resolve()
+        if not path.exists():
+            raise Exception(f"Path does not exist: {path}")
+        if filters and not path.is_dir():
+            raise Exception("Filters only work with directories")
+        if filters:
+            return self.pin_overlay(path, tier, filters=filters)
+            
+        with self.pin_lock(str(path)):
+            if str(path) in self.pinned_items:
+                raise Exception(f"Path is already pinned: {path}")
+
+            ramdisk_path = self.tier_root(tier, 'move')
+            temp_path = ramdisk_path / path.relative_to('/')
+            temp_path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Copy to tmpfs
+            copied = self.copier.sync_tree(path, temp_path)
+            self.sizes.build(str(path), temp_path)
+            self.block_map.build(str(path), temp_path, path)
+
+            # Keep a private view of the disk copy, syncs write there once the original is covered
+            disk_path = self.make_disk_view(path)
+
+            # Start journaling before anyone but us can write to the copy
+            self.tracker.watch(str(path), temp_path)
+
+            # Bind mount over original
+            try:
+                self.mounts.bind(temp_path, path)
+            except Exception:
+                self.tracker.unwatch(str(path))
+                self.release_disk_view(disk_path)
+                raise
+
+            # Record operation
+            self.last_access[str(path)] = time.time()
+            with self.lock:
+                self.pinned_items[str(path)] = {
+                    'type': 'move', 
+                    'temp_path': str(temp_path),
+                    'disk_path': disk_path,
+                    'original_path': str(path),
+                    'tier': tier
+                }
+            self.save_state()
+        self.metrics.observe('rampipe_pin_duration_seconds', time.monotonic() - started, mode='move')
+        self.metrics.inc('rampipe_pin_bytes_total', copied['bytes'], mode='move')
+
+    def make_disk_view(self, path):
+        """Bind the on-disk original to a private mountpoint before it gets covered"""
+        view_base = Path(self.config.get('disk_view_base', '/run/rampipe/disk'))
+        view_base.mkdir(parents=True, exist_ok=True)
+        view = view_base / f"{path.name}-{int(time.time())}"
+        suffix = 0
+        # A bind mount needs a target of the same kind. Creating it is also what
+        # claims the name, pins of the same name may be set up at the same time
+        while True:
+            try:
+                if path.is_dir():
+                    view.mkdir()
+                else:
+                    view.touch(exist_ok=False)
+                break
+            except FileExistsError:
+                suffix += 1
+                view = view_base / f"{path.name}-{int(time.time())}-{suffix}"
+        try:
+            # Private, so the bind over the original doesn't propagate into the view
+            self.mounts.bind(path, view, private=True)
+        except Exception:
+            self.release_disk_view(str(view))
+            raise
+        return str(view)
+
+    def release_left_on_disk(self, path, rels):
+        """Unmount the disk copies bound over what the filters of a pin left out"""
+        for rel in reversed(rels):
+            self.mounts.umount(os.path.join(path, rel), check=False)
+
+    def release_disk_view(self, disk_path):
+        """Unmount and remove a private disk view"""
+        self.mounts.umount(disk_path, check=False)
+        try:
+            os.rmdir(disk_path) if Path(disk_path).is_dir() else os.remove(disk_path)
+        except OSError as e:
+            print(f"Warning: Could not remove disk view {disk_path}: {e}", file=sys.stderr)
+
+    def disk_path(self, item):
+        """Where the on-disk copy of a move pin can be written to"""
+        # Pins recorded before disk views existed only know the original path
+        return self.mounts.resolve(item.get('disk_path', item['original_path']))
+
+    def flushed_file(self, item):
+        """Where the checkpoint bookkeeping of an overlay pin is kept, next to its upper dir"""
+        return Path(item['upper_dir']).parent / f"{item['overlay_id']}-flushed.json"
+
+    def load_flushed(self, item):
+        """Checkpoint bookkeeping of an overlay pin. Caller holds its checkpoint lock"""
+        path = item['original_path']
+        if path not in self.overlay_flushed:
+            try:
+                with open(self.flushed_file(item), 'r') as f:
+                    self.overlay_flushed[path] = json.load(f)
+            except FileNotFoundError:
+                self.overlay_flushed[path] = {}
+        return self.overlay_flushed[path]
+
+    def save_flushed(self, item):
+        """Caller holds the checkpoint lock of the pin"""
+        with open(self.flushed_file(item), 'w') as f:
+            json.dump(self.load_flushed(item), f)
+
+    def pin_lock(self, path):
+        with self.lock:
+            return self.pin_locks.setdefault(path, threading.RLock())
+
+    def device_lock(self, device):
+        with self.lock:
+            return self.device_locks.setdefault(device, threading.Lock())
+
+    def checkpoint_lock(self, path):
+        with self.lock:
+            return self.checkpoint_locks.setdefault(path, threading.Lock())
+
+    def pin_device(self, item):
+        """The device a pin writes back to"""
+        try:
+            return os.stat(self.disk_path(item)).st_dev
+        except OSError:
+            return None
+
+    def limiter_for(self, item):
+        """The rate limiter of the device a pin writes back to"""
+        device = self.pin_device(item)
+        with self.lock:
+            if device not in self.limiters:
+                self.limiters[device] = RateLimiter(parse_size(self.config.get('writeback_max_bandwidth', 0)),
+                                                    int(self.config.get('writeback_max_iops', 0)))
+                if self.writeback_cancelled:
+                    self.limiters[device].cancel()
+            return self.limiters[device]
+
+    def cancel_writeback(self):
+        """Make background syncs give up at their next write, what they didn't write stays dirty"""
+        with self.lock:
+            self.writeback_cancelled = True
+            limiters = list(self.limiters.values())
+        for limiter in limiters:
+            limiter.cancel()
+
+    def checkpoint_overlay_item(self, path, item, background=False):
+        """Flush what changed in the upper dir of an overlay pin onto the disk"""
+        if 'disk_path' not in item:
+            # Recorded before checkpoints existed, there is no private way to the lower dir
+            return {'files': 0, 'bytes': 0}
+        checkpointer, limiter, hold = self.checkpointer, None, None
+        if background:
+            checkpointer, limiter = self.writeback_checkpointer, self.limiter_for(item)
+            settle = float(self.config.get('writeback_coalesce_window', 10))
+            max_age = float(self.config.get('sync_interval', 300))
+            dirty_since = self.overlay_dirty_since.setdefault(path, {})
+            held = set()
+            now = time.time()
+
+            def hold(rel, st):
+                # Still being rewritten, unless it has been dirty for a whole sync interval
+                if now - st.st_mtime < settle and now - dirty_since.setdefault(rel, now) < max_age:
+                    held.add(rel)
+                    return True
+                return False
+
+        recorded = []
+
+        def write_file(rel, src, dst, st):
+            # Big files go block by block, like for move pins
+            if not self.block_map.wants(st):
+                return None
+            try:
+                dst_st = os.lstat(dst)
+            except FileNotFoundError:
+                dst_st = None
+            if dst_st is not None and not stat.S_ISREG(dst_st.st_mode):
+                return None
+            blocks = self.block_map.lookup(path, rel, dst_st) if dst_st is not None else None
+            checksums, written = checkpointer.copier.copy_blocks(src, dst, st, blocks, self.block_map.block_size,
+                                                                 limiter, OverlayCheckpointer.OVERLAY_XATTRS)
+            self.block_map.record(path, rel, os.lstat(dst), checksums)
+            recorded.append(rel)
+            return written
+
+        # A trusted journal says which paths to look at, without one the whole upper dir is walked
+        entries, full = self.tracker.take(path)
+        sizes = {}
+        with self.checkpoint_lock(path):
+            try:
+                if full:
+                    stats = checkpointer.checkpoint(item['upper_dir'], item['disk_path'], self.load_flushed(item),
+                                                    limiter=limiter, hold=hold, sizes=sizes, write_file=write_file)
+                else:
+                    stats = checkpointer.checkpoint_paths(item['upper_dir'], item['disk_path'],
+                                                          self.load_flushed(item), entries,
+                                                          limiter=limiter, hold=hold, write_file=write_file)
+            except Exception:
+                self.tracker.restore(path, entries, full)
+                raise
+            finally:
+                # Whatever made it to disk before a failure doesn't need flushing again
+                self.save_flushed(item)
+                if recorded:
+                    self.block_map.save(path)
+        if background:
+            self.overlay_dirty_since[path] = {rel: dirty_since[rel] for rel in held}
+            self.tracker.restore(path, {rel: 'write' for rel in held}, False)
+        if full:
+            # It walked the whole upper dir, which also covers changes the tracker missed
+            self.sizes.replace(path, item['upper_dir'], sizes)
+        self.metrics.inc('rampipe_flushed_files_total', stats['files'], type='overlay')
+        self.metrics.inc('rampipe_flushed_bytes_total', stats['bytes'], type='overlay')
+        return stats
+
+    def write_back_blocks(self, path, item, rels, copier, limiter=None):
+        """
+        Write the big files among rels of a move pin back block by block. Returns
+        the stats and the rest of rels, for the usual copy
+        """
+        stats = {'files': 0, 'bytes': 0}
+        disk_root = self.disk_path(item)
+        rest = []
+        big = []
+        for rel in rels:
+            src = os.path.join(item['temp_path'], rel) if rel else item['temp_path']
+            dst = os.path.join(disk_root, rel) if rel else disk_root
+            try:
+                st = os.lstat(src)
+            except FileNotFoundError:
+                # Deleted, the usual copy removes it from the disk
+                rest.append(rel)
+                continue
+            try:
+                dst_st = os.lstat(dst)
+            except FileNotFoundError:
+                dst_st = None
+            if not self.block_map.wants(st) or (dst_st is not None and not stat.S_ISREG(dst_st.st_mode)):
+                rest.append(rel)
+            elif dst_st is None:
+                # A new big file goes whole, but with checksums taken on the way. Unless it's in a
+                # new directory too, the usual copy makes that first
+                if os.path.isdir(os.path.dirname(dst)):
+                    big.append((rel, src, dst, st, None))
+                else:
+                    rest.append(rel)
+            else:
+                big.append((rel, src, dst, st, self.block_map.lookup(path, rel, dst_st)))
+        if not big:
+            return stats, rest
+
+        def write(rel, src, dst, st, blocks):
+            checksums, written = copier.copy_blocks(src, dst, st, blocks, self.block_map.block_size, limiter)
+            self.block_map.record(path, rel, os.lstat(dst), checksums)
+            return written
+
+        errors = []
+        for future in [copier.pool.submit(write, *args) for args in big]:
+            try:
+                stats['bytes'] += future.result()
+                stats['files'] += 1
+            except Exception as e:
+                errors.append(e)
+        self.block_map.save(path)
+        if errors:
+            raise Exception(f"Write-back to {disk_root} failed: {errors[0]}")
+        return stats, rest
+
+    def sync_move_item(self, path, item, background=False):
+        """Write back what changed in the tmpfs copy of a move pin"""
+        copier, limiter = self.copier, None
+        if background:
+            copier, limiter = self.writeback_copier, self.limiter_for(item)
+            entries, full = self.tracker.take(path, float(self.config.get('writeback_coalesce_window', 10)),
+                                              float(self.config.get('sync_interval', 300)))
+        else:
+            entries, full = self.tracker.take(path)
+        try:
+            if full:
+                # The big files we know go block by block, the quick check of the full sync skips them then
+                blocks, rels = self.write_back_blocks(path, item, list(self.block_map.files(path)), copier, limiter)
+                stats = copier.sync_tree(item['temp_path'], self.disk_path(item), limiter=limiter)
+            else:
+                blocks, rels = self.write_back_blocks(path, item, entries, copier, limiter)
+                stats = copier.apply_entries(item['temp_path'], self.disk_path(item), rels, limiter=limiter)
+            stats['files'] += blocks['files']
+            stats['bytes'] += blocks['bytes']
+        except Exception:
+            self.tracker.restore(path, entries, full)
+            raise
+        if full:
+            # The changes the journal lost never reached the size index either
+            self.sizes.build(path, item['temp_path'])
+        self.metrics.inc('rampipe_flushed_files_total', stats['files'], type='move')
+        self.metrics.inc('rampipe_flushed_bytes_total', stats['bytes'], type='move')
+        return stats
+
+    def pin_pending(self, path, item):
+        """
+        What of a pin still has to be written back, as (changed entries, bytes).
+        Deletions count as changes too, even if they have no bytes to write.
+        Comes from the journal and the size index, so it never walks a tree
+        """
+        if item['type'] == 'overlay' and 'disk_path' not in item:
+            # Only merged on unpin
+            return 0, 0
+        if item['type'] not in ('move', 'overlay'):
+            return 0, 0
+        entries, full = self.tracker.peek(path)
+        if full:
+            return 1, self.memory_usage(item)
+        return len(entries), self.sizes.bytes_of(path, entries)
+
+    def pin_dirty_bytes(self, path, item):
+        """Roughly how many bytes of a pin still have to be written back"""
+        return self.pin_pending(path, item)[1]
+
+    def dirty_bytes(self, tracked_only=False):
+        """
+        With tracked_only, pins waiting for a full sync are left out. Their whole
+        size counts as dirty, so they would set off write-back again and again
+        """
+        return sum(self.pin_dirty_bytes(path, item) for path, item in list(self.pinned_items.items())
+                   if not tracked_only or not self.tracker.wants_full(path))
+
+    def pin_overlay(self, path, tier='tmpfs', dedup=False, filters=None):
+        """
+        Pin directory using overlay method. With dedup the lower dir is a copy
+        in RAM whose files are shared with other dedup pins of the same content.
+        With filters the upper dir starts out with the files that pass them, so
+        those are in RAM right away and the rest is read from disk until
+        something writes to it. What they exclude, and files that are too big,
+        get the disk copy bound over them, so even writes to those never reach RAM
+        """
+        started = time.monotonic()
+        path = Path(path).resolve()
+        if not path.exists():
+            raise Exception(f"Path does not exist: {path}")
+        if not path.is_dir():
+            raise Exception("Overlay mode only works with directories")
+        if dedup and filters:
+            raise Exception("Dedup pins take the whole directory, they can't have filters")
+            
+        with self.pin_lock(str(path)):
+            if str(path) in self.pinned_items:
+                raise Exception(f"Path is already pinned: {path}")
+
+            # Check for submounts
+            if self.mounts.submounts(path):
+                raise Exception("Directory has submounts, aborting")
+
+            left_on_disk = []
+            if filters:
+                files = filtered_files(path, filters, left_on_disk)
+                if not files:
+                    raise Exception(f"No file in {path} passes the filters")
+
+            overlay_base = self.tier_root(tier, 'overlay')
+            dir_name = path.name
+            overlay_id = f"{dir_name}-{int(time.time())}"
+            upper_dir = overlay_base / f"{overlay_id}-upper"
+            work_dir = overlay_base / f"{overlay_id}-work"
+            merged_dir = Path('/mnt') / overlay_id
+
+            upper_dir.mkdir(parents=True, exist_ok=True)
+            work_dir.mkdir(parents=True, exist_ok=True)
+            merged_dir.mkdir(parents=True, exist_ok=True)
+
+            flushed = {}
+            if filters:
+                # The files and the directories leading to them, as if overlayfs had copied them up.
+                # They are the same as on disk, so no checkpoint needs to write them back
+                dirs = {os.path.dirname(rel) for rel in files}
+                for rel in list(dirs):
+                    while rel:
+                        rel = os.path.dirname(rel)
+                        dirs.add(rel)
+                copied = self.copier.apply_entries(path, upper_dir, sorted(dirs) + sorted(files))
+                for rel in (dirs | set(files)) - {''}:
+                    flushed[rel] = self.checkpointer.signature(os.lstat(upper_dir / rel))
+                self.block_map.build(str(path), upper_dir, path, sorted(files))
+
+            lower_dir = path
+            if dedup:
+                # The first write to a file copies it up, so a shared file is never written to
+                store = self.content_store(tier)
+                lower_dir = overlay_base / f"{overlay_id}-lower"
+                try:
+                    copied = store.link_tree(path, lower_dir)
+                except Exception:
+                    store.release(str(path), lower_dir)
+                    raise
+                store.index(str(path), lower_dir)
+
+            disk_path = None
+            mounted = covered = False
+            bound = []
+            try:
+                # Checkpoints write the upper dir's changes into the disk copy through a private view
+                disk_path = self.make_disk_view(path)
+
+                # Mount overlay
+                self.mounts.mount_overlay(lower_dir, upper_dir, work_dir, merged_dir)
+                mounted = True
+
+                # Writes through the overlay land in the upper dir, journal them from the start
+                self.tracker.watch(str(path), upper_dir)
+
+                # Bind merged overlay over original
+                self.mounts.bind(merged_dir, path)
+                covered = True
+
+                # A write to what the filters left out would copy it up into RAM, so bind the disk copy back over it
+                for rel in left_on_disk:
+                    self.mounts.bind(os.path.join(disk_path, rel), path / rel)
+                    bound.append(rel)
+            except Exception:
+                # Undo it all in reverse, nothing records a pin that never was
+                self.release_left_on_disk(path, bound)
+                if covered:
+                    self.mounts.umount(path, check=False)
+                self.tracker.unwatch(str(path))
+                if mounted:
+                    self.mounts.umount(merged_dir, check=False)
+                if disk_path is not None:
+                    self.release_disk_view(disk_path)
+                if dedup:
+                    store.release(str(path), lower_dir)
+                if filters:
+                    self.block_map.drop(str(path))
+                shutil.rmtree(upper_dir, ignore_errors=True)
+                shutil.rmtree(work_dir, ignore_errors=True)
+                shutil.rmtree(merged_dir, ignore_errors=True)
+                raise
+
+            self.last_access[str(path)] = time.time()
+            self.sizes.build(str(path), upper_dir)
+            with self.lock:
+                self.pinned_items[str(path)] = {
+                    'type': 'overlay',
+                    'upper_dir': str(upper_dir),
+                    'work_dir': str(work_dir),
+                    'merged_dir': str(merged_dir),
+                    'disk_path': disk_path,
+                    'overlay_id': overlay_id,
+                    'original_path': str(path),
+                    'tier': tier
+                }
+                if dedup:
+                    self.pinned_items[str(path)].update({'dedup': True, 'lower_dir': str(lower_dir)})
+                if filters:
+                    self.pinned_items[str(path)].update({'filters': filters, 'files': len(files),
+                                                         'left_on_disk': left_on_disk})
+            if flushed:
+                with self.checkpoint_lock(str(path)):
+                    self.overlay_flushed[str(path)] = flushed
+                    self.save_flushed(self.pinned_items[str(path)])
+            self.save_state()
+        if filters:
+            self.metrics.inc('rampipe_pin_bytes_total', copied['bytes'], mode='overlay')
+        if dedup:
+            self.metrics.observe('rampipe_pin_duration_seconds', time.monotonic() - started, mode='dedup')
+            self.metrics.inc('rampipe_pin_bytes_total', copied['bytes'] - copied['deduped'], mode='dedup')
+            return copied
+        self.metrics.observe('rampipe_pin_duration_seconds', time.monotonic() - started, mode='overlay')
+
+    def pin_lazy(self, path, tier='tmpfs'):
+        """
+        Pin a directory right away and fill RAM in the background.
+        The pin is an overlay, so until a file has been copied up into RAM
+        its reads simply go to the disk. Returns the job doing the copying
+        """
+        path = Path(path).resolve()
+        if not path.is_dir():
+            raise Exception("Lazy pins only work with directories")
+        with self.pin_lock(str(path)):
+            self.pin_overlay(path, tier)
+            self.pinned_items[str(path)]['lazy'] = True
+            self.pinned_items[str(path)]['populated'] = False
+            self.save_state()
+            return self.start_populate(str(path))
+
+    def pin_mlock(self, path, filters=None):
+        """
+        Pin file/directory by locking its pages in the page cache. Nothing is
+        copied, for read-only stuff. filters limit a directory to some of its files
+        """
+        started = time.monotonic()
         path = Path(path).resolve()
         if not path.exists():
             raise Exception(f"Path does not exist: {path}")
-            
-        ramdisk_path = Path(self.config['ramdisk_path'])
-        temp_path = ramdisk_path / path.relative_to('/')
-        temp_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # Copy to tmpfs
-        if path.is_file():
-            shutil.copy2(str(path), str(temp_path))
-        else:
-            shutil.copytree(str(path), str(temp_path), dirs_exist_ok=True)
+        with self.pin_lock(str(path)):
+            if str(path) in self.pinned_items:
+                raise Exception(f"Path is already pinned: {path}")
 
-        # Bind mount over original
-        subprocess.run(['mount', '--bind', str(temp_path), str(path)], check=True, capture_output=True)
+            files = self.locker.scan(path, filters)
+            if not files:
+                raise Exception(f"Nothing to lock in {path}" + (" that passes the filters" if filters else ""))
+            # Fail before locking anything, not halfway through
+            self.check_memlock(sum(PageLocker.pages(st.st_size) for st in files.values()))
+            try:
+                locked = self.locker.lock_files(str(path), files)
+            except Exception:
+                self.locker.release(str(path))
+                raise
 
-        # Record operation
-        self.pinned_items[str(path)] = {
-            'type': 'move', 
-            'temp_path': str(temp_path),
-            'original_path': str(path)
-        }
-        self.save_state()
+            self.last_access[str(path)] = time.time()
+            with self.lock:
+                self.pinned_items[str(path)] = {
+                    'type': 'lock',
+                    'original_path': str(path),
+                    'filters': filters
+                }
+            self.save_state()
+        self.metrics.observe('rampipe_pin_duration_seconds', time.monotonic() - started, mode='lock')
+        return locked
 
-    def pin_overlay(self, path):
-        """Pin directory using overlay method"""
-        path = Path(path).resolve()
-        if not path.exists():
-            raise Exception(f"Path does not exist: {path}")
-        if not path.is_dir():
-            raise Exception("Overlay mode only works with directories")
-            
-        # Check for submounts
-        result = subprocess.run(['findmnt', '-rn', '-o', 'TARGET', '--submounts', str(path)], 
-                              capture_output=True, text=True)
-        if result.stdout.strip():
-            raise Exception("Directory has submounts, aborting")
-
-        overlay_base = Path(self.config.get('overlay_base', '/dev/shm/overlays'))
-        dir_name = path.name
-        overlay_id = f"{dir_name}-{int(time.time())}"
-        upper_dir = overlay_base / f"{overlay_id}-upper"
-        work_dir = overlay_base / f"{overlay_id}-work"
-        merged_dir = Path('/mnt') / overlay_id
-
-        upper_dir.mkdir(parents=True, exist_ok=True)
-        work_dir.mkdir(parents=True, exist_ok=True)
-        merged_dir.mkdir(parents=True, exist_ok=True)
-
-        # Mount overlay
-        subprocess.run([
-            'mount', '-t', 'overlay', 'overlay',
-            '-o', f'lowerdir={path},upperdir={upper_dir},workdir={work_dir}',
-            str(merged_dir)
-        ], check=True, capture_output=True)
+    def pin_filters(self, item):
+        """The filters of a selective pin, None if it takes everything"""
+        if 'filters' in item:
+            return item['filters']
+        # Lock pins used to only know include patterns
+        return make_filters(item.get('include'))
 
-        # Bind merged overlay over original
-        subprocess.run(['mount', '--bind', str(merged_dir), str(path)], check=True, capture_output=True)
+    def memlock_limit(self):
+        """How much this process may lock in total, None if there is no limit"""
+        if int(proc_field('/proc/self/status', 'CapEff') or '0', 16) >> CAP_IPC_LOCK & 1:
+            # mlock doesn't look at RLIMIT_MEMLOCK then
+            return None
+        soft, hard = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+        return None if soft == resource.RLIM_INFINITY else soft
 
-        self.pinned_items[str(path)] = {
-            'type': 'overlay',
-            'upper_dir': str(upper_dir),
-            'work_dir': str(work_dir),
-            'merged_dir': str(merged_dir),
-            'overlay_id': overlay_id,
-            'original_path': str(path)
-        }
-        self.save_state()
+    def check_memlock(self, needed):
+        """Make sure needed more bytes can be locked, raising the soft limit if that is enough"""
+        locked = proc_bytes('/proc/self/status', 'VmLck')
+        limit = self.memlock_limit()
+        if limit is not None and locked + needed > limit:
+            soft, hard = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+            if hard != resource.RLIM_INFINITY and locked + needed > hard:
+                raise Exception(f"Locking needs {needed / 1024 / 1024:.2f} MB, but RLIMIT_MEMLOCK is "
+                                f"{hard / 1024 / 1024:.2f} MB and {locked / 1024 / 1024:.2f} MB are locked already "
+                                f"(raise LimitMEMLOCK= in the service)")
+            resource.setrlimit(resource.RLIMIT_MEMLOCK, (hard, hard))
+        # Locked pages can't be reclaimed, locking more than is free just makes the OOM killer busy
+        available = proc_bytes('/proc/meminfo', 'MemAvailable')
+        if available and needed > available:
+            raise Exception(f"Locking needs {needed / 1024 / 1024:.2f} MB, but only "
+                            f"{available / 1024 / 1024:.2f} MB of RAM are available")
+
+    def create_job(self, kind, path):
+        with self.jobs_lock:
+            job = Job(self.next_job_id, kind, path)
+            self.jobs[job.job_id] = job
+            self.next_job_id += 1
+            # Keep the history of finished jobs short
+            finished = [j for j in self.jobs.values() if j.state != 'running']
+            for old in finished[:-50]:
+                del self.jobs[old.job_id]
+        return job
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(int(job_id))
+        if job is None:
+            raise Exception(f"No such job: {job_id}")
+        return job
+
+    def start_populate(self, path):
+        """Start the background job that copies a lazy pin into RAM"""
+        job = self.create_job('pin', path)
+        self.pinned_items[path]['job_id'] = job.job_id
+        job.thread = threading.Thread(target=self.populate_overlay, args=(job, path), daemon=True)
+        job.thread.start()
+        return job
+
+    def populate_overlay(self, job, path):
+        """Copy every file of a lazy pin up into RAM, hottest and smallest first"""
+        try:
+            item = self.pinned_items[path]
+            lower_root = self.disk_path(item)
+            merged_root = item['merged_dir']
+            upper_root = item['upper_dir']
+
+            files = []
+            for dirpath, dirnames, filenames in os.walk(lower_root):
+                for name in filenames:
+                    full = os.path.join(dirpath, name)
+                    try:
+                        st = os.lstat(full)
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        files.append((os.path.relpath(full, lower_root), st))
+                if job.cancelled:
+                    break
+
+            # Recently read files first, small before big within each group, so most
+            # files become RAM-backed as early as possible
+            hot_since = time.time() - self.config.get('lazy_hot_window', 86400)
+            files.sort(key=lambda f: (f[1].st_atime < hot_since, f[1].st_size))
+            job.files_total = len(files)
+            job.bytes_total = sum(st.st_size for _, st in files)
+
+            for rel, lower_st in files:
+                if job.cancelled:
+                    break
+                upper = os.path.join(upper_root, rel)
+                with self.checkpoint_lock(path):
+                    if not os.path.lexists(upper):
+                        self.copy_up(os.path.join(merged_root, rel), upper, rel, lower_st, item)
+                job.files_done += 1
+                job.bytes_done += lower_st.st_size
+
+            if not job.cancelled:
+                item['populated'] = True
+                self.save_state()
+            with self.checkpoint_lock(path):
+                self.save_flushed(item)
+            job.finish()
+        except Exception as e:
+            print(f"Warning: Filling RAM for {path} failed: {e}", file=sys.stderr)
+            job.finish(error=e)
+
+    def copy_up(self, merged, upper, rel, lower_st, item):
+        """Make overlayfs copy one file into the upper dir. Caller holds the checkpoint lock of the pin"""
+        try:
+            # Opening for writing copies the file up without touching its content or times
+            fd = os.open(merged, os.O_WRONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            # Gone meanwhile, or a binary that is running right now (ETXTBSY), reads keep going to disk
+            return
+        try:
+            upper_st = os.lstat(upper)
+        except FileNotFoundError:
+            return
+        self.sizes.mark(item['original_path'], rel)
+        # It's the same content as on disk, so no checkpoint needs to write it back,
+        # unless somebody wrote to it in the meantime
+        if upper_st.st_mtime_ns == lower_st.st_mtime_ns and upper_st.st_size == lower_st.st_size:
+            self.load_flushed(item)[rel] = self.checkpointer.signature(upper_st)
+
+    def start_profile(self, duration=None, top_n=None, apply=False):
+        """Profile disk I/O in the background, optionally pinning the results. Returns the job"""
+        duration = float(duration or self.config.get('profile_duration', 60))
+        job = self.create_job('profile', '-')
+        job.deadline = time.time() + duration
+        job.thread = threading.Thread(target=self.profile_job, args=(job, duration, top_n, apply), daemon=True)
+        job.thread.start()
+        return job
+
+    def profile_job(self, job, duration, top_n, apply):
+        try:
+            interval = float(self.config.get('profile_sample_interval', 1))
+            job.files_total = int(duration / interval)
+            with self.lock:
+                pinned = list(self.pinned_items)
+            profiler = AccessProfiler(
+                extra_roots=pinned,
+                exclude_roots=[self.config['ramdisk_path'], self.config.get('overlay_base', '/dev/shm/overlays'),
+                               self.config.get('disk_view_base', '/run/rampipe/disk')])
+            files = profiler.run(duration, interval, job)
+            ranking = profiler.rank(files, int(self.config.get('autopin_min_depth', 2)))
+            plan = self.plan_autopin(ranking, top_n)
+            job.result = {'ranking': ranking[:50], 'plan': plan}
+
+            lines = ["Busiest paths:"]
+            for path, entry in ranking[:20]:
+                lines.append(f"  {path}{'/' if entry['is_dir'] else ''} - {entry['ops']} ops, "
+                             f"{entry['bytes'] / 1024 / 1024:.2f} MB, "
+                             f"{entry['disk_bytes'] / 1024 / 1024:.2f} MB from disk")
+            lines.append("Pin candidates within the budget:")
+            for candidate in plan:
+                lines.append(f"  {candidate['path']} ({candidate['mode']}) - "
+                             f"{candidate['cost'] / 1024 / 1024:.2f} MB of RAM")
+            if apply:
+                lines.extend(self.apply_autopin(plan))
+            job.summary = '\n'.join(lines)
+            job.finish()
+        except Exception as e:
+            print(f"Warning: Profiling failed: {e}", file=sys.stderr)
+            job.finish(error=e)
+
+    def estimate_cost(self, path, mode, entry, limit):
+        """RAM a pin of path would take, stops counting once past limit"""
+        if mode == 'overlay':
+            # Only what gets written ends up in RAM, twice the observed writes as headroom
+            return 2 * entry['write_bytes']
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+            if size > limit:
+                break
+        return size
+
+    def plan_autopin(self, ranking, top_n=None):
+        """
+        Pick the paths to pin: the most traffic per byte of RAM first, no
+        paths nested in each other, within autopin_budget and autopin_top_n
+        """
+        budget = parse_size(self.config.get('autopin_budget', '256M'))
+        top_n = int(top_n or self.config.get('autopin_top_n', 5))
+
+        # What auto pins use now is available to the new plan, manual pins aren't touched
+        with self.lock:
+            manual = [path for path, item in self.pinned_items.items() if not item.get('auto')]
+
+        candidates = []
+        for path, entry in ranking[:top_n * 20]:
+            if not entry['score'] or not os.path.exists(path):
+                continue
+            if any(path == p or path.startswith(p + '/') or p.startswith(path + '/') for p in manual):
+                continue
+            mode = 'move'
+            if entry['is_dir'] and entry['bytes'] and entry['write_bytes'] / entry['bytes'] >= 0.5:
+                mode = 'overlay'
+            cost = self.estimate_cost(path, mode, entry, budget)
+            if cost > budget:
+                continue
+            # Tiny files would always win on density alone, so count at least 64K for each
+            candidates.append({'path': path, 'mode': mode, 'cost': cost, 'score': entry['score'],
+                               'density': entry['score'] / max(cost, 64 * 1024)})
+
+        plan = []
+        remaining = budget
+        for candidate in sorted(candidates, key=lambda c: c['density'], reverse=True):
+            path = candidate['path']
+            if candidate['cost'] > remaining:
+                continue
+            if any(path.startswith(c['path'] + '/') or c['path'].startswith(path + '/') for c in plan):
+                continue
+            plan.append(candidate)
+            remaining -= candidate['cost']
+            if len(plan) >= top_n:
+                break
+        return plan
+
+    def apply_autopin(self, plan):
+        """Pin what the plan has, unpin earlier auto pins it dropped. Returns log lines"""
+        lines = []
+        wanted = {candidate['path']: candidate for candidate in plan}
+        with self.lock:
+            pinned_items = dict(self.pinned_items)
+        for path, item in pinned_items.items():
+            if item.get('auto') and path not in wanted:
+                try:
+                    self.unpin(path)
+                    lines.append(f"Auto-unpinned {path}")
+                except Exception as e:
+                    lines.append(f"Could not auto-unpin {path}: {e}")
+        for path, candidate in wanted.items():
+            if path in self.pinned_items:
+                continue
+            try:
+                # Flag it before the pin lock lets anybody else at the new pin
+                with self.pin_lock(str(Path(path).resolve())):
+                    if candidate['mode'] == 'overlay':
+                        self.pin_overlay(path)
+                    else:
+                        self.pin_move(path)
+                    self.mark_auto(path)
+                self.save_state()
+                lines.append(f"Auto-pinned {path} using {candidate['mode']}")
+            except Exception as e:
+                lines.append(f"Could not auto-pin {path}: {e}")
+        for line in lines:
+            print(line)
+        return lines
 
     def unpin(self, path):
         """Unpin file/directory and sync back to disk"""
         path = str(Path(path).resolve())
-        if path not in self.pinned_items:
-            raise Exception("Path is not pinned")
+        started = time.monotonic()
+        with self.pin_lock(path):
+            item = self.pinned_items.get(path)
+            if item is None:
+                raise Exception("Path is not pinned")
+            self.unpin_item(path, item)
+        self.metrics.observe('rampipe_unpin_duration_seconds', time.monotonic() - started, type=item['type'])
 
-        item = self.pinned_items[path]
-        
-        try:
-            # Unmount the bind mount
-            subprocess.run(['umount', path], check=True, capture_output=True)
-        except subprocess.CalledProcessError:
-            # Force unmount if regular fails
-            subprocess.run(['umount', '-f', path], check=True, capture_output=True)
+    def unpin_item(self, path, item):
+        """Tear a pin down and write it back. Caller holds its pin lock"""
+        # Stop filling RAM for a lazy pin first
+        if 'job_id' in item:
+            with self.jobs_lock:
+                job = self.jobs.get(item['job_id'])
+            if job is not None and job.state == 'running':
+                job.cancelled = True
+                job.thread.join()
+
+        if item['type'] == 'lock':
+            # Nothing mounted and nothing to write back
+            self.locker.release(path)
+        else:
+            self.release_left_on_disk(path, item.get('left_on_disk', []))
+            try:
+                # Unmount the bind mount
+                self.mounts.umount(path)
+            except subprocess.CalledProcessError:
+                # Force unmount if regular fails
+                self.mounts.umount(path, force=True)
 
         if item['type'] == 'move':
-            # Sync data back using rsync
+            # Write back whatever the journal still holds, then stop tracking
             temp_path = item['temp_path']
-            source = temp_path + '/' if Path(temp_path).is_dir() else temp_path
-            subprocess.run(['rsync', '-a', '--delete', source, path], check=True, capture_output=True)
+            self.sync_move_item(path, item)
+            self.tracker.unwatch(path)
+            self.block_map.drop(path)
+            if 'disk_path' in item:
+                self.release_disk_view(item['disk_path'])
             # Cleanup
             shutil.rmtree(temp_path) if Path(temp_path).is_dir() else os.remove(temp_path)
             
         elif item['type'] == 'overlay':
             # Additional cleanup for overlay
-            try:
-                subprocess.run(['umount', item['merged_dir']], capture_output=True)
-            except:
-                pass
-                
-            # Merge changes back using overlay-tools if available
-            try:
-                subprocess.run([
-                    'overlay', 'merge', '-f', '-l', path, '-u', item['upper_dir']
-                ], check=True, capture_output=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                # Fallback: manually copy changes
-                print("Warning: overlay-tools not found, using rsync fallback")
-                subprocess.run(['rsync', '-a', '--delete', 
-                              f"{item['upper_dir']}/", f"{path}/"], 
-                             capture_output=True)
-            
+            self.mounts.umount(item['merged_dir'], check=False)
+
+            # Merge what the checkpoints haven't flushed yet
+            if 'disk_path' in item:
+                self.checkpoint_overlay_item(path, item)
+                self.release_disk_view(item['disk_path'])
+            else:
+                # Pinned before checkpoints existed, the original is uncovered now so merge into it
+                self.checkpointer.checkpoint(item['upper_dir'], path, {})
+
             # Cleanup
+            self.tracker.unwatch(path)
+            self.block_map.drop(path)
+            if item.get('dedup'):
+                self.content_store(item.get('tier', 'tmpfs')).release(path, item['lower_dir'])
             shutil.rmtree(item['upper_dir'], ignore_errors=True)
             shutil.rmtree(item['work_dir'], ignore_errors=True)
             shutil.rmtree(item['merged_dir'], ignore_errors=True)
+            self.flushed_file(item).unlink(missing_ok=True)
+            self.overlay_flushed.pop(path, None)
 
-        del self.pinned_items[path]
+        with self.lock:
+            del self.pinned_items[path]
+        self.last_access.pop(path, None)
+        self.sizes.drop(path)
         self.save_state()
 
-    def run_sync(self):
-        """Perform sync of all pinned items to disk"""
+    def run_sync(self, background=False, tracked_only=False):
+        """
+        Perform sync of all pinned items to disk. Background syncs are rate
+        limited per device and leave files that are still being rewritten for later.
+        With tracked_only, pins that need a full sync are skipped
+        """
+        # One worker per disk: different disks are written to in parallel, one disk never
+        # gets two syncs fighting over it
         with self.lock:
-            for path, item in list(self.pinned_items.items()):
-                try:
-                    if item['type'] == 'move':
-                        temp_path = item['temp_path']
-                        source = temp_path + '/' if Path(temp_path).is_dir() else temp_path
-                        subprocess.run(['rsync', '-a', '--delete', source, path], 
-                                     capture_output=True)
-                    # Overlay items sync automatically through the filesystem
-                except Exception as e:
-                    print(f"Warning: Sync failed for {path}: {e}", file=sys.stderr)
+            pinned_items = dict(self.pinned_items)
+        devices = {}
+        for path, item in pinned_items.items():
+            devices.setdefault(self.pin_device(item), []).append(path)
+
+        started = time.monotonic()
+        written = []
+        workers = []
+        for device, paths in devices.items():
+            worker = threading.Thread(target=self.sync_device, args=(device, paths, background, written,
+                                                                    tracked_only),
+                                      name=f'rampipe-sync-{device}', daemon=True)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        kind = 'background' if background else 'full'
+        self.metrics.observe('rampipe_sync_duration_seconds', time.monotonic() - started, kind=kind)
+        self.metrics.inc('rampipe_sync_bytes_total', sum(written), kind=kind)
+
+    def sync_device(self, device, paths, background=False, written=None, tracked_only=False):
+        """Sync the pins of one disk, one after the other. Appends the bytes written to written"""
+        with self.device_lock(device):
+            for path in paths:
+                if background and self.writeback_cancelled:
+                    break
+                with self.pin_lock(path):
+                    # Unpinned while we waited, unpin wrote it back already
+                    item = self.pinned_items.get(path)
+                    if item is None:
+                        continue
+                    if tracked_only and self.tracker.wants_full(path):
+                        continue
+                    started = time.monotonic()
+                    try:
+                        if item['type'] == 'move':
+                            stats = self.sync_move_item(path, item, background)
+                        elif item['type'] == 'overlay':
+                            stats = self.checkpoint_overlay_item(path, item, background)
+                        else:
+                            if item['type'] == 'lock' and background:
+                                # Nothing to write, but files may have been added or replaced (updates)
+                                self.locker.lock_files(path, self.locker.scan(path, self.pin_filters(item)))
+                            continue
+                    except Exception as e:
+                        if background and self.writeback_cancelled:
+                            # Stopped for the shutdown flush, which writes it back itself
+                            break
+                        print(f"Warning: Sync failed for {path}: {e}", file=sys.stderr)
+                        continue
+                    self.metrics.observe('rampipe_pin_sync_duration_seconds', time.monotonic() - started, path=path)
+                    self.metrics.inc('rampipe_pin_sync_bytes_total', stats['bytes'], path=path)
+                    if written is not None:
+                        written.append(stats['bytes'])
 
     def get_status(self):
-        """Get current status information"""
+        """
+        Get current status information. Sizes come from the size index, so
+        this neither walks trees nor waits for a running sync
+        """
         with self.lock:
-            status = {
-                'pinned_items': {},
-                'total_count': len(self.pinned_items),
-                'memory_usage': {}
+            pinned_items = dict(self.pinned_items)
+        status = {
+            'pinned_items': {},
+            'total_count': len(pinned_items),
+            'memory_usage': {}
+        }
+
+        total_memory = 0
+        for path, item in pinned_items.items():
+            item_status = item.copy()
+            item_status['memory_usage'] = self.memory_usage(item)
+            item_status['last_access'] = self.pin_last_access(path)
+            item_status['ram_saved'] = self.ram_saved(item)
+            total_memory += item_status['memory_usage']
+            status['pinned_items'][path] = item_status
+
+        status['total_memory'] = total_memory
+        status['ram_saved'] = sum(item['ram_saved'] for item in status['pinned_items'].values())
+        status['warm_seconds'] = self.warm_seconds
+        status['readahead'] = self.readahead_stats
+        status['locked_bytes'] = self.locker.locked_bytes()
+        status['memlock_limit'] = self.memlock_limit()
+        status['filesystems'] = {}
+        locations = [self.config['ramdisk_path'], self.config.get('overlay_base', '/dev/shm/overlays')]
+        if self.zram_device:
+            locations.append(self.config.get('zram_path', '/mnt/rampipe-zram'))
+        for location in locations:
+            try:
+                st = os.statvfs(location)
+            except OSError:
+                continue
+            status['filesystems'][location] = {
+                'size': st.f_blocks * st.f_frsize,
+                'used': (st.f_blocks - st.f_bfree) * st.f_frsize,
+                'available': st.f_bavail * st.f_frsize
             }
-            
-            # Calculate memory usage (simplified - in production you'd use better methods)
-            total_memory = 0
-            for path, item in self.pinned_items.items():
-                item_status = item.copy()
-                
-                # Estimate memory usage
+        status['evicted'] = list(self.evicted)
+        status['orphans'] = list(self.orphans)
+
+        # What each tier holds, and what that costs after compression
+        status['tiers'] = {}
+        for tier in TIERS:
+            logical = sum(item['memory_usage'] for item in status['pinned_items'].values()
+                          if item['type'] != 'lock' and item.get('tier', 'tmpfs') == tier)
+            usage = {'logical_size': logical, 'compressed_size': logical, 'ratio': 1.0}
+            if tier == 'zram':
+                if not self.zram_device:
+                    continue
+                stats = self.mounts.zram_stats(self.zram_device)
+                if stats:
+                    usage = {'logical_size': logical, 'data_size': stats['data_size'],
+                             'compressed_size': stats['compressed_size'], 'mem_used': stats['mem_used'],
+                             'algorithm': stats['algorithm'], 'ratio': self.zram_ratio()}
+            status['tiers'][tier] = usage
+        return status
+
+    def memory_usage(self, item):
+        """How much RAM a pin takes, in allocated bytes"""
+        if item['type'] == 'lock':
+            return self.locker.locked_bytes(item['original_path'])
+        usage = self.sizes.total(item['original_path']) or 0
+        if item.get('dedup'):
+            # Its share of the store, on top of what it changed
+            usage += self.content_store(item.get('tier', 'tmpfs')).usage(item['original_path'])[1]
+        return usage
+
+    def ram_saved(self, item):
+        """How much RAM dedup saves a pin, against every file of it having its own copy"""
+        if not item.get('dedup'):
+            return 0
+        logical, share = self.content_store(item.get('tier', 'tmpfs')).usage(item['original_path'])
+        return logical - share
+
+    def note_change(self, pin, rel):
+        """Called by the tracker for every change in the RAM copy of a move pin or the upper dir of an overlay"""
+        self.sizes.mark(pin, rel)
+        self.metrics.inc('rampipe_ram_writes_total')
+
+    def collect_metrics(self):
+        """Update the gauges, then return the metrics"""
+        status = self.get_status()
+        metrics = self.metrics
+        for kind in ('move', 'overlay', 'lock'):
+            pins = [item for item in status['pinned_items'].values() if item['type'] == kind]
+            metrics.set('rampipe_pins', len(pins), type=kind)
+            metrics.set('rampipe_pinned_bytes', sum(item['memory_usage'] for item in pins), type=kind)
+        for location, usage in status['filesystems'].items():
+            metrics.set('rampipe_ram_used_bytes', usage['used'], location=location)
+            metrics.set('rampipe_ram_size_bytes', usage['size'], location=location)
+        metrics.set('rampipe_dirty_bytes', self.dirty_bytes())
+
+        # Without the pin, every change would have been a write to disk. What actually went to
+        # disk is one write per flushed file, so the difference never reached it. inotify doesn't
+        # say how big a write was, so there is no honest number for bytes, the flushed bytes are
+        # next to it for comparison
+        writes = metrics.get('rampipe_ram_writes_total')
+        flushed = sum(metrics.get('rampipe_flushed_files_total', type=kind) for kind in ('move', 'overlay'))
+        metrics.set('rampipe_disk_writes_avoided', max(0, writes - flushed))
+        return metrics
+
+    def metrics_text(self):
+        return self.collect_metrics().prometheus()
+
+    def format_stats(self):
+        """The metrics for people, for rampipe stats"""
+        snapshot = self.collect_metrics().snapshot()
+
+        def series(name):
+            return snapshot.get(name, [])
+
+        def value(name, **labels):
+            return sum(s['value'] for s in series(name)
+                       if all(s['labels'].get(k) == str(v) for k, v in labels.items()))
+
+        def timing(entry):
+            return f"{entry['count']} times, avg {entry['sum'] / entry['count'] * 1000:.1f} ms"
+
+        mb = 1024 * 1024
+        lines = ["RamPipe Stats:"]
+        if series('rampipe_time_to_warm_seconds'):
+            lines.append(f"Time to warm: {value('rampipe_time_to_warm_seconds'):.2f} s")
+        for entry in series('rampipe_sync_duration_seconds'):
+            kind = entry['labels']['kind']
+            lines.append(f"Syncs ({kind}): {timing(entry)}, "
+                         f"{value('rampipe_sync_bytes_total', kind=kind) / mb:.2f} MB written")
+        for name, label in (('rampipe_pin_duration_seconds', 'Pin'), ('rampipe_unpin_duration_seconds', 'Unpin')):
+            for entry in series(name):
+                lines.append(f"{label} ({list(entry['labels'].values())[0]}): {timing(entry)}")
+        lines.append(f"Copied into RAM by pinning: {value('rampipe_pin_bytes_total') / mb:.2f} MB")
+        lines.append(f"RAM used by pins: {value('rampipe_pinned_bytes') / mb:.2f} MB "
+                     f"({value('rampipe_pins'):.0f} pins)")
+        for entry in series('rampipe_ram_used_bytes'):
+            location = entry['labels']['location']
+            lines.append(f"  {location}: {entry['value'] / mb:.2f} of "
+                         f"{value('rampipe_ram_size_bytes', location=location) / mb:.2f} MB used")
+        lines.append(f"Waiting to be written back: {value('rampipe_dirty_bytes') / mb:.2f} MB")
+        lines.append(f"Written to disk: {value('rampipe_flushed_bytes_total') / mb:.2f} MB in "
+                     f"{value('rampipe_flushed_files_total'):.0f} files")
+        lines.append(f"Disk writes avoided (estimate): {value('rampipe_disk_writes_avoided'):.0f} of "
+                     f"{value('rampipe_ram_writes_total'):.0f} writes to RAM")
+        requests = series('rampipe_request_duration_seconds')
+        if requests:
+            lines.append("Requests:")
+            for entry in sorted(requests, key=lambda s: s['labels']['action']):
+                lines.append(f"  {entry['labels']['action']}: {timing(entry)}")
+        return '\n'.join(lines)
+
+    def start_metrics_listener(self):
+        """Serve the metrics for Prometheus on metrics_listen, host:port or unix:/path"""
+        listen = str(self.config.get('metrics_listen', '')).strip()
+        if not listen:
+            return
+        try:
+            if listen.startswith('unix:'):
+                socket_path = listen[len('unix:'):]
                 try:
-                    if item['type'] == 'move':
-                        temp_path = Path(item['temp_path'])
-                        if temp_path.exists():
-                            if temp_path.is_file():
-                                size = temp_path.stat().st_size
-                            else:
-                                size = sum(f.stat().st_size for f in temp_path.rglob('*') if f.is_file())
-                            item_status['memory_usage'] = size
-                            total_memory += size
-                    elif item['type'] == 'overlay':
-                        upper_dir = Path(item['upper_dir'])
-                        if upper_dir.exists():
-                            size = sum(f.stat().st_size for f in upper_dir.rglob('*') if f.is_file())
-                            item_status['memory_usage'] = size
-                            total_memory += size
-                except:
-                    item_status['memory_usage'] = 0
-                
-                status['pinned_items'][path] = item_status
-            
-            status['total_memory'] = total_memory
-            return status
+                    os.unlink(socket_path)
+                except FileNotFoundError:
+                    pass
+                server = UnixHTTPServer(socket_path, MetricsHandler)
+            else:
+                host, _, port = listen.rpartition(':')
+                server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+        except Exception as e:
+            print(f"Warning: Could not serve metrics on {listen}: {e}", file=sys.stderr)
+            return
+        server.rampipe = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on {listen}")
+
+    def execute(self, command):
+        """Run one command from a client and return the response"""
+        action = command.get('action')
+        response = {'status': 'success', 'message': ''}
+        started = time.monotonic()
 
-    def handle_client(self, client_socket):
-        """Handle a client connection"""
         try:
-            # Receive command
-            data = b""
-            while True:
-                chunk = client_socket.recv(4096)
-                if not chunk:
-                    break
-                data += chunk
-            
-            if not data:
-                return
-                
-            command = json.loads(data.decode('utf-8'))
-            action = command.get('action')
-            
-            response = {'status': 'success', 'message': ''}
-            
-            try:
-                if action == 'pin':
-                    path = command['path']
-                    mode = command.get('mode', 'move')
-                    
-                    if mode == 'overlay':
-                        self.pin_overlay(path)
-                        response['message'] = f"Pinned {path} using overlay"
-                    else:
-                        self.pin_move(path)
-                        response['message'] = f"Pinned {path} using move"
-                        
-                elif action == 'unpin':
-                    path = command['path']
-                    self.unpin(path)
-                    response['message'] = f"Unpinned {path}"
-                    
-                elif action == 'status':
-                    status = self.get_status()
-                    # Format status output
-                    lines = ["RamPipe Status:", f"Total pinned items: {status['total_count']}"]
-                    lines.append(f"Total memory used: {status['total_memory'] / 1024 / 1024:.2f} MB")
-                    lines.append("\nPinned items:")
-                    
-                    for path, item in status['pinned_items'].items():
-                        mem_mb = item.get('memory_usage', 0) / 1024 / 1024
-                        lines.append(f"  {path} ({item['type']}) - {mem_mb:.2f} MB")
-                    
-                    response['message'] = '\n'.join(lines)
-                    response['status_data'] = status
-                    
-                elif action == 'sync':
-                    self.run_sync()
-                    response['message'] = "Sync completed"
+            if action == 'pin':
+                path = command['path']
+                mode = command.get('mode', 'move')
+                tier = command.get('tier') or 'tmpfs'
+                on_tier = f" on {tier}" if tier != 'tmpfs' else ""
+                filters = make_filters(command.get('include'), command.get('exclude'), command.get('max_file_size'))
+                if filters and (command.get('lazy') or command.get('dedup')):
+                    raise Exception("Filters don't work with lazy and dedup pins, those take the whole directory")
+                if mode == 'lock' and tier != 'tmpfs':
+                    raise Exception("Lock pins stay in the page cache, they can't go on a tier")
+
+                if command.get('dedup'):
+                    if command.get('lazy'):
+                        raise Exception("Dedup pins are copied up front, they can't be lazy")
+                    copied = self.pin_overlay(path, tier, dedup=True)
+                    response['message'] = (f"Pinned {path} with dedup{on_tier}, "
+                                           f"{copied['deduped'] / 1024 / 1024:.2f} of "
+                                           f"{copied['bytes'] / 1024 / 1024:.2f} MB were in RAM already")
+                elif mode == 'lock':
+                    locked = self.pin_mlock(path, filters)
+                    response['message'] = (f"Pinned {path} by locking {locked['files']} files "
+                                           f"({locked['bytes'] / 1024 / 1024:.2f} MB) in the page cache")
+                elif command.get('lazy'):
+                    job = self.pin_lazy(path, tier)
+                    response['message'] = (f"Pinned {path} lazily{on_tier}, filling RAM in the background "
+                                           f"(job {job.job_id})")
+                    response['job_id'] = job.job_id
+                elif mode == 'overlay' or filters:
+                    # A selective pin is always an overlay
+                    self.pin_overlay(path, tier, filters=filters)
+                    response['message'] = f"Pinned {path} using overlay{on_tier}"
+                    if filters:
+                        response['message'] += f", {self.pinned_items[str(Path(path).resolve())]['files']} files in RAM"
+                else:
+                    self.pin_move(path, tier)
+                    response['message'] = f"Pinned {path} using move{on_tier}"
+                self.set_pin_priority(path, int(command.get('priority') or 0))
                     
+            elif action == 'unpin':
+                path = command['path']
+                self.unpin(path)
+                response['message'] = f"Unpinned {path}"
+                
+            elif action == 'status':
+                status = self.get_status()
+                # Format status output
+                lines = ["RamPipe Status:", f"Total pinned items: {status['total_count']}"]
+                lines.append(f"Total memory used: {status['total_memory'] / 1024 / 1024:.2f} MB")
+                if status['ram_saved']:
+                    lines.append(f"Saved by dedup: {status['ram_saved'] / 1024 / 1024:.2f} MB")
+                if status['warm_seconds'] is not None:
+                    line = f"Warm after {status['warm_seconds']:.2f} s"
+                    if status['readahead']:
+                        line += (f" (readahead of {status['readahead']['bytes'] / 1024 / 1024:.2f} MB in "
+                                 f"{status['readahead']['files']} files took {status['readahead']['seconds']:.2f} s)")
+                    lines.append(line)
                 else:
+                    lines.append("Still warming up")
+                if status['locked_bytes']:
+                    limit = status['memlock_limit']
+                    lines.append(f"Locked in the page cache: {status['locked_bytes'] / 1024 / 1024:.2f} MB "
+                                 f"(limit {'none' if limit is None else f'{limit / 1024 / 1024:.2f} MB'})")
+                for location, usage in status['filesystems'].items():
+                    lines.append(f"  {location}: {usage['used'] / 1024 / 1024:.2f} of "
+                                 f"{usage['size'] / 1024 / 1024:.2f} MB used")
+                lines.append("\nPinned items:")
+                
+                for path, item in status['pinned_items'].items():
+                    mem_mb = item.get('memory_usage', 0) / 1024 / 1024
+                    kind = item['type'] + (', dedup' if item.get('dedup') else '')
+                    kind += ', zram' if item.get('tier') == 'zram' else ''
+                    line = f"  {path} ({kind}) - {mem_mb:.2f} MB"
+                    if item.get('ram_saved'):
+                        line += f", {item['ram_saved'] / 1024 / 1024:.2f} MB saved by dedup"
+                    if item.get('priority'):
+                        line += f", priority {item['priority']}"
+                    if item['type'] == 'lock':
+                        line += " locked"
+                    filters = self.pin_filters(item)
+                    if filters:
+                        line += f" - {self.format_filters(filters)}"
+                        if 'files' in item:
+                            line += f", {item['files']} files pinned"
+                    if item.get('lazy') and not item.get('populated'):
+                        line += f" - filling RAM (job {item.get('job_id')})"
+                    lines.append(line)
+
+                lines.append("\nTiers:")
+                for tier, usage in status['tiers'].items():
+                    line = f"  {tier}: {usage['logical_size'] / 1024 / 1024:.2f} MB"
+                    if 'mem_used' in usage:
+                        line += (f" logical, {usage['compressed_size'] / 1024 / 1024:.2f} MB compressed with "
+                                 f"{usage['algorithm']} ({usage['ratio']:.2f}x), "
+                                 f"{usage['mem_used'] / 1024 / 1024:.2f} MB of RAM used")
+                    lines.append(line)
+
+                if status['orphans']:
+                    lines.append("\nOrphaned in RAM (belongs to no pin, may hold changes that never made it "
+                                 "to disk, check and delete by hand):")
+                    for orphan in status['orphans']:
+                        line = f"  {orphan['path']}"
+                        if orphan['size'] is not None:
+                            line += f" - {orphan['size'] / 1024 / 1024:.2f} MB"
+                        if orphan['note']:
+                            line += f" ({orphan['note']})"
+                        lines.append(line)
+
+                if status['evicted']:
+                    lines.append("\nEvicted (re-pinned once there is room):")
+                    for record in status['evicted']:
+                        lines.append(f"  {record['path']} ({record['mode']}) - "
+                                     f"{record['size'] / 1024 / 1024:.2f} MB")
+                
+                response['message'] = '\n'.join(lines)
+                response['status_data'] = status
+                
+            elif action == 'sync':
+                self.run_sync()
+                response['message'] = "Sync completed"
+
+            elif action == 'profile':
+                job = self.start_profile(command.get('duration'), command.get('top_n'),
+                                         command.get('apply', False))
+                response['message'] = f"Profiling disk I/O (job {job.job_id})"
+                response['job_id'] = job.job_id
+
+            elif action == 'jobs':
+                with self.jobs_lock:
+                    jobs = [job.to_dict() for job in self.jobs.values()]
+                lines = [self.format_job(job) for job in jobs] or ["No jobs"]
+                response['message'] = '\n'.join(lines)
+                response['jobs'] = jobs
+
+            elif action == 'job':
+                job = self.get_job(command['job_id']).to_dict()
+                response['message'] = self.format_job(job)
+                response['job'] = job
+                
+            elif action == 'stats':
+                response['message'] = self.format_stats()
+                response['metrics'] = self.collect_metrics().snapshot()
+
+            elif action == 'batch':
+                # Each command gets its own response, one failing doesn't stop the rest
+                responses = [self.execute(sub) if sub.get('action') != 'batch'
+                             else {'status': 'error', 'message': "Batches can't be nested"}
+                             for sub in command.get('commands', [])]
+                failed = sum(1 for sub in responses if sub['status'] != 'success')
+                if failed:
                     response['status'] = 'error'
-                    response['message'] = f"Unknown action: {action}"
-                    
-            except Exception as e:
+                response['message'] = '\n'.join(sub['message'] for sub in responses if sub['message'])
+                response['responses'] = responses
+
+            else:
                 response['status'] = 'error'
-                response['message'] = str(e)
-                
-            # Send response
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            
+                response['message'] = f"Unknown action: {action}"
+                # Don't let made up actions grow the list of series
+                action = 'unknown'
+
+        except Exception as e:
+            response['status'] = 'error'
+            response['message'] = str(e)
+
+        self.metrics.observe('rampipe_request_duration_seconds', time.monotonic() - started, action=action)
+        return response
+
+    @staticmethod
+    def format_filters(filters):
+        parts = [f"include {', '.join(filters['include'])}"] if filters.get('include') else []
+        if filters.get('exclude'):
+            parts.append(f"exclude {', '.join(filters['exclude'])}")
+        if filters.get('max_file_size'):
+            parts.append(f"files up to {filters['max_file_size'] / 1024 / 1024:.2f} MB")
+        return '; '.join(parts)
+
+    def format_job(self, job):
+        """One line of job progress for the CLI"""
+        line = f"job {job['job_id']} {job['kind']} {job['path']}: {job['state']}"
+        if job['bytes_total']:
+            line += f", {job['bytes_done'] / 1024 / 1024:.1f}/{job['bytes_total'] / 1024 / 1024:.1f} MB"
+        unit = 'samples' if job['kind'] == 'profile' else 'files'
+        line += f", {job['files_remaining']} {unit} remaining"
+        if job['eta'] is not None:
+            line += f", ETA {job['eta']:.0f}s"
+        if job['error']:
+            line += f" ({job['error']})"
+        if job['summary'] and job['state'] != 'running':
+            line += '\n' + job['summary']
+        return line
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handle a client connection. Clients send frames of a 4-byte big-endian
+        length followed by a JSON request, as many as they like, without
+        waiting for responses. Each request is answered by one frame carrying
+        the request's 'id', or by a series of frames with 'stream': true
+        followed by a last one with 'stream': false. Old clients that send a
+        single bare JSON request and shut down their side get a bare answer
+        """
+        write_lock = asyncio.Lock()
+        tasks = set()
+        cancelled = False
+        connection = asyncio.current_task()
+        self.connections.add(connection)
+        try:
+            first = await reader.read(1)
+            if not first:
+                return
+
+            if first == b'{':
+                data = first + await reader.read()
+                try:
+                    response = await self.run_command(json.loads(data.decode('utf-8')))
+                except ValueError as e:
+                    response = {'status': 'error', 'message': f'Internal error: {str(e)}'}
+                writer.write(json.dumps(response).encode('utf-8'))
+                await writer.drain()
+                return
+
+            header = first + await reader.readexactly(FRAME_HEADER.size - 1)
+            while True:
+                (length,) = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    print(f"Warning: Dropping client that sent a {length} byte frame", file=sys.stderr)
+                    return
+                payload = await reader.readexactly(length)
+                # Requests run side by side, a slow pin doesn't hold up a status behind it
+                task = asyncio.ensure_future(self.serve_request(payload, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                header = await reader.readexactly(FRAME_HEADER.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # We are stopping, don't wait for streams that only end when the client goes away
+            cancelled = True
         except Exception as e:
-            error_response = json.dumps({
-                'status': 'error', 
-                'message': f'Internal error: {str(e)}'
-            })
-            client_socket.send(error_response.encode('utf-8'))
+            print(f"Socket error: {e}", file=sys.stderr)
         finally:
-            client_socket.close()
+            if tasks:
+                if cancelled:
+                    for task in tasks:
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            self.connections.discard(connection)
+
+    async def serve_request(self, payload, writer, write_lock):
+        """Answer one framed request"""
+        try:
+            command = json.loads(payload.decode('utf-8'))
+        except ValueError as e:
+            command = {}
+            response = {'status': 'error', 'message': f'Internal error: {str(e)}'}
+        request_id = command.get('id')
+
+        async def send(response):
+            if request_id is not None:
+                response['id'] = request_id
+            data = json.dumps(response).encode('utf-8')
+            async with write_lock:
+                writer.write(FRAME_HEADER.pack(len(data)) + data)
+                await writer.drain()
+
+        if not command:
+            await send(response)
+        elif command.get('stream') and command.get('action') == 'job':
+            await self.stream_job(command, send)
+        else:
+            await send(await self.run_command(command))
+
+    async def run_command(self, command):
+        """Run a command on the request threads, the blocking work must not stall the event loop"""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.request_pool, self.execute, command)
+        except Exception as e:
+            return {'status': 'error', 'message': f'Internal error: {str(e)}'}
+
+    async def stream_job(self, command, send):
+        """Send progress events of a job every second until it is done"""
+        while True:
+            try:
+                job = self.get_job(command['job_id']).to_dict()
+            except Exception as e:
+                await send({'status': 'error', 'message': str(e), 'stream': False})
+                return
+            running = job['state'] == 'running'
+            await send({'status': 'success', 'message': self.format_job(job), 'job': job, 'stream': running})
+            if not running:
+                return
+            await asyncio.sleep(1)
+
+    async def serve(self):
+        server = await asyncio.start_unix_server(self.handle_connection, path=self.socket_path,
+                                                 backlog=SOCKET_BACKLOG)
+        os.chmod(self.socket_path, 0o666)  # Allow non-root users to connect
+
+        print(f"Socket server started at {self.socket_path}")
+        # Only now can clients reach us, systemd hears about it after the critical pins are up
+        threading.Thread(target=self.report_ready, daemon=True).start()
+
+        async with server:
+            while self.running:
+                await asyncio.sleep(1)  # Allow checking self.running
+            # Leaving waits for every client to go, and a stats --watch or jobs --follow never does
+            for connection in list(self.connections):
+                connection.cancel()
 
     def start_socket_server(self):
         """Start the UNIX socket server"""
@@ -361,65 +4378,497 @@ class RamPipeDaemon:
         
         # Create socket directory
         Path(self.socket_path).parent.mkdir(parents=True, exist_ok=True)
-        
-        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        server.bind(self.socket_path)
-        server.listen(5)
-        os.chmod(self.socket_path, 0o666)  # Allow non-root users to connect
-        
-        print(f"Socket server started at {self.socket_path}")
-        
-        while self.running:
-            try:
-                server.settimeout(1)  # Allow checking self.running
-                client, addr = server.accept()
-                # Handle client in a thread
-                client_thread = threading.Thread(target=self.handle_client, args=(client,))
-                client_thread.daemon = True
-                client_thread.start()
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:
-                    print(f"Socket error: {e}", file=sys.stderr)
-        
-        server.close()
+
+        asyncio.run(self.serve())
 
     def start_periodic_sync(self):
-        """Start periodic sync thread"""
+        """
+        Start periodic sync thread. It writes back once sync_interval has
+        passed or once writeback_dirty_bytes have piled up, whatever comes first
+        """
         def sync_loop():
+            if self.config_flag('writeback_idle_priority', 'yes'):
+                set_idle_io_priority()
+            interval = float(self.config.get('sync_interval', 300))
+            threshold = parse_size(self.config.get('writeback_dirty_bytes', '64M'))
+            check_interval = min(interval, float(self.config.get('writeback_check_interval', 5)))
+            last_sync = time.time()
             while self.running:
-                time.sleep(self.config.get('sync_interval', 300))
+                time.sleep(check_interval)
                 try:
-                    self.run_sync()
+                    # Pins without a journal (lock pins, or ones that ran out of watches) or with a
+                    # lost one only get synced every sync_interval, the threshold can't see their changes
+                    due = time.time() - last_sync >= interval
+                    if not due and (not threshold or self.dirty_bytes(tracked_only=True) < threshold):
+                        continue
+                    with self.background_sync_lock:
+                        if not self.running:
+                            break
+                        self.run_sync(background=True, tracked_only=not due)
+                    if due:
+                        last_sync = time.time()
                 except Exception as e:
                     print(f"Periodic sync error: {e}", file=sys.stderr)
         
         sync_thread = threading.Thread(target=sync_loop, daemon=True)
         sync_thread.start()
 
+    def pin_last_access(self, path):
+        """When a pin was last used, as far as we could tell"""
+        return max(self.last_access.get(path, 0), self.tracker.last_event.get(path, 0))
+
+    def note_open_files(self):
+        """Count pins that have files open in some process as used right now"""
+        with self.lock:
+            roots = {path.rstrip('/') + '/': path for path in self.pinned_items}
+        now = time.time()
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                fds = os.listdir(f'/proc/{pid}/fd')
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(f'/proc/{pid}/fd/{fd}')
+                except OSError:
+                    continue
+                for root, path in roots.items():
+                    if target.startswith(root) or target == path:
+                        self.last_access[path] = now
+
+    def ram_usage(self, path):
+        """Percentage of the filesystem at path that is in use"""
+        try:
+            st = os.statvfs(path)
+        except OSError:
+            return 0
+        if not st.f_blocks:
+            return 0
+        usage = 100 * (st.f_blocks - st.f_bfree) / st.f_blocks
+        if self.zram_device and path == self.config.get('zram_path', '/mnt/rampipe-zram'):
+            # The filesystem size is what fits uncompressed, what counts is the RAM the compressed
+            # data takes, against the memory limit (or the size, if there is no limit)
+            stats = self.mounts.zram_stats(self.zram_device)
+            limit = parse_size(self.config.get('zram_mem_limit', 0)) or parse_size(self.config.get('zram_size', '2G'))
+            if stats and limit:
+                usage = max(usage, 100 * stats['mem_used'] / limit)
+        return usage
+
+    def memory_pressure(self):
+        """The 'some avg10' memory pressure in percent, None if the kernel has no PSI"""
+        try:
+            with open('/proc/pressure/memory', 'r') as f:
+                for line in f:
+                    if line.startswith('some'):
+                        fields = dict(part.split('=') for part in line.split()[1:])
+                        return float(fields['avg10'])
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def pin_location(self, item):
+        """The RAM filesystem a pin lives on, None for lock pins, which live in the page cache"""
+        if item['type'] == 'lock':
+            return None
+        if item.get('tier') == 'zram':
+            return self.config.get('zram_path', '/mnt/rampipe-zram')
+        if item['type'] == 'overlay':
+            return self.config.get('overlay_base', '/dev/shm/overlays')
+        return self.config['ramdisk_path']
+
+    def zram_ratio(self):
+        """How well the zram tier compresses, 1 while it holds nothing"""
+        stats = self.mounts.zram_stats(self.zram_device) if self.zram_device else None
+        if not stats or not stats['compressed_size']:
+            return 1.0
+        return stats['data_size'] / stats['compressed_size']
+
+    def check_budget(self):
+        """
+        Demote the least recently used pins while a RAM filesystem is above the
+        high watermark (until it is below the low one) or memory pressure is
+        high, and re-pin demoted ones once there is room again
+        """
+        high = float(self.config.get('budget_high_watermark', 90))
+        low = float(self.config.get('budget_low_watermark', 75))
+        psi_high = float(self.config.get('budget_psi_high', 10))
+        psi_low = float(self.config.get('budget_psi_low', 2))
+        never_evict = {str(Path(p.strip().strip('"')).resolve())
+                       for p in str(self.config.get('never_evict', '')).split(',') if p.strip().strip('"')}
+
+        self.note_open_files()
+        locations = {self.config['ramdisk_path'], self.config.get('overlay_base', '/dev/shm/overlays')}
+        if self.zram_device:
+            locations.add(self.config.get('zram_path', '/mnt/rampipe-zram'))
+        pressure = self.memory_pressure()
+
+        # Filesystems over the high watermark get drained down to the low one
+        for location in locations:
+            if self.ram_usage(location) < high:
+                continue
+            print(f"RAM filesystem {location} is {self.ram_usage(location):.0f}% full, evicting pins")
+            while self.ram_usage(location) >= low:
+                if not self.evict_coldest(never_evict, location):
+                    print(f"Warning: Nothing left to evict from {location}", file=sys.stderr)
+                    break
+
+        # Memory pressure drops slowly, so just one pin per check
+        if pressure is not None and pressure >= psi_high:
+            print(f"Memory pressure at {pressure:.1f}%, evicting a pin")
+            self.evict_coldest(never_evict)
+            return
+
+        if pressure is not None and pressure > psi_low:
+            return
+        self.repin_evicted(low)
+
+    def evict_coldest(self, never_evict, location=None):
+        """Sync and unpin the pin that was used least recently. Returns False if there was none"""
+        with self.lock:
+            pinned_items = dict(self.pinned_items)
+        candidates = [path for path, item in pinned_items.items()
+                      if path not in never_evict
+                      and (location is None or self.pin_location(item) == location)]
+        if not candidates:
+            return False
+        path = min(candidates, key=self.pin_last_access)
+        item = pinned_items[path]
+        record = {
+            'path': path,
+            'mode': item['type'],
+            'tier': item.get('tier', 'tmpfs'),
+            'lazy': item.get('lazy', False),
+            'dedup': item.get('dedup', False),
+            'filters': self.pin_filters(item),
+            'priority': item.get('priority', 0),
+            'auto': item.get('auto', False),
+            'size': self.memory_usage(item),
+            'evicted_at': time.time()
+        }
+        try:
+            self.unpin(path)
+        except Exception as e:
+            print(f"Warning: Could not evict {path}: {e}", file=sys.stderr)
+            return False
+        print(f"Evicted {path} ({record['size'] / 1024 / 1024:.2f} MB)")
+        self.evicted.append(record)
+        self.save_evicted()
+        return True
+
+    def repin_evicted(self, low):
+        """Re-pin the pin evicted first, if it fits below the low watermark again"""
+        delay = float(self.config.get('budget_repin_delay', 300))
+        for record in list(self.evicted):
+            if time.time() - record['evicted_at'] < delay:
+                continue
+            if record['path'] in self.pinned_items or not os.path.exists(record['path']):
+                self.evicted.remove(record)
+                self.save_evicted()
+                continue
+            tier = record.get('tier', 'tmpfs')
+            location = self.pin_location({'type': record['mode'], 'tier': tier})
+            size = record['size']
+            if tier == 'zram':
+                if not self.zram_device:
+                    self.setup_zram()
+                # It will take about as much as the rest compresses to
+                size /= self.zram_ratio()
+            # Lock pins don't fill a filesystem, low memory pressure is all they need
+            st = os.statvfs(location) if location else None
+            if st and st.f_blocks and (self.ram_usage(location) + 100 * size / (st.f_blocks * st.f_frsize)) >= low:
+                continue
+            try:
+                with self.pin_lock(record['path']):
+                    if record['mode'] == 'lock':
+                        self.pin_mlock(record['path'], record.get('filters'))
+                    elif record['lazy']:
+                        self.pin_lazy(record['path'], tier)
+                    elif record['mode'] == 'overlay':
+                        self.pin_overlay(record['path'], tier, dedup=record.get('dedup', False),
+                                         filters=record.get('filters'))
+                    else:
+                        self.pin_move(record['path'], tier)
+                    if record['auto']:
+                        self.mark_auto(record['path'])
+                self.set_pin_priority(record['path'], record.get('priority', 0))
+                self.save_state()
+                print(f"Re-pinned {record['path']}")
+            except Exception as e:
+                print(f"Warning: Could not re-pin {record['path']}: {e}", file=sys.stderr)
+            self.evicted.remove(record)
+            self.save_evicted()
+            # One at a time, so we see what it does to memory before the next one
+            return
+
+    def start_budget_manager(self):
+        """Start the thread that keeps pins within the RAM budget"""
+        def budget_loop():
+            while self.running:
+                time.sleep(self.config.get('budget_check_interval', 10))
+                try:
+                    self.check_budget()
+                except Exception as e:
+                    print(f"Budget check error: {e}", file=sys.stderr)
+
+        budget_thread = threading.Thread(target=budget_loop, daemon=True)
+        budget_thread.start()
+
+    def start_autopin(self):
+        """Start the thread that re-profiles and re-plans auto pins every autopin_interval"""
+        def autopin_loop():
+            while self.running:
+                job = self.start_profile(apply=True)
+                job.thread.join()
+                time.sleep(self.config.get('autopin_interval', 3600))
+
+        autopin_thread = threading.Thread(target=autopin_loop, daemon=True)
+        autopin_thread.start()
+
     def signal_handler(self, signum, frame):
-        """Handle shutdown signals"""
+        """Handle shutdown signals. The writing back happens in the main loop once the server stopped"""
         print("Shutting down RamPipe daemon...")
         self.running = False
-        self.run_sync()  # Final sync
+
+    def systemd_unit(self):
+        """The service systemd runs us as, None if it didn't start us"""
+        if 'INVOCATION_ID' not in os.environ:
+            return None
+        try:
+            with open('/proc/self/cgroup', 'r') as f:
+                for line in f:
+                    name = line.strip().rsplit('/', 1)[-1]
+                    if name.endswith('.service'):
+                        return name
+        except OSError:
+            pass
+        return None
+
+    def learn_stop_timeout(self):
+        """
+        How many seconds we get to write back once told to stop, None for as long as it
+        takes. shutdown_timeout if set, else TimeoutStopSec of our unit. Asked at start,
+        systemd has better things to do than answer us while the machine goes down
+        """
+        configured = self.config.get('shutdown_timeout', 'auto')
+        if str(configured).strip('"') == 'auto':
+            unit = self.systemd_unit()
+            # What systemd gives a unit that doesn't say
+            configured = '90s'
+            if unit:
+                try:
+                    configured = subprocess.run(['systemctl', 'show', '--property=TimeoutStopUSec', '--value', unit],
+                                                capture_output=True, text=True, timeout=5, check=True).stdout
+                except (subprocess.SubprocessError, OSError) as e:
+                    print(f"Warning: Could not ask systemd for the stop timeout of {unit}: {e}", file=sys.stderr)
+        try:
+            timeout = parse_timespan(configured)
+        except ValueError as e:
+            print(f"Warning: {e}, using 90 s", file=sys.stderr)
+            timeout = 90.0
+        # Like TimeoutStopSec, 0 means no limit
+        return timeout or None
+
+    def system_stopping(self):
+        """Whether the whole machine is going down, not just us (a restart for an upgrade, say)"""
+        if self.systemd_unit() is None:
+            return False
+        try:
+            state = subprocess.run(['systemctl', 'is-system-running'], capture_output=True, text=True,
+                                   timeout=2).stdout.strip()
+        except (subprocess.SubprocessError, OSError):
+            return False
+        return state == 'stopping'
+
+    def plan_shutdown_flush(self):
+        """
+        The pins that still have something to write back, grouped by the disk they go
+        to. On every disk the highest priority goes first, then the most dirty bytes
+        """
+        with self.lock:
+            pinned_items = dict(self.pinned_items)
+        plan = {}
+        for path, item in pinned_items.items():
+            try:
+                changes, dirty = self.pin_pending(path, item)
+            except Exception as e:
+                # Can't tell, better write it back for nothing than not at all
+                print(f"Warning: Could not tell what is dirty in {path}: {e}", file=sys.stderr)
+                changes, dirty = 1, self.memory_usage(item)
+            if not changes:
+                continue
+            plan.setdefault(self.pin_device(item), []).append(
+                {'path': path, 'type': item['type'], 'priority': item.get('priority', 0), 'bytes': dirty})
+        for pins in plan.values():
+            pins.sort(key=lambda pin: (-pin['priority'], -pin['bytes']))
+        return plan
+
+    def shutdown_flush(self):
+        """
+        Write back every dirty pin before systemd kills us. Disks are written to in
+        parallel, each one pin at a time in plan order, and nothing new is started
+        once the deadline has passed. Returns the pins that didn't make it
+        """
+        started = time.monotonic()
+        margin = float(self.config.get('shutdown_margin', 5))
+        extend = float(self.config.get('shutdown_extend', 0))
+        deadline = None
+        if self.stop_timeout is not None:
+            deadline = started + max(self.stop_timeout - margin, 0) + extend
+        notify_systemd("STOPPING=1\nSTATUS=Writing back")
+
+        def wait_for(lock):
+            # Waiting counts against the deadline too
+            if deadline is None:
+                return lock.acquire()
+            return lock.acquire(timeout=max(deadline - time.monotonic(), 0))
+
+        # A background sync holds the disks with throttled copies in the idle I/O class. Make it
+        # give up at its next write and wait for that, it puts back what it didn't get to, so
+        # the plan sees it as dirty
+        self.cancel_writeback()
+        while True:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                print("Warning: The background sync didn't stop before the deadline", file=sys.stderr, flush=True)
+                break
+            if self.background_sync_lock.acquire(timeout=1 if deadline is None else min(1, deadline - now)):
+                self.background_sync_lock.release()
+                break
+            if extend:
+                notify_systemd(f"EXTEND_TIMEOUT_USEC={int((deadline - now + margin) * 1000000)}")
+
+        plan = self.plan_shutdown_flush()
+        pins = [pin for device_pins in plan.values() for pin in device_pins]
+        if not pins:
+            print("Nothing to write back")
+            return []
+        print(f"Writing back {len(pins)} pins ({sum(pin['bytes'] for pin in pins) / 1024 / 1024:.2f} MB) "
+              f"to {len(plan)} disks" + (f", {deadline - started:.0f} s until the deadline" if deadline else ""),
+              flush=True)
+        state = {pin['path']: 'not started' for pin in pins}
+
+        def flush_pin(path):
+            """Write back one pin, None if it is gone"""
+            item = self.pinned_items.get(path)
+            if item is None:
+                return None
+            state[path] = 'writing'
+            if item['type'] == 'move':
+                return self.sync_move_item(path, item)
+            return self.checkpoint_overlay_item(path, item)
+
+        def flush_device(device, device_pins):
+            device_lock = self.device_lock(device)
+            if not wait_for(device_lock):
+                return
+            try:
+                for pin in device_pins:
+                    path = pin['path']
+                    pin_lock = self.pin_lock(path)
+                    if (deadline is not None and time.monotonic() >= deadline) or not wait_for(pin_lock):
+                        return
+                    pin_started = time.monotonic()
+                    try:
+                        stats = flush_pin(path)
+                    except Exception as e:
+                        state[path] = 'failed'
+                        print(f"Warning: Could not write back {path}: {e}", file=sys.stderr, flush=True)
+                        continue
+                    finally:
+                        pin_lock.release()
+                    state[path] = 'done'
+                    if stats is None:
+                        # Unpinned while we waited, unpin wrote it back already
+                        continue
+                    left = sum(1 for value in state.values() if value != 'done')
+                    print(f"Wrote back {path}: {stats['bytes'] / 1024 / 1024:.2f} MB in "
+                          f"{time.monotonic() - pin_started:.2f} s, {left} pins to go", flush=True)
+                    notify_systemd(f"STATUS=Writing back, {left} pins to go")
+            finally:
+                device_lock.release()
+
+        workers = []
+        for device, device_pins in plan.items():
+            worker = threading.Thread(target=flush_device, args=(device, device_pins),
+                                      name=f'rampipe-shutdown-{device}', daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        while True:
+            alive = [worker for worker in workers if worker.is_alive()]
+            if not alive:
+                break
+            now = time.monotonic()
+            if deadline is not None:
+                if now >= deadline:
+                    break
+                if extend:
+                    # Keeps pushing systemd's kill out to just after our own deadline
+                    notify_systemd(f"EXTEND_TIMEOUT_USEC={int((deadline - now + margin) * 1000000)}")
+            alive[0].join(timeout=5 if deadline is None else min(5, deadline - now))
+            writing = [path for path, value in state.items() if value == 'writing']
+            if writing and alive[0].is_alive():
+                print(f"Still writing back {', '.join(writing)}"
+                      + (f", {max(deadline - time.monotonic(), 0):.0f} s until the deadline" if deadline else ""),
+                      flush=True)
+
+        incomplete = [pin for pin in pins if state[pin['path']] != 'done']
+        if not incomplete:
+            print(f"Wrote everything back in {time.monotonic() - started:.2f} s", flush=True)
+            return []
+        print("Not everything was written back, these pins still have data only in RAM:", file=sys.stderr)
+        for pin in incomplete:
+            print(f"  {pin['path']} ({pin['type']}, priority {pin['priority']}, "
+                  f"{pin['bytes'] / 1024 / 1024:.2f} MB dirty) - {state[pin['path']]}", file=sys.stderr)
+        sys.stderr.flush()
+        notify_systemd(f"STATUS=Not written back: {', '.join(pin['path'] for pin in incomplete)}")
+        return [pin['path'] for pin in incomplete]
+
+    def shutdown(self):
+        """Write everything back and exit, once the socket server has stopped"""
+        if self.shutdown_flush():
+            # Copies still running would be killed half way by systemd anyway, don't wait
+            # for them. What is left in RAM is reported above
+            sys.stdout.flush()
+            os._exit(1)
+        if self.system_stopping():
+            self.teardown_zram()
+        # Otherwise the zram device stays, with its pins mounted, for the next start to pick up
         sys.exit(0)
 
+    def report_ready(self):
+        """Tell systemd we're up once the critical manifest pins are in RAM"""
+        self.critical_ready.wait()
+        notify_systemd("READY=1\nSTATUS=Critical pins are in RAM")
+
     def start_main_loop(self):
         """Start the main daemon loop"""
         print("Starting RamPipe daemon...")
+        self.stop_timeout = self.learn_stop_timeout()
         
         # Start periodic sync
         self.start_periodic_sync()
+        self.start_budget_manager()
+
+        if self.config_flag('autopin'):
+            self.start_autopin()
+
+        if self.config_flag('readahead'):
+            self.start_readahead_recorder()
+
+        self.start_metrics_listener()
         
         # Start socket server (blocks until shutdown)
         self.start_socket_server()
+        self.shutdown()
 
 if __name__ == '__main__':
-    # Check if running as root
-    if os.geteuid() != 0:
-        print("Error: RamPipe daemon must be run as root", file=sys.stderr)
+    # Optional config path, e.g. for a simulated setup that runs without root
+    try:
+        daemon = RamPipeDaemon(*sys.argv[1:2])
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
-    
-    daemon = RamPipeDaemon()
     daemon.start_main_loop()
\ No newline at end of file
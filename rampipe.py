@@ -5,57 +5,229 @@ CLI client for comunicating with the demon.
 """
 
 
+import os
 import socket
+import struct
+import shlex
 import sys
 import json
+import time
 import argparse
 
+SOCKET_PATH = os.environ.get('RAMPIPE_SOCKET', "/run/rampipe.sock")
+
+# Every message is a 4-byte big-endian length followed by that much JSON
+FRAME_HEADER = struct.Struct('>I')
+
+# Seconds to wait for an answer. Pinning, unpinning and syncing take as long as the copy
+# or the write-back does, so those (and batches of them) wait as long as it takes
+REQUEST_TIMEOUT = 10
+SLOW_ACTIONS = ('pin', 'unpin', 'sync', 'batch')
+
+class Connection:
+    """A persistent connection to the demon, requests and responses are matched by id"""
+
+    def __init__(self, path=SOCKET_PATH, timeout=REQUEST_TIMEOUT):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except Exception:
+            self.sock.close()
+            raise
+        self.next_id = 1
+
+    def send(self, command_dict):
+        """Send a request without waiting for the answer, returns its id"""
+        request_id = self.next_id
+        self.next_id += 1
+        data = json.dumps(dict(command_dict, id=request_id)).encode('utf-8')
+        self.sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+        return request_id
+
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Daemon closed the connection")
+            data += chunk
+        return data
+
+    def receive(self):
+        (length,) = FRAME_HEADER.unpack(self.read_exactly(FRAME_HEADER.size))
+        return json.loads(self.read_exactly(length).decode('utf-8'))
+
+    def receive_for(self, request_id):
+        # Only one request is in flight from the CLI, anything else is stale
+        while True:
+            response_data = self.receive()
+            if response_data.get('id') == request_id:
+                return response_data
+
+    def request(self, command_dict, timeout=REQUEST_TIMEOUT):
+        """Send a request and wait for its response, with timeout None for as long as it takes"""
+        self.sock.settimeout(timeout)
+        return self.receive_for(self.send(command_dict))
+
+    def stream(self, command_dict):
+        """Send a streaming request and yield every event until the last one"""
+        # Events come every second, one that is this late means the daemon is stuck
+        self.sock.settimeout(REQUEST_TIMEOUT)
+        request_id = self.send(dict(command_dict, stream=True))
+        while True:
+            response_data = self.receive_for(request_id)
+            yield response_data
+            if not response_data.get('stream'):
+                return
+
+    def close(self):
+        self.sock.close()
+
+_connection = None
+
+def connection():
+    """Connect on first use and keep the connection for the rest of the run"""
+    global _connection
+    if _connection is None:
+        _connection = Connection()
+    return _connection
+
+def request(command_dict):
+    """Send command to daemon via UNIX socket and return the decoded response"""
+    timeout = None if command_dict.get('action') in SLOW_ACTIONS else REQUEST_TIMEOUT
+    return connection().request(command_dict, timeout)
+
 def send_command(command_dict):
-    """Send command to daemon via UNIX socket and return response"""
+    """Send command to daemon, print the result and return the response on success"""
     try:
-        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        client.settimeout(10)  # 10 second timeout
-        client.connect("/run/rampipe.sock")
-        
-        # Send command
-        client.send(json.dumps(command_dict).encode('utf-8'))
-        client.shutdown(socket.SHUT_WR)  # Signal we're done writing
-        
-        # Receive response
-        response = b""
-        while True:
-            chunk = client.recv(4096)
-            if not chunk:
-                break
-            response += chunk
-        
-        response_data = json.loads(response.decode('utf-8'))
+        response_data = request(command_dict)
         
         if response_data.get('status') == 'success':
             if response_data.get('message'):
                 print(response_data['message'])
-            return True
+            return response_data
         else:
             print(f"Error: {response_data.get('message', 'Unknown error')}")
-            return False
+            return None
             
-    except socket.timeout:
+    except Exception as e:
+        report_error(e)
+        return None
+
+def report_error(e):
+    """Print why talking to the daemon failed"""
+    if isinstance(e, socket.timeout):
         print("Error: Connection timeout")
-        return False
-    except ConnectionRefusedError:
-        print("Error: Daemon not running. Start with: systemctl start rampiped")
-        return False
-    except FileNotFoundError:
+    elif isinstance(e, (ConnectionRefusedError, FileNotFoundError)):
         print("Error: Daemon not running. Start with: systemctl start rampiped")
-        return False
-    except Exception as e:
+    else:
         print(f"Error: {e}")
-        return False
+
+def follow_job(job_id):
+    """Print progress of a job until it is no longer running"""
+    interactive = sys.stdout.isatty()
+    try:
+        # The daemon pushes an event every second, no need to poll
+        for response_data in connection().stream({'action': 'job', 'job_id': job_id}):
+            if response_data.get('status') != 'success':
+                print(f"\nError: {response_data.get('message', 'Unknown error')}")
+                return False
+
+            job = response_data['job']
+            if interactive:
+                print(f"\r\033[K{response_data['message']}", end='', flush=True)
+            else:
+                print(response_data['message'])
+            if job['state'] != 'running':
+                if interactive:
+                    print()
+                return job['state'] == 'done'
+    except Exception as e:
+        print(f"\nError: {e}")
+    return False
+
+def watch_stats(interval):
+    """Redraw the stats every interval seconds until interrupted"""
+    try:
+        while True:
+            try:
+                response_data = request({'action': 'stats'})
+            except Exception as e:
+                report_error(e)
+                return
+            if response_data.get('status') != 'success':
+                print(f"Error: {response_data.get('message', 'Unknown error')}")
+                return
+            # Clear the screen and start at the top
+            print(f"\033[H\033[J{response_data['message']}", flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+def build_commands(args):
+    """Turn parsed arguments into the list of commands to send"""
+    if args.action == 'pin':
+        # Determine mode
+        if args.lock:
+            mode = 'lock'
+        elif args.overlay:
+            mode = 'overlay'
+        else:
+            mode = 'move'
+        if (args.include or args.exclude or args.max_file_size) and (args.lazy or args.dedup):
+            raise ValueError("--include, --exclude and --max-file-size don't work with --lazy and --dedup")
+        if args.lock and args.tier:
+            raise ValueError("--tier doesn't work with --lock, locked files stay in the page cache")
+        return [{'action': 'pin', 'path': path, 'mode': mode, 'lazy': args.lazy, 'dedup': args.dedup,
+                 'tier': args.tier or 'tmpfs', 'include': args.include, 'exclude': args.exclude,
+                 'max_file_size': args.max_file_size, 'priority': args.priority} for path in args.path]
+    elif args.action == 'unpin':
+        return [{'action': 'unpin', 'path': path} for path in args.path]
+    elif args.action in ('status', 'sync'):
+        return [{'action': args.action}]
+    raise ValueError(f"{args.action} can't be used in a batch")
+
+def read_batch(parser, source):
+    """Parse a batch file, one CLI command per line"""
+    stream = sys.stdin if source == '-' else open(source)
+    commands = []
+    try:
+        for number, line in enumerate(stream, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            try:
+                commands.extend(build_commands(parser.parse_args(words)))
+            except (ValueError, SystemExit) as e:
+                raise ValueError(f"{source}:{number}: {e if isinstance(e, ValueError) else 'invalid command'}")
     finally:
-        try:
-            client.close()
-        except:
-            pass
+        if stream is not sys.stdin:
+            stream.close()
+    return commands
+
+def send_batch(commands):
+    """Send several commands in one request, returns the responses"""
+    if len(commands) == 1:
+        response_data = send_command(commands[0])
+        return [response_data] if response_data else []
+    try:
+        response_data = request({'action': 'batch', 'commands': commands})
+    except Exception as e:
+        report_error(e)
+        return []
+    if 'responses' not in response_data:
+        print(f"Error: {response_data.get('message', 'Unknown error')}")
+        return []
+    succeeded = []
+    for response_data in response_data['responses']:
+        if response_data.get('status') == 'success':
+            if response_data.get('message'):
+                print(response_data['message'])
+            succeeded.append(response_data)
+        else:
+            print(f"Error: {response_data.get('message', 'Unknown error')}")
+    return succeeded
 
 def main():
     parser = argparse.ArgumentParser(description='RamPipe CLI - Manage RAM caching')
@@ -63,19 +235,55 @@ def main():
     
     # Pin command
     pin_parser = subparsers.add_parser('pin', help='Pin file/directory to RAM')
-    pin_parser.add_argument('path', help='Path to file or directory')
+    pin_parser.add_argument('path', nargs='+', help='Paths to files or directories')
     pin_parser.add_argument('--move', action='store_true', help='Use move mode (default)')
     pin_parser.add_argument('--overlay', action='store_true', help='Use overlay mode (directories only)')
+    pin_parser.add_argument('--lock', action='store_true',
+                            help="Keep the files in the page cache with mlock, no copy (for read-only stuff)")
+    pin_parser.add_argument('--include', action='append', metavar='GLOB',
+                            help="Only pin files whose name or path matches, e.g. '*.sqlite' (can be repeated)")
+    pin_parser.add_argument('--exclude', action='append', metavar='GLOB',
+                            help="Leave files and directories that match on disk, e.g. 'cache' (can be repeated)")
+    pin_parser.add_argument('--max-file-size', metavar='SIZE', help='Leave files bigger than this on disk, e.g. 10M')
+    pin_parser.add_argument('--lazy', action='store_true',
+                            help='Return at once and fill RAM in the background (directories only, implies --overlay)')
+    pin_parser.add_argument('--wait', action='store_true', help='With --lazy, show progress until RAM is filled')
+    pin_parser.add_argument('--dedup', action='store_true',
+                            help='Store files that other dedup pins have too only once (directories only)')
+    pin_parser.add_argument('--tier', choices=['tmpfs', 'zram'],
+                            help='Keep it in plain RAM (default) or compressed on zram, not for --lock')
+    pin_parser.add_argument('--priority', type=int, default=0,
+                            help='Pins with a higher priority are written back first on shutdown')
     
     # Unpin command
     unpin_parser = subparsers.add_parser('unpin', help='Unpin file/directory from RAM')
-    unpin_parser.add_argument('path', help='Path to file or directory')
+    unpin_parser.add_argument('path', nargs='+', help='Paths to files or directories')
     
     # Status command
     subparsers.add_parser('status', help='Show current status')
     
     # Sync command
     subparsers.add_parser('sync', help='Force sync all data to disk')
+
+    # Profile command
+    profile_parser = subparsers.add_parser('profile', help='Find the paths causing the most disk I/O')
+    profile_parser.add_argument('--duration', type=float, help='Seconds to sample for (default from config)')
+    profile_parser.add_argument('--top', type=int, help='How many paths to suggest for pinning')
+    profile_parser.add_argument('--apply', action='store_true', help='Pin the suggested paths')
+
+    # Jobs command
+    jobs_parser = subparsers.add_parser('jobs', help='Show background jobs')
+    jobs_parser.add_argument('job_id', nargs='?', type=int, help='Only show this job')
+    jobs_parser.add_argument('--follow', action='store_true', help='Show progress until the job is done')
+
+    # Stats command
+    stats_parser = subparsers.add_parser('stats', help='Show what the daemon measured: syncs, latencies, disk I/O avoided')
+    stats_parser.add_argument('--watch', action='store_true', help='Keep refreshing')
+    stats_parser.add_argument('--interval', type=float, default=2, help='Seconds between refreshes with --watch')
+
+    # Batch command
+    batch_parser = subparsers.add_parser('batch', help='Run pin, unpin, status and sync commands from a file')
+    batch_parser.add_argument('file', help="File with one command per line, e.g. 'pin /srv/db --overlay', or - for stdin")
     
     args = parser.parse_args()
     
@@ -84,29 +292,50 @@ def main():
         sys.exit(1)
     
     if args.action == 'pin':
-        # Determine mode
-        if args.overlay:
-            mode = 'overlay'
-        else:
-            mode = 'move'
-            
-        send_command({
-            'action': 'pin', 
-            'path': args.path, 
-            'mode': mode
-        })
+        try:
+            commands = build_commands(args)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        for response_data in send_batch(commands):
+            if args.wait and 'job_id' in response_data:
+                follow_job(response_data['job_id'])
         
-    elif args.action == 'unpin':
-        send_command({
-            'action': 'unpin',
-            'path': args.path
+    elif args.action in ('unpin', 'status', 'sync'):
+        send_batch(build_commands(args))
+
+    elif args.action == 'stats':
+        if args.watch:
+            watch_stats(args.interval)
+        else:
+            send_command({'action': 'stats'})
+
+    elif args.action == 'batch':
+        try:
+            commands = read_batch(parser, args.file)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        if commands:
+            send_batch(commands)
+
+    elif args.action == 'profile':
+        response_data = send_command({
+            'action': 'profile',
+            'duration': args.duration,
+            'top_n': args.top,
+            'apply': args.apply
         })
-        
-    elif args.action == 'status':
-        send_command({'action': 'status'})
-        
-    elif args.action == 'sync':
-        send_command({'action': 'sync'})
+        if response_data:
+            follow_job(response_data['job_id'])
+
+    elif args.action == 'jobs':
+        if args.job_id is None:
+            send_command({'action': 'jobs'})
+        elif args.follow:
+            follow_job(args.job_id)
+        else:
+            send_command({'action': 'job', 'job_id': args.job_id})
 
 if __name__ == '__main__':
     main()
\ No newline at end of file